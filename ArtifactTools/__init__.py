@@ -1,23 +1,35 @@
-import pycurl
+import io
 import os
-import yaml
 import logging
-import paramiko
+from JenkinsTools import lazy_import, load_yaml_file, ContextExecutor
+from SSHTools import get_pool
+from JenkinsTools.metrics import span, record_curl, register_secret, MASK
+from ArtifactTools.segmented import SegmentedDownload, DownloadError, parse_size
+from ArtifactTools.multi import TransferQueue, TransferResult
+from ArtifactTools.cache import ArtifactCache
+from ArtifactTools.delta import delta_put, DeltaUnavailable
+from ArtifactTools.sftpupload import pipelined_put, TransferProgress
+from ArtifactTools.distribute import Distribution, PEER_COPY
+from ArtifactTools.transport import (FileTransport, Stream, TransportError, get_transport, transport_options,
+                                     relay)
+from ArtifactTools.repo import checksum_deploy, chunked_put, checksum_headers, RepoError
+from ArtifactTools.checksum import (parse_algorithms, checksum_name, parse_checksum, StreamDigest,
+                                    HashingReader, DigestCache)
+from urllib.parse import urlparse
 # import socket
 import traceback
+
+pycurl = lazy_import('pycurl')
 # from paramiko.client import SSHClient
 
 # set logging level for the module
 log_level = logging.DEBUG
 
-# Set up logging stream
-sh = logging.StreamHandler()
-sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
-logger = logging.getLogger('DockerTools')
-logger.addHandler(sh)
+# handlers are left to the entry point, see JenkinsTools.configure_logging
+logger = logging.getLogger('ArtifactTools')
 logger.setLevel(log_level)
 
-__all__ = ['ArtifactConfig', 'ArtifactDownloader', 'ArtifactUploader']
+__all__ = ['ArtifactConfig', 'ArtifactDownloader', 'ArtifactUploader', 'run_jobs']
 
 
 class ArtifactConfig(object):
@@ -31,7 +43,7 @@ class ArtifactConfig(object):
         """
         Creates an artifact-config object from a yaml file
         This can be an upload, download or combination job.
-        Currently only one of each job type is supported
+        Each of download and upload may be a single job or a list of jobs
         :param config_file:
         """
         logger.debug("Loading config file %s" % config_file)
@@ -50,18 +62,28 @@ class ArtifactConfig(object):
 
     def read_config(self):
         try:
-            f = open(self.config_file, 'r')
+            self.config = load_yaml_file(self.config_file)
         except (OSError, IOError):
             logger.fatal("Config file (%s) not found" % self.config_file)
             exit(2)
-        else:
-            self.config = yaml.safe_load(f)
+
+    def jobs(self, key):
+        """
+        Returns the jobs of one type as a list, whether the config holds a single job or a list of them
+        :param str key: download, upload or relay
+        :return list: job config dicts
+        """
+        jobs = self.config.get(key) or []
+        if isinstance(jobs, dict):
+            jobs = [jobs]
+        return jobs
 
 
 class ArtifactDownloader:
     """
     Class to download an artifact from an http location and place it locally on the filesystem
-    Optionally grabs the MD5 if available and checks the archive
+    Optionally checksums the artifact as it downloads and checks it against the published checksum files
+    failures is set when a download fails or a checksum does not match
 
     """
     # Enums for download type
@@ -74,10 +96,11 @@ class ArtifactDownloader:
         config = kwargs[key]
         if 'artifact' in config:
             self.artifact = config['artifact']
-            # todo - following line assumes MD5 and a .3 extension on the artifact, should support others.
-            self.checksum = self.artifact.replace(config['artifact'], config['artifact'][:-4] + '.md5')
         else:
             self.artifact_url = None
+        self.algorithms = parse_algorithms(config.get('checksum'))
+        self.digests = {}
+        self.remote_checksums = {}
         if 'url' in config:
             self.artifact_url = config['url']
         else:
@@ -94,8 +117,20 @@ class ArtifactDownloader:
             self.api_key = config['apikey']
         else:
             self.api_key = None
+        self.connections = config.get('connections', 4)
+        self.segment_size = config.get('segment_size', '8M')
+        self.retries = config.get('retries', 5)
+        self.retry_backoff = config.get('retry_backoff', 1.0)
+        self.cache_dir = config.get('cache')
+        self.cache_size = config.get('cache_size', '10G')
+        self.cache_hardlink = config.get('cache_hardlink', False)
+        self.cache = ArtifactCache(self.cache_dir, self.cache_size, self.cache_hardlink) if self.cache_dir else None
+        self.transport_options = transport_options(config)
+        register_secret(self.password)
+        register_secret(self.api_key)
         logger.debug("Download config - Artifact: %s, Checksum: %s, URL: %s, Username: %s, Password: %s, ApiKey: %s " %
-                     (self.artifact, self.checksum, self.artifact_url, self.user, self.password, self.api_key))
+                     (self.artifact, self.algorithms, self.artifact_url, self.user, self.password and MASK,
+                      self.api_key and MASK))
 
     def set_url(self, artifact_url):
         """
@@ -125,38 +160,178 @@ class ArtifactDownloader:
     def download(self, source=ARTIFACT):
         """
         Attempts to pull the named artifact down from the remote location
-        # ToDo: make this NOT nexus specific
+        The artifact itself is fetched in parallel segments and resumed if a previous attempt failed part way,
+        computing the configured checksums as it arrives. CHECKSUM fetches the published checksum file for each.
+        Urls other than http(s), e.g. s3:// or sftp://, are streamed through the matching transport.
         :return:
         """
-        down = pycurl.Curl()
         if source == ArtifactDownloader.ARTIFACT and self.__check_url__():
-            f = open(self.artifact, 'wb')
-            down.setopt(down.URL, self.artifact_url + self.artifact)
+            with span('artifact.download', scheme=urlparse(self.artifact_url).scheme or 'file') as s:
+                auth = (self.user, self.password) if self.user else None
+                url = self.artifact_url + self.artifact
+                if not self._is_http(url):
+                    try:
+                        self.digests = self.fetch_with_transport(url, self.artifact, self.algorithms)
+                    except TransportError as e:
+                        s.ok = False
+                        self.failures = True
+                        logger.fatal("Failed to download: %s\n%s" % (url, e))
+                        if log_level != logging.DEBUG:
+                            exit(2)
+                    return
+
+                def fetch(path, algorithms):
+                    engine = SegmentedDownload(url, path, connections=self.connections,
+                                               segment_size=self.segment_size, retries=self.retries,
+                                               backoff=self.retry_backoff, auth=auth, algorithms=algorithms)
+                    engine.run()
+                    s.set(bytes=engine.size or 0, resumed_bytes=engine.resumed_bytes)
+                    return engine.digest.hexdigests()
+
+                try:
+                    if self.cache is not None:
+                        self.digests = self.cache.fetch(url, self.artifact,
+                                                        lambda path: fetch(path, self._cache_algorithms()),
+                                                        self.algorithms, auth)
+                        logger.info("Artifact cache stats: %s" % self.cache.usage())
+                    else:
+                        self.digests = fetch(self.artifact, self.algorithms)
+                except (DownloadError, pycurl.error, OSError) as e:
+                    s.ok = False
+                    self.failures = True
+                    logger.fatal("Failed to download: %s\n%s" % (url, e))
+                    if log_level != logging.DEBUG:
+                        exit(2)
+                return
         if source == ArtifactDownloader.CHECKSUM and self.__check_url__():
-            f = open(self.checksum, 'wb')
-            down.setopt(down.URL, self.artifact_url + self.checksum)
+            for algorithm in self.algorithms:
+                self.download_checksum(algorithm)
+
+    @staticmethod
+    def _is_http(url):
+        return urlparse(url).scheme in ('http', 'https')
+
+    def fetch_with_transport(self, url, path, algorithms):
+        """
+        Streams url to a local file through its transport
+        :return dict: algorithm -> hex digest
+        """
+        digest = StreamDigest(algorithms)
+
+        def hashed(stream):
+            for chunk in stream:
+                digest.update(chunk)
+                yield chunk
+        with get_transport(url, self.transport_options).open(url) as stream:
+            FileTransport().put(path, Stream(hashed(stream), stream.size))
+        return digest.hexdigests()
+
+    def download_checksum(self, algorithm):
+        """
+        Fetches the checksum file published alongside the artifact for one algorithm
+        :param str algorithm:
+        :return:
+        """
+        name = checksum_name(self.artifact, algorithm)
+        if not self._is_http(self.artifact_url + name):
+            try:
+                self.fetch_with_transport(self.artifact_url + name, name, [])
+                self.read_checksum(algorithm)
+            except TransportError as e:
+                logger.error("No %s checksum published for %s (%s)" % (algorithm, self.artifact, e))
+            return
+        down = pycurl.Curl()
+        f = open(name, 'wb')
+        down.setopt(down.URL, self.artifact_url + name)
         down.setopt(pycurl.FOLLOWLOCATION, 1)
         down.setopt(pycurl.MAXREDIRS, 3)
         down.setopt(pycurl.TIMEOUT, 30)
         down.setopt(pycurl.NOSIGNAL, 1)
         down.setopt(pycurl.WRITEDATA, f)
+        if self.user:
+            down.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+            down.setopt(pycurl.USERPWD, "%s:%s" % (self.user, self.password))
         try:
             down.perform()
+            status = down.getinfo(pycurl.RESPONSE_CODE)
         except pycurl.error as e:
+            record_curl('http.transfer', down, self.artifact_url + name, False, kind='checksum')
+            self.failures = True
             logger.fatal("Failed to download: %s\n%s" % (down.getinfo(pycurl.EFFECTIVE_URL), e))
             down.close()
+            f.close()
             if log_level != logging.DEBUG:
                 exit(2)
+            return
+        record_curl('http.transfer', down, self.artifact_url + name, kind='checksum')
         down.close()
+        f.close()
+        if status < 400:
+            self.read_checksum(algorithm)
+        else:
+            logger.error("No %s checksum published for %s (HTTP %s)" % (algorithm, self.artifact, status))
+
+    def read_checksum(self, algorithm):
+        with open(checksum_name(self.artifact, algorithm), 'rb') as f:
+            self.remote_checksums[algorithm] = parse_checksum(f.read())
+
+    def queue(self, transfers):
+        """
+        Adds the artifact download, and its checksum files, to a TransferQueue rather than downloading straight away
+        :param TransferQueue transfers:
+        :return TransferResult: the artifact download
+        """
+        auth = (self.user, self.password) if self.user else None
+        url = self.artifact_url + self.artifact
+        for algorithm in self.algorithms:
+            name = checksum_name(self.artifact, algorithm)
+            transfers.add_download(self.artifact_url + name, name, auth)
+        if self.cache is None:
+            return transfers.add_download(url, self.artifact, auth, algorithms=self.algorithms)
+        digests = self.cache.lookup(url, self.artifact, self.algorithms, auth)
+        if digests is not None:
+            result = TransferResult(TransferResult.DOWNLOAD, url, self.artifact)
+            result.ok = True
+            result.digests = digests
+            return result
+        return transfers.add_download(url, self.cache.incoming_path(url), auth, algorithms=self._cache_algorithms())
+
+    def finish_queued(self, result):
+        """
+        Completes a queued download once the TransferQueue has run, adding it to the cache if one is configured
+        :param TransferResult result: as returned by queue
+        """
+        if self.cache is not None and result.ok and result.path != self.artifact:
+            result.digests = self.cache.store(result.url, result.path, result.digests, self.artifact, self.algorithms)
+            result.path = self.artifact
+        self.digests = result.digests
+
+    def _cache_algorithms(self):
+        return sorted(set(self.algorithms) | set(['sha256']))
 
     def check_checksum(self):
-        pass
+        """
+        Compares the checksums computed during download with the published ones
+        :return bool: True if every configured checksum matched
+        """
+        for algorithm in self.algorithms:
+            expected = self.remote_checksums.get(algorithm)
+            actual = self.digests.get(algorithm)
+            if expected is None or actual is None:
+                logger.error("Cannot verify %s of %s, checksum unavailable" % (algorithm, self.artifact))
+                self.failures = True
+            elif expected != actual:
+                logger.error("%s mismatch for %s: expected %s, got %s" % (algorithm, self.artifact, expected, actual))
+                self.failures = True
+            else:
+                logger.info("%s of %s verified: %s" % (algorithm, self.artifact, actual))
+        return not self.failures
 
 
 class ArtifactUploader:
     """
     Class to upload an artifact to a location either artifact repo or local/remote filesystem
-    Optionally creates and/or pushes the MD5 if available/required
+    Optionally computes checksums while uploading and publishes them alongside the artifact
 
     """
     # Enums for download type
@@ -170,9 +345,10 @@ class ArtifactUploader:
         config = kwargs[key]
         if 'artifact' in config:
             self.artifact = config['artifact']
-            self.checksum = self.artifact.replace(config['artifact'], config['artifact'][:-4] + '.md5')
         else:
             self.target = None
+        self.algorithms = parse_algorithms(config.get('checksum'))
+        self.digests = {}
         if 'target' in config:
             self.target = config['target']
         else:
@@ -188,7 +364,7 @@ class ArtifactUploader:
         if 'target_port' in config:
             self.target_port = config['target_port']
         else:
-            self.target_type = 22
+            self.target_port = 22
         if 'username' in config:
             self.user = config['username']
         else:
@@ -205,79 +381,401 @@ class ArtifactUploader:
             self.api_key = config['apikey']
         else:
             self.api_key = None
+        self.delta = bool(config.get('delta', False))
+        self.delta_min_savings = float(config.get('delta_min_savings', 0.5))
+        self.delta_block_size = parse_size(config['delta_block_size']) if config.get('delta_block_size') else None
+        self.delta_scan_timeout = float(config.get('delta_scan_timeout', 60))
+        self.remote_python = config.get('remote_python', 'python3')
+        self.compress = bool(config.get('compress', False))
+        self.window_size = parse_size(config.get('window_size', '16M'))
+        self.packet_size = parse_size(config['packet_size']) if config.get('packet_size') else None
+        self.max_outstanding = int(config.get('max_outstanding', 256))
+        self.progress_interval = float(config.get('progress_interval', 5))
+        self.checksum_deploy = bool(config.get('checksum_deploy', True))
+        self.chunk_size = parse_size(config['chunk_size']) if config.get('chunk_size') else None
+        self.chunk_connections = int(config.get('chunk_connections', 4))
+        self.digest_cache = DigestCache(config.get('digest_cache'))
+        self.hosts = config.get('hosts') or []
+        self.transport_options = transport_options(config)
+        self.distribution = {'seeds': config.get('seeds', 2), 'fan_out': config.get('fan_out', 4),
+                             'max_in_flight': config.get('max_in_flight', 16),
+                             'peer_copy': config.get('peer_copy', PEER_COPY), 'retries': config.get('peer_retries', 2),
+                             'forward_agent': bool(config.get('forward_agent', False))}
+        register_secret(self.password)
+        register_secret(self.api_key)
         logger.debug("Upload config - Artifact: %s, Checksum: %s, Target: %s, Username: %s, Password: %s, ApiKey: %s " %
-                     (self.artifact, self.checksum, self.target, self.user, self.password, self.api_key))
+                     (self.artifact, self.algorithms, self.target, self.user, self.password and MASK,
+                      self.api_key and MASK))
 
     def upload_to_repo(self, source=ARTIFACT):
-        up = pycurl.Curl()
-        up_file_size = None
-        up_file = None
+        """
+        PUTs the artifact to the repository, then its checksum files.
+        With checksum_deploy (the default) and the artifact's digests already known, the repository is first asked
+        whether it already holds the content, and the body is only sent if it does not. Artifacts larger than
+        chunk_size are sent as parallel ranged PUTs where the repository accepts them.
+        :param source:
+        :return:
+        """
+        auth, headers = self._repo_auth()
+        size = os.path.getsize(self.artifact)
         logger.info("Uploading to %s" % self.target)
-        up.setopt(pycurl.URL, self.target)
-        if source == self.ARTIFACT:
-            up_file_size = os.path.getsize(self.artifact)
-            up_file = open(self.artifact, 'rb')
-        if not self.api_key:
-            up.setopt(pycurl.PUT, 1)
+        try:
+            sent, headers, digests = self.send_without_put(auth, headers, size)
+            if not sent:
+                digests = self.put_to_repo(auth, headers, size, digests)
+        except (pycurl.error, RepoError) as e:
+            logger.fatal("Failed to upload: %s" % e)
+            self.failures = True
+            if log_level != logging.DEBUG:
+                exit(2)
+            return
+        self.digests = dict((a, digests[a]) for a in self.algorithms if a in digests)
+        for algorithm, value in self.digests.items():
+            self.publish_checksum_to_repo(algorithm, value)
+
+    def send_without_put(self, auth, headers, size):
+        """
+        Publishes the artifact by checksum deploy or a chunked upload where configured and possible
+        :param tuple auth: (username, password) or None
+        :param list headers: request headers
+        :param int size:
+        :return tuple: True if the artifact was published, the headers for a PUT of the body with the checksum
+                       headers added, and the digests if they had to be computed
+        :raises RepoError: if the repository rejects the upload
+        """
+        chunked = self.chunk_size is not None and size > self.chunk_size
+        # only digests known from an earlier upload are used: working them out here would read the artifact once
+        # more before sending it, while a PUT of the body hashes it on the way for the next upload
+        digests = self.digest_cache.lookup(self.artifact, self.repo_algorithms()) or {}
+        headers = headers + checksum_headers(digests)
+        if self.checksum_deploy and digests and checksum_deploy(self.target, digests, auth, headers,
+                                                                self.target_type):
+            logger.info("%s already holds the content of %s, published without sending it" %
+                        (self.target_type, self.artifact))
+            return True, headers, digests
+        if chunked and chunked_put(self.target, self.artifact, size, self.chunk_size, self.chunk_connections, auth,
+                                   headers):
+            if not digests and self.algorithms:
+                # the chunks are read out of order, so the checksum files need a read of their own
+                digests = self.digest_cache.digests(self.artifact, self.algorithms)
+            return True, headers, digests
+        return False, headers, digests
+
+    def repo_algorithms(self):
+        """
+        :return list: digests worth keeping for the artifact: the checksums to publish, plus those checksum deploy
+                      sends
+        """
+        return sorted(set(self.algorithms) | ({'sha1', 'sha256'} if self.checksum_deploy else set()))
+
+    def put_to_repo(self, auth, headers, size, digests=None):
+        """
+        Sends the whole artifact in one PUT
+        :param tuple auth: (username, password) or None
+        :param list headers: request headers
+        :param int size:
+        :param dict digests: already known digests, otherwise they are computed as the artifact is sent
+        :return dict: algorithm -> hex digest
+        :raises RepoError: if the repository rejects the upload
+        """
+        digest = StreamDigest([] if digests else self.repo_algorithms())
+        up = pycurl.Curl()
+        try:
+            with open(self.artifact, 'rb') as f:
+                up.setopt(pycurl.URL, self.target)
+                up.setopt(pycurl.UPLOAD, 1)
+                if auth:
+                    up.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+                    up.setopt(pycurl.USERPWD, "%s:%s" % auth)
+                if headers:
+                    up.setopt(pycurl.HTTPHEADER, headers)
+                up.setopt(pycurl.INFILESIZE_LARGE, size)
+                up.setopt(pycurl.READFUNCTION, HashingReader(f, digest).read)
+                up.setopt(pycurl.WRITEFUNCTION, lambda data: None)
+                up.perform()
+                status = up.getinfo(pycurl.RESPONSE_CODE)
+        finally:
+            record_curl('http.transfer', up, self.target, kind='upload')
+            up.close()
+        if status >= 400:
+            raise RepoError("%s rejected the upload with HTTP status %s" % (self.target, status))
+        if digests:
+            return digests
+        self.digest_cache.store(self.artifact, digest.hexdigests())
+        return digest.hexdigests()
+
+    def publish_checksum_to_repo(self, algorithm, value):
+        """
+        PUTs a checksum file next to the uploaded artifact
+        :param str algorithm:
+        :param str value: hex digest
+        :return:
+        """
+        url = checksum_name(self.target, algorithm)
+        data = value.encode('ascii')
+        up = pycurl.Curl()
+        auth, headers = self._repo_auth()
+        up.setopt(pycurl.URL, url)
+        up.setopt(pycurl.UPLOAD, 1)
+        if auth:
             up.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
-            up.setopt(pycurl.USERPWD, "%s:%s" % (self.user, self.password))
-            up.setopt(pycurl.INFILESIZE, up_file_size)
-            up.setopt(pycurl.INFILE, up_file)
-        else:
-            # TODO: This doesn't work yet.... fix key-based auth option
-            up.setopt(up.HTTPPOST, [
-                ('artifact_upload', (
-                    up.FORM_FILE, self.artifact,
-                    up.FORM_CONTENTTYPE, 'application/gzip',
-                    up.HEADER, "X-JFrog-Art-Api:%s" % self.api_key,
-                ))
-            ])
+            up.setopt(pycurl.USERPWD, "%s:%s" % auth)
+        if headers:
+            up.setopt(pycurl.HTTPHEADER, headers)
+        up.setopt(pycurl.INFILESIZE, len(data))
+        up.setopt(pycurl.READFUNCTION, io.BytesIO(data).read)
         try:
             up.perform()
         except pycurl.error as e:
-            logger.fatal("Failed to upload: %s" + str(e))
-            up.close()
-            if log_level != logging.DEBUG:
-                exit(2)
+            logger.error("Failed to publish %s checksum to %s: %s" % (algorithm, url, e))
+            self.failures = True
+        record_curl('http.transfer', up, url, kind='checksum')
         up.close()
 
     def upload_to_server(self, target=None):
-        use_gssapi = False
-        do_gssapi_key_exchange = False
         if target is not None:
             # ToDo - scp transfer to target optionally via user/key or user/pass
-            logger.debug("Uploading artifact %s to target (%s)" % (self.artifact, self.target))
             try:
-                k = paramiko.RSAKey.from_private_key_file(self.identity_file)
-                t = paramiko.Transport((self.target, self.target_port))
-                t.connect(username=self.user, gss_host=self.target,
-                          gss_auth=use_gssapi, gss_kex=do_gssapi_key_exchange, pkey=k)
-                sftp = paramiko.SFTPClient.from_transport(t)
-                sftp.put(self.artifact, self.target_path)
-
+                self.put_to_server()
             except Exception as e:
                 logger.error('Upload via ssh/sftp failed with error: \n%s\n%s' % (e.__class__, e))
                 if log_level == logging.DEBUG:
                     traceback.print_exc()
-                try:
-                    t.close()
-                except:
-                    pass
                 exit(1)
 
         else:
             logger.error("Target not specified - unable to perform upload...")
             exit(2)
 
+    def put_to_server(self):
+        """
+        Copies the artifact to the target over sftp, raising on failure rather than exiting
+        so that it can be used from worker threads.
+        :return:
+        """
+        logger.debug("Uploading artifact %s to target (%s)" % (self.artifact, self.target))
+        transport = get_pool().transport(self.target, self.target_port, self.user, self.identity_file, self.compress)
+        digest = StreamDigest(self.algorithms)
+        sent = False
+        if self.delta:
+            try:
+                delta_put(transport, self.artifact, self.target_path, self.delta_block_size, self.delta_min_savings,
+                          self.remote_python, digest, scan_timeout=self.delta_scan_timeout)
+                sent = True
+            except DeltaUnavailable as e:
+                logger.info("Not using a delta upload for %s (%s), sending the whole file" % (self.artifact, e))
+        sftp = get_pool().sftp(self.target, self.target_port, self.user, self.identity_file, self.compress,
+                               self.window_size, self.packet_size)
+        try:
+            if not sent:
+                progress = TransferProgress('Upload of %s' % os.path.basename(self.artifact), self.progress_interval)
+                size = os.path.getsize(self.artifact)
+                with span('artifact.sftp.upload', host=self.target) as s, open(self.artifact, 'rb') as f:
+                    pipelined_put(sftp, HashingReader(f, digest), self.target_path, size, self.max_outstanding,
+                                  progress=progress)
+                    s.set(bytes=size)
+            self.digests = digest.hexdigests()
+            for algorithm, value in self.digests.items():
+                with sftp.open(checksum_name(self.target_path, algorithm), 'w') as f:
+                    f.write(value)
+        finally:
+            sftp.close()
+
+    def upload_with_transport(self):
+        """
+        Writes the artifact, then its checksum files, to an s3:// or file target through the transport layer,
+        raising TransportError on failure. The checksums are computed as the artifact is sent, unless the digest
+        cache already has them, in which case the file is passed on untouched (e.g. to sendfile).
+        :return:
+        """
+        transport = get_transport(self.target, self.transport_options)
+        digests = self.digest_cache.lookup(self.artifact, self.algorithms)
+        with FileTransport().open(self.artifact) as stream:
+            if digests is not None:
+                transport.put(self.target, stream)
+            else:
+                digest = StreamDigest(self.algorithms)
+
+                def hashed(chunks):
+                    for chunk in chunks:
+                        digest.update(chunk)
+                        yield chunk
+                transport.put(self.target, Stream(hashed(stream), stream.size))
+                digests = digest.hexdigests()
+                self.digest_cache.store(self.artifact, digests)
+        self.digests = digests
+        for algorithm, value in self.digests.items():
+            transport.put(checksum_name(self.target, algorithm), Stream.from_bytes(value.encode('ascii')))
+        logger.info("Uploaded %s to %s" % (self.artifact, self.target))
+
+    def distribute(self):
+        """
+        Sends the artifact to every host in hosts, uploading to a few seeds and letting the rest copy from peers
+        :return list: HopResult per host
+        """
+        results = Distribution(self, self.hosts, **self.distribution).run()
+        failed = [r for r in results if not r.ok]
+        for result in failed:
+            logger.error("Distribution to %s failed: %s" % (result.host, result.error))
+        if failed:
+            self.failures = True
+        return results
+
+    def _repo_auth(self):
+        auth = None
+        headers = []
+        if self.api_key:
+            headers.append('X-JFrog-Art-Api: %s' % self.api_key)
+        elif self.user:
+            auth = (self.user, self.password)
+        return auth, headers
+
+    def queue(self, transfers):
+        """
+        Adds an upload to an artifact repository to a TransferQueue rather than uploading it straight away.
+        A checksum deploy, or a chunked upload, is made straight away; only a PUT of the whole body is queued.
+        :param TransferQueue transfers:
+        :return TransferResult:
+        """
+        auth, headers = self._repo_auth()
+        result = TransferResult(TransferResult.UPLOAD, self.target, self.artifact)
+        try:
+            sent, headers, digests = self.send_without_put(auth, headers, os.path.getsize(self.artifact))
+        except (pycurl.error, RepoError, OSError) as e:
+            logger.error("Failed to upload %s: %s" % (self.artifact, e))
+            result.error = str(e)
+            return result
+        if not sent:
+            return transfers.add_upload(self.target, self.artifact, auth, headers,
+                                        [] if digests else self.repo_algorithms())
+        result.ok = True
+        result.digests = dict((a, digests[a]) for a in self.algorithms if a in digests)
+        return result
+
+    def queue_checksums(self, transfers, result):
+        """
+        Queues the checksum files for a completed upload, computed while it was sent
+        :param TransferQueue transfers:
+        :param TransferResult result: the artifact upload
+        """
+        if result.digests and set(result.digests) >= set(self.repo_algorithms()):
+            self.digest_cache.store(self.artifact, result.digests)
+        else:
+            result.digests = self.digest_cache.lookup(self.artifact, self.algorithms) or result.digests
+        self.digests = dict((a, result.digests[a]) for a in self.algorithms if a in result.digests)
+        auth, headers = self._repo_auth()
+        for algorithm, value in self.digests.items():
+            transfers.add_upload(checksum_name(self.target, algorithm), None, auth, headers,
+                                 data=value.encode('ascii'))
+
     def upload(self):
+        with span('artifact.upload', target_type=self.target_type) as s:
+            self._upload()
+            s.ok = not self.failures
+
+    def _upload(self):
         logger.debug("Target type is %s" % self.target)
-        if self.target_type == 'ssh':
+        if self.target_type == 'ssh' and self.hosts:
+            self.distribute()
+        elif self.target_type == 'ssh':
             self.upload_to_server(target=self.target)
         elif self.target_type == 'artifactory':
-            self.upload_to_repo(self.target)
+            self.upload_to_repo()
         elif self.target_type == 'nexus':
-            self.upload_to_repo(self.target)
+            self.upload_to_repo()
+        elif self.target_type in ('s3', 'file'):
+            try:
+                self.upload_with_transport()
+            except TransportError as e:
+                logger.fatal("Failed to upload: %s" % e)
+                self.failures = True
         else:
             logger.error("Unknown target in config - upload cannot be performed")
             exit(2)
 
+
+def run_jobs(config):
+    """
+    Runs every download job, then every upload and relay job, in the config concurrently.
+    HTTP transfers share one TransferQueue, and so one set of connections per host; ssh, s3 and file uploads and
+    relays run on a thread pool. ssh uploads with hosts are distributed to every host, with an outcome per host.
+    The number of transfers in flight is set by the top level concurrency key (default 8) and connections per host
+    by max_host_connections (default 4).
+    :param ArtifactConfig config:
+    :return list: (job type, artifact, ok, error) for each job
+    """
+    concurrency = config.config.get('concurrency', 8)
+    host_connections = config.config.get('max_host_connections', 4)
+    outcomes = []
+
+    downloads = [ArtifactDownloader({'download': job}, 'download') for job in config.jobs('download')]
+    if downloads:
+        transfers = TransferQueue(concurrency, host_connections, downloads[0].retries, downloads[0].retry_backoff)
+        queued = [(ad, ad.queue(transfers)) for ad in downloads]
+        transfers.run()
+        for ad, result in queued:
+            try:
+                ad.finish_queued(result)
+            except (IOError, OSError) as e:
+                result.ok, result.error = False, str(e)
+            ok, error = result.ok, result.error
+            if ok and ad.algorithms:
+                for algorithm in ad.algorithms:
+                    if os.path.exists(checksum_name(ad.artifact, algorithm)):
+                        ad.read_checksum(algorithm)
+                if not ad.check_checksum():
+                    ok, error = False, 'checksum mismatch'
+            outcomes.append(('download', result.path, ok, error))
+
+    uploads = [ArtifactUploader({'upload': job}, 'upload') for job in config.jobs('upload')]
+    transfers = TransferQueue(concurrency, host_connections)
+    repo_uploads = [au for au in uploads if au.target_type in ('artifactory', 'nexus')]
+    server_uploads = [au for au in uploads if au.target_type in ('ssh', 's3', 'file')]
+    for au in uploads:
+        if au not in repo_uploads and au not in server_uploads:
+            logger.error("Unknown target type %s for %s - upload cannot be performed" % (au.target_type, au.artifact))
+            outcomes.append(('upload', au.artifact, False, 'unknown target type %s' % au.target_type))
+    queued = [(au, au.queue(transfers)) for au in repo_uploads]
+
+    def put(au):
+        try:
+            if au.target_type == 'ssh' and au.hosts:
+                return [('upload', '%s on %s' % (au.artifact, r.host), r.ok, r.error) for r in au.distribute()]
+            if au.target_type == 'ssh':
+                au.put_to_server()
+            else:
+                au.upload_with_transport()
+            return [('upload', au.artifact, True, None)]
+        except Exception as e:
+            logger.error('Upload of %s to %s failed: %s' % (au.artifact, au.target, e))
+            return [('upload', au.artifact, False, str(e))]
+
+    def relay_job(job):
+        try:
+            relay(job['source'], job['destination'], transport_options(job.get('source_options') or {}),
+                  transport_options(job.get('destination_options') or {}), parse_algorithms(job.get('checksum')))
+            return 'relay', job['source'], True, None
+        except Exception as e:
+            logger.error('Relay of %s to %s failed: %s' % (job.get('source'), job.get('destination'), e))
+            return 'relay', job.get('source'), False, str(e)
+
+    with ContextExecutor(max_workers=concurrency) as pool:
+        server_results = pool.map(put, server_uploads)
+        relay_results = pool.map(relay_job, config.jobs('relay'))
+        if repo_uploads:
+            transfers.run()
+            checksums = TransferQueue(concurrency, host_connections)
+            for au, result in queued:
+                if result.ok:
+                    au.queue_checksums(checksums, result)
+            checksum_results = checksums.run()
+            for au, result in queued:
+                ok, error = result.ok, result.error
+                failed = [r for r in checksum_results if r.url.startswith(au.target + '.') and not r.ok]
+                if ok and failed:
+                    ok, error = False, 'publishing checksum failed: %s' % failed[0].error
+                outcomes.append(('upload', result.path, ok, error))
+        for results in server_results:
+            outcomes.extend(results)
+        outcomes.extend(relay_results)
+    return outcomes
@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager
+from JenkinsTools import lazy_import
+from ArtifactTools.segmented import parse_size, _Response
+
+pycurl = lazy_import('pycurl')
+
+"""
+Local artifact cache shared by the jobs on an agent.
+Downloads are stored once under objects/<sha256> and indexed by url along with the ETag / Last-Modified the server
+returned. A later request for the same url is revalidated with a conditional HEAD and, if unchanged, the stored
+object is reflinked (or copied) into the workspace instead of being downloaded again. Hardlinking is opt in: the
+workspace file then shares the object's inode, so a job writing to it corrupts the cache for every other job.
+The index is guarded by a file lock, and the least recently used entries are evicted once the cache exceeds its size.
+
+"""
+
+logger = logging.getLogger('ArtifactTools')
+
+__all__ = ['ArtifactCache']
+
+FICLONE = 0x40049409
+
+
+def link_file(source, dest, hardlink=False):
+    """
+    Places source at dest without copying the data where the filesystem allows it:
+    a reflink (copy on write clone) first, then a hardlink if allowed, falling back to a copy
+    :param bool hardlink: allow dest to share source's inode
+    :return str: reflink, hardlink or copy
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        with open(source, 'rb') as src:
+            with open(dest, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return 'reflink'
+    except (IOError, OSError):
+        if os.path.exists(dest):
+            os.remove(dest)
+    if hardlink:
+        try:
+            os.link(source, dest)
+            return 'hardlink'
+        except OSError:
+            pass
+    shutil.copyfile(source, dest)
+    return 'copy'
+
+
+class ArtifactCache(object):
+    """
+    :param str directory: cache location, shared between jobs on the agent
+    :param max_size: maximum bytes held, plain integer or with a K/M/G suffix
+    :param bool hardlink: hardlink objects into workspaces when they cannot be reflinked, rather than copying them
+    """
+    def __init__(self, directory, max_size='10G', hardlink=False):
+        self.directory = os.path.expanduser(directory)
+        self.hardlink = hardlink
+        self.objects = os.path.join(self.directory, 'objects')
+        self.index_path = os.path.join(self.directory, 'index.json')
+        self.max_size = parse_size(max_size)
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes_saved': 0}
+        self._validators = {}
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+
+    @contextmanager
+    def _index(self):
+        """
+        Holds the cache lock, yielding the index for reading and updating
+        """
+        with open(os.path.join(self.directory, 'lock'), 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.index_path) as f:
+                        index = json.load(f)
+                except (IOError, OSError, ValueError):
+                    index = {'entries': {}, 'stats': {}}
+                yield index
+                tmp = self.index_path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(index, f)
+                os.rename(tmp, self.index_path)
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _object_path(self, sha256):
+        return os.path.join(self.objects, sha256)
+
+    def revalidate(self, url, entry, auth=None):
+        """
+        Asks the server whether the cached copy of url is current, sending its ETag / Last-Modified
+        :return tuple: (current, etag, last_modified) - the validators are the server's latest
+        """
+        c = pycurl.Curl()
+        response = _Response()
+        headers = []
+        if entry.get('etag'):
+            headers.append('If-None-Match: %s' % entry['etag'])
+        if entry.get('last_modified'):
+            headers.append('If-Modified-Since: %s' % entry['last_modified'])
+        c.setopt(pycurl.URL, url)
+        c.setopt(pycurl.NOBODY, 1)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.MAXREDIRS, 3)
+        c.setopt(pycurl.NOSIGNAL, 1)
+        c.setopt(pycurl.TIMEOUT, 30)
+        c.setopt(pycurl.HTTPHEADER, headers)
+        c.setopt(pycurl.HEADERFUNCTION, response.header)
+        if auth:
+            c.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+            c.setopt(pycurl.USERPWD, "%s:%s" % auth)
+        try:
+            c.perform()
+        finally:
+            c.close()
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if response.status == 304:
+            return True, entry.get('etag'), entry.get('last_modified')
+        if response.status is None or response.status >= 400:
+            return False, None, None
+        current = bool((etag and etag == entry.get('etag')) or
+                       (not etag and last_modified and last_modified == entry.get('last_modified')))
+        return current, etag, last_modified
+
+    def lookup(self, url, dest, algorithms=(), auth=None):
+        """
+        Links the cached copy of url into dest if the server confirms it is still current
+        :param str url:
+        :param str dest: workspace path
+        :param list algorithms: digests wanted by the caller
+        :param tuple auth: optional (username, password) used for revalidation
+        :return dict: digests for the requested algorithms on a hit, None on a miss
+        """
+        with self._index() as index:
+            entry = index['entries'].get(url)
+        if entry is not None and os.path.exists(self._object_path(entry['sha256'])):
+            current, etag, last_modified = self.revalidate(url, entry, auth)
+            if current:
+                try:
+                    method = link_file(self._object_path(entry['sha256']), dest, self.hardlink)
+                except (IOError, OSError) as e:
+                    logger.warning("Cached copy of %s unusable, downloading again: %s" % (url, e))
+                else:
+                    digests = self._digests(entry, algorithms)
+                    with self._index() as index:
+                        entry['last_used'] = time.time()
+                        index['entries'][url] = entry
+                        self._count(index, 'hits')
+                        self._count(index, 'bytes_saved', entry['size'])
+                    logger.info("Cache hit for %s (%s, %d bytes not downloaded)" % (url, method, entry['size']))
+                    return digests
+        else:
+            current, etag, last_modified = self.revalidate(url, {}, auth)
+        logger.info("Cache miss for %s" % url)
+        self._validators[url] = (etag, last_modified)
+        return None
+
+    def incoming_path(self, url):
+        """
+        :return str: where a download of url should be written before it is passed to store
+        """
+        return os.path.join(self.directory, 'incoming-%d-%s' % (os.getpid(), hashlib.sha1(url.encode()).hexdigest()))
+
+    def store(self, url, path, digests, dest, algorithms=()):
+        """
+        Moves a completed download into the cache and links it into dest
+        :param str url:
+        :param str path: the downloaded file, normally incoming_path(url)
+        :param dict digests: digests computed during the download, must include sha256
+        :param str dest: workspace path
+        :param list algorithms: digests wanted by the caller
+        :return dict: digests for the requested algorithms
+        """
+        etag, last_modified = self._validators.pop(url, (None, None))
+        try:
+            sha256 = digests['sha256']
+            size = os.path.getsize(path)
+            target = self._object_path(sha256)
+            if os.path.exists(target):
+                os.remove(path)
+            else:
+                os.chmod(path, 0o444)
+                os.rename(path, target)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        link_file(target, dest, self.hardlink)
+        with self._index() as index:
+            index['entries'][url] = {'sha256': sha256, 'size': size, 'etag': etag, 'last_modified': last_modified,
+                                     'digests': digests, 'last_used': time.time()}
+            self._count(index, 'misses')
+            self._evict(index)
+        return dict((a, digests[a]) for a in algorithms if a in digests)
+
+    def fetch(self, url, dest, download, algorithms=(), auth=None):
+        """
+        Places the artifact at url in dest, from the cache if the server confirms it is current,
+        otherwise by calling download and adding the result to the cache.
+
+        :param download: callable(path) downloading url to path and returning its digests,
+                         which must include sha256
+        :return dict: digests of the artifact for the requested algorithms
+        """
+        digests = self.lookup(url, dest, algorithms, auth)
+        if digests is not None:
+            return digests
+        path = self.incoming_path(url)
+        try:
+            digests = download(path)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return self.store(url, path, digests, dest, algorithms)
+
+    def _digests(self, entry, algorithms):
+        missing = [a for a in algorithms if a not in entry.get('digests', {})]
+        if missing:
+            hashes = [(a, hashlib.new(a)) for a in missing]
+            with open(self._object_path(entry['sha256']), 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                    for algorithm, h in hashes:
+                        h.update(chunk)
+            entry.setdefault('digests', {}).update((a, h.hexdigest()) for a, h in hashes)
+        return dict((a, entry['digests'][a]) for a in algorithms)
+
+    def _count(self, index, stat, amount=1):
+        self.stats[stat] += amount
+        index['stats'][stat] = index['stats'].get(stat, 0) + amount
+
+    def _evict(self, index):
+        entries = index['entries']
+        sizes = {}
+        for entry in entries.values():
+            sizes[entry['sha256']] = entry['size']
+        total = sum(sizes.values())
+        for url in sorted(entries, key=lambda u: entries[u]['last_used']):
+            if total <= self.max_size:
+                break
+            sha256 = entries.pop(url)['sha256']
+            if not [e for e in entries.values() if e['sha256'] == sha256]:
+                path = self._object_path(sha256)
+                if os.path.exists(path):
+                    os.remove(path)
+                total -= sizes[sha256]
+            self._count(index, 'evictions')
+            logger.info("Evicted %s from the artifact cache" % url)
+
+    def usage(self):
+        """
+        :return dict: entries, bytes held and lifetime hit/miss/eviction counts for the cache
+        """
+        with self._index() as index:
+            sizes = dict((e['sha256'], e['size']) for e in index['entries'].values())
+            usage = {'entries': len(index['entries']), 'bytes': sum(sizes.values())}
+            usage.update(index['stats'])
+        return usage
@@ -0,0 +1,246 @@
+import os
+import json
+import hashlib
+import threading
+
+"""
+Incremental checksums computed while an artifact streams through a transfer, so it is never read a second time.
+Checksum files follow the repository convention of the artifact name plus the algorithm e.g. test.tgz.sha256
+
+"""
+
+__all__ = ['ALGORITHMS', 'parse_algorithms', 'checksum_name', 'parse_checksum',
+           'StreamDigest', 'OrderedDigest', 'HashingReader', 'DigestCache']
+
+ALGORITHMS = ('md5', 'sha1', 'sha256')
+
+
+def parse_algorithms(value):
+    """
+    Converts the checksum option from the config into a list of algorithms.
+    True means md5, for compatibility with older configs; a name or list of names selects those algorithms.
+    :param value:
+    :return list:
+    """
+    if value is True:
+        return ['md5']
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    algorithms = [str(a).lower().replace('-', '') for a in value]
+    for algorithm in algorithms:
+        if algorithm not in ALGORITHMS:
+            raise ValueError("Unsupported checksum algorithm %s, expected one of %s" %
+                             (algorithm, ', '.join(ALGORITHMS)))
+    return algorithms
+
+
+def checksum_name(artifact, algorithm):
+    """
+    :return str: name of the checksum file published alongside an artifact
+    """
+    return '%s.%s' % (artifact, algorithm)
+
+
+def parse_checksum(text):
+    """
+    Extracts the digest from a checksum file, which may be the bare digest or 'digest  filename'
+    :param text: str or bytes
+    :return str:
+    """
+    if isinstance(text, bytes):
+        text = text.decode('ascii', 'replace')
+    parts = text.strip().split()
+    return parts[0].lower() if parts else ''
+
+
+class StreamDigest(object):
+    """
+    Computes several digests over data fed to it in order
+    :param list algorithms:
+    """
+    def __init__(self, algorithms):
+        self.algorithms = list(algorithms)
+        self.reset()
+
+    def reset(self):
+        self._hashes = [(a, hashlib.new(a)) for a in self.algorithms]
+        self.length = 0
+
+    def update(self, data):
+        for algorithm, h in self._hashes:
+            h.update(data)
+        self.length += len(data)
+
+    def hexdigests(self):
+        """
+        :return dict: algorithm -> hex digest
+        """
+        return dict((a, h.hexdigest()) for a, h in self._hashes)
+
+
+class OrderedDigest(StreamDigest):
+    """
+    Digest for data arriving out of order, e.g. from parallel range requests.
+    Pieces ahead of the next expected offset are held in memory until the gap is filled; past max_buffered bytes
+    they are dropped and read back from the file (usually still in the page cache) when their turn comes.
+    Ranges already on disk from an earlier attempt are registered with on_disk and read the same way.
+
+    :param list algorithms:
+    :param reader: callable(offset, length) returning bytes from the destination file
+    :param int max_buffered: bytes of out of order data to hold in memory
+    """
+    def __init__(self, algorithms, reader=None, max_buffered=64 * 1024 ** 2):
+        self.reader = reader
+        self.max_buffered = max_buffered
+        self._lock = threading.Lock()
+        StreamDigest.__init__(self, algorithms)
+
+    def reset(self):
+        StreamDigest.reset(self)
+        self._pending = {}
+        self._buffered = 0
+
+    def on_disk(self, offset, length):
+        """
+        Registers a range that is already in the destination file
+        """
+        if length:
+            with self._lock:
+                self._pending[offset] = (length, None)
+                self._advance()
+
+    def feed(self, offset, data):
+        """
+        Adds data that has been written at offset in the destination file
+        """
+        with self._lock:
+            if offset == self.length and not self._pending:
+                self.update(data)
+                return
+            self._pending[offset] = (len(data), data)
+            self._buffered += len(data)
+            self._advance()
+            if self._buffered > self.max_buffered:
+                for pending in sorted(self._pending, reverse=True):
+                    length, held = self._pending[pending]
+                    if held is not None:
+                        self._pending[pending] = (length, None)
+                        self._buffered -= length
+                        if self._buffered <= self.max_buffered // 2:
+                            break
+
+    def _advance(self):
+        while self.length in self._pending:
+            length, data = self._pending.pop(self.length)
+            if data is None:
+                offset = self.length
+                end = offset + length
+                while offset < end:
+                    chunk = self.reader(offset, min(1024 ** 2, end - offset))
+                    if not chunk:
+                        raise IOError("Short read hashing offset %d" % offset)
+                    self.update(chunk)
+                    offset += len(chunk)
+            else:
+                self._buffered -= length
+                self.update(data)
+
+
+class HashingReader(object):
+    """
+    Wraps a file opened for reading, digesting everything read through it
+    :param file fileobj:
+    :param StreamDigest digest:
+    """
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+class DigestCache(object):
+    """
+    Digests of whole local files, kept until the file's size, mtime or inode changes, so that republishing an
+    unchanged artifact does not read it again. Held in memory, and in a json file if path is given.
+    :param str path: json file to persist digests to, e.g. on the agent between builds
+    """
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path) if path else None
+        self.hits = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        if self.path:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._entries = {}
+
+    def lookup(self, filename, algorithms):
+        """
+        :param str filename:
+        :param list algorithms:
+        :return dict: algorithm -> hex digest, None unless all of them are known for the file as it is now
+        """
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry['stamp'] == stamp and all(a in entry['digests'] for a in algorithms):
+                self.hits += 1
+                return dict((a, entry['digests'][a]) for a in algorithms)
+        return None
+
+    def digests(self, filename, algorithms):
+        """
+        :param str filename:
+        :param list algorithms:
+        :return dict: algorithm -> hex digest
+        """
+        digests = self.lookup(filename, algorithms)
+        if digests is not None:
+            return digests
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        digest = StreamDigest(algorithms)
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                digest.update(chunk)
+        digests = digest.hexdigests()
+        self.store(filename, digests, stamp)
+        return digests
+
+    def store(self, filename, digests, stamp=None):
+        """
+        Records digests computed elsewhere, e.g. while the file was uploaded
+        :param str filename:
+        :param dict digests: algorithm -> hex digest
+        :param list stamp: size, mtime_ns and inode the digests were computed for, the file's current ones if None
+        """
+        filename = os.path.abspath(filename)
+        if stamp is None:
+            st = os.stat(filename)
+            stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None or entry['stamp'] != stamp:
+                entry = self._entries[filename] = {'stamp': stamp, 'digests': {}}
+            entry['digests'].update(digests)
+            if self.path:
+                if not os.path.isdir(os.path.dirname(self.path) or '.'):
+                    os.makedirs(os.path.dirname(self.path))
+                tmp = '%s.%d' % (self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(self._entries, f)
+                os.rename(tmp, self.path)
@@ -0,0 +1,378 @@
+import os
+import mmap
+import time
+import zlib
+import shlex
+import struct
+import hashlib
+import logging
+
+"""
+rsync style delta uploads over ssh.
+A small python helper run on the target returns a weak checksum (adler32) and a sha1 for each block of the copy it
+already has. The local artifact is scanned with the same checksum, so matching blocks are found at any offset, and
+only the unmatched bytes are sent together with block references. The helper rebuilds the file beside the target,
+checks its sha256 and renames it into place.
+The scan checks the block at the current offset with zlib first, which keeps unchanged stretches at C speed. Past a
+change it looks for the next block that is still where it was, and only rolls the checksum byte by byte when there is
+none, i.e. when data has been inserted or removed. Before the scan, a sample of offsets spread
+over the file is looked up, so an artifact that shares little with the target's copy (e.g. a recompressed archive)
+is given up on after a few blocks' work rather than a full scan.
+When the target has no copy, python is not available there, or too little would be saved, the caller falls back to a
+full upload.
+
+"""
+
+logger = logging.getLogger('ArtifactTools')
+
+__all__ = ['block_size_for', 'weak_checksum', 'plan_delta', 'DeltaUnavailable', 'delta_put']
+
+# adler32 modulus
+MOD = 65521
+
+# offsets looked up before the scan, and the smallest file, in blocks per sample, worth sampling
+SAMPLES = 32
+SAMPLE_MIN_BLOCKS = 4
+
+SIGNATURE_SCRIPT = r'''
+import sys, zlib, hashlib
+path, size = sys.argv[1], int(sys.argv[2])
+try:
+    f = open(path, 'rb')
+except (IOError, OSError):
+    sys.exit(3)
+out = sys.stdout
+with f:
+    while True:
+        block = f.read(size)
+        if not block:
+            break
+        out.write('%d %s\n' % (zlib.adler32(block), hashlib.sha1(block).hexdigest()))
+'''
+
+PATCH_SCRIPT = r'''
+import os, sys, struct, hashlib
+path, size, expected, tmp = sys.argv[1], int(sys.argv[2]), sys.argv[3], sys.argv[4]
+inp = sys.stdin.buffer
+h = hashlib.sha256()
+chunk = max(size, 1024 ** 2 // size * size)
+
+
+def write(data):
+    out.write(data)
+    h.update(data)
+
+
+try:
+    with open(path, 'rb') as old, open(tmp, 'wb') as out:
+        while True:
+            op = inp.read(1)
+            if op == b'C':
+                index, count = struct.unpack('>QI', inp.read(12))
+                old.seek(index * size)
+                remaining = count * size
+                while remaining > 0:
+                    data = old.read(min(chunk, remaining))
+                    if not data:
+                        break
+                    write(data)
+                    remaining -= len(data)
+            elif op == b'L':
+                length, = struct.unpack('>I', inp.read(4))
+                write(inp.read(length))
+            elif op == b'E':
+                break
+            else:
+                raise IOError('bad delta stream')
+    if h.hexdigest() != expected:
+        raise IOError('sha256 mismatch after patching')
+    os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+    os.rename(tmp, path)
+except (IOError, OSError) as e:
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    sys.stderr.write('%s\n' % e)
+    sys.exit(4)
+sys.stdout.write('ok\n')
+'''
+
+
+class DeltaUnavailable(Exception):
+    """
+    A delta upload is not possible or not worthwhile, the caller should upload the whole file
+    """
+    pass
+
+
+def block_size_for(size):
+    """
+    Picks a block size around the square root of the file size, as rsync does, between 2K and 128K
+    :param int size: bytes
+    :return int:
+    """
+    block = int(size ** 0.5) // 1024 * 1024
+    return max(2048, min(128 * 1024, block))
+
+
+def weak_checksum(data):
+    """
+    The weak checksum of a block, adler32: a is one plus the byte sum and b the sum of the running values of a, both
+    mod 65521, giving b << 16 | a
+    :param bytes data:
+    :return int:
+    """
+    return zlib.adler32(data)
+
+
+class _Scanner(object):
+    """
+    Looks up blocks of data in the target's signature, by checksumming the block at an offset with zlib or by
+    rolling the checksum forward a byte at a time
+    """
+    def __init__(self, data, block_size, signature):
+        self.data = data
+        self.block_size = block_size
+        self.table = {}
+        for index, (weak, strong) in enumerate(signature):
+            self.table.setdefault(weak, {}).setdefault(strong, index)
+
+    def lookup(self, position, length, weak):
+        """
+        :return int: index of the target block holding data[position:position + length], None if there is none
+        """
+        candidates = self.table.get(weak)
+        if candidates:
+            return candidates.get(hashlib.sha1(self.data[position:position + length]).hexdigest())
+        return None
+
+    def at(self, position, length=None):
+        length = length or self.block_size
+        return self.lookup(position, length, zlib.adler32(self.data[position:position + length]))
+
+    def roll(self, position, limit):
+        """
+        Searches forward from position, which does not match itself, for the next offset whose block matches
+        :param int position:
+        :param int limit: last offset to try
+        :return tuple: (offset, index) of the match, or (offset reached, None) if there was none up to limit
+        """
+        data, size, table = self.data, self.block_size, self.table
+        weak = zlib.adler32(data[position:position + size])
+        a, b = weak & 0xffff, weak >> 16
+        # bytes are rolled out of and into the window from one slice, a lot faster to index than an mmap
+        window = data[position:limit + size]
+        for i in range(limit - position):
+            out = window[i]
+            a = (a - out + window[i + size]) % MOD
+            b = (b - size * out + a - 1) % MOD
+            weak = (b << 16) | a
+            if weak in table:
+                index = self.lookup(position + i + 1, size, weak)
+                if index is not None:
+                    return position + i + 1, index
+        return limit, None
+
+    def sample(self, samples):
+        """
+        Looks for a matching block within one block of each of a number of offsets spread over the data.
+        Wherever two blocks' worth of data also appear in the target's copy, one of its blocks starts within a block
+        of the offset, so the share of offsets that match estimates the share of the data the target already has.
+        :param int samples:
+        :return float: fraction of the offsets that found a match
+        """
+        span = len(self.data) - 2 * self.block_size
+        found = 0
+        for k in range(samples):
+            position = span * k // samples
+            if self.at(position) is not None or self.roll(position, position + self.block_size)[1] is not None:
+                found += 1
+        return found / float(samples)
+
+
+def plan_delta(data, block_size, signature, max_literal=None, digest=None, max_seconds=None):
+    """
+    Works out how to build data from the blocks the target already holds
+    :param data: bytes-like, usually an mmap of the local artifact
+    :param int block_size:
+    :param list signature: (weak, sha1) per block of the target's copy
+    :param int max_literal: give up once more than this many bytes would have to be sent, or when a sample of the
+                            data suggests so
+    :param StreamDigest digest: updated with data as it is scanned
+    :param float max_seconds: give up if the scan takes longer than this
+    :return list: ops, ('C', first block, count) to copy target blocks and ('L', offset, length) to send bytes
+    :raises DeltaUnavailable: if max_literal or max_seconds is exceeded
+    """
+    size = len(data)
+    scanner = _Scanner(data, block_size, signature)
+    if max_literal is not None and size >= SAMPLES * SAMPLE_MIN_BLOCKS * block_size:
+        found = scanner.sample(SAMPLES)
+        # generous, since the sample is small: only give up when well short of the savings asked for
+        if found < (1 - max_literal / float(size)) / 2:
+            raise DeltaUnavailable('only %d of %d sampled blocks are on the target' % (round(found * SAMPLES),
+                                                                                       SAMPLES))
+    deadline = time.time() + max_seconds if max_seconds else None
+    ops = []
+    literal_start = 0
+    literal_bytes = 0
+    hashed = 0
+
+    def emit_literal(end):
+        if end > literal_start:
+            ops.append(('L', literal_start, end - literal_start))
+
+    def emit_copy(index):
+        if ops and ops[-1][0] == 'C' and ops[-1][1] + ops[-1][2] == index:
+            ops[-1] = ('C', ops[-1][1], ops[-1][2] + 1)
+        else:
+            ops.append(('C', index, 1))
+
+    position = 0
+    last = size - block_size
+    while position <= last:
+        index = scanner.at(position)
+        if index is None:
+            # roll in steps, so that the literal and time limits are checked as the scan goes
+            limit = min(last, position + 1024 ** 2)
+            if max_literal is not None:
+                limit = min(limit, position + max_literal - literal_bytes + 1)
+            # data rewritten in place leaves the blocks after it where they were, so look for the next of those
+            # first and only roll through every offset when none is found, i.e. when the data has moved
+            reached = position + block_size
+            while reached <= limit and index is None:
+                index = scanner.at(reached)
+                if index is None:
+                    reached += block_size
+            if index is None:
+                reached, index = scanner.roll(position, limit)
+            literal_bytes += reached - position
+            position = reached
+            if max_literal is not None and literal_bytes > max_literal:
+                raise DeltaUnavailable('more than %d bytes differ' % max_literal)
+        if index is not None:
+            emit_literal(position)
+            emit_copy(index)
+            position += block_size
+            literal_start = position
+        elif position == last:
+            # not even the last full window matched, what is left is checked against the target's last block
+            position += 1
+            literal_bytes += 1
+        if deadline is not None and time.time() > deadline:
+            raise DeltaUnavailable('scan took longer than %ss' % max_seconds)
+        if digest is not None and position - hashed >= 1024 ** 2:
+            digest.update(data[hashed:position])
+            hashed = position
+    tail = size - position
+    if tail > 0:
+        index = scanner.at(position, tail)
+        if index is not None and index == len(signature) - 1:
+            emit_literal(position)
+            emit_copy(index)
+            literal_start = size
+        else:
+            literal_bytes += tail
+            if max_literal is not None and literal_bytes > max_literal:
+                raise DeltaUnavailable('more than %d bytes differ' % max_literal)
+    emit_literal(size)
+    if digest is not None:
+        for start in range(hashed, size, 1024 ** 2):
+            digest.update(data[start:start + 1024 ** 2])
+    return ops
+
+
+def _remote_python(python, script, *args):
+    return '%s -c %s %s' % (python, shlex.quote(script), ' '.join(shlex.quote(str(a)) for a in args))
+
+
+def _exec(transport, command, timeout):
+    chan = transport.open_session(timeout=timeout)
+    chan.settimeout(timeout)
+    chan.exec_command(command)
+    return chan
+
+
+def remote_signature(transport, remote_path, block_size, python='python3', timeout=300):
+    """
+    :return list: (weak, sha1) for each block of the target's copy
+    :raises DeltaUnavailable: if the target has no copy or cannot run the helper
+    """
+    chan = _exec(transport, _remote_python(python, SIGNATURE_SCRIPT, remote_path, block_size), timeout)
+    with chan.makefile('r') as f:
+        output = f.read()
+    status = chan.recv_exit_status()
+    chan.close()
+    if status == 3:
+        raise DeltaUnavailable('no existing copy of %s on the target' % remote_path)
+    if status != 0:
+        raise DeltaUnavailable('signature helper failed with status %d' % status)
+    signature = []
+    for line in output.decode().splitlines():
+        weak, strong = line.split()
+        signature.append((int(weak), strong))
+    return signature
+
+
+def delta_put(transport, local_path, remote_path, block_size=None, min_savings=0.5, python='python3', digest=None,
+              timeout=300, scan_timeout=60):
+    """
+    Updates remote_path on the target to match local_path, sending only blocks the target does not have
+    :param paramiko.Transport transport: connection to the target
+    :param str local_path:
+    :param str remote_path:
+    :param int block_size: defaults to block_size_for the local file
+    :param float min_savings: fraction of the file that must already be on the target
+    :param python: python executable on the target
+    :param StreamDigest digest: receives the local file's data for checksum files, reset if DeltaUnavailable is raised
+    :param float scan_timeout: seconds the local scan may take before a full upload is used instead
+    :return dict: size, literal bytes sent, blocks copied and bytes sent over the wire
+    :raises DeltaUnavailable: when a full upload should be used instead; the target's copy is left as it was
+    """
+    size = os.path.getsize(local_path)
+    if size == 0:
+        raise DeltaUnavailable('empty artifact')
+    block_size = block_size or block_size_for(size)
+    signature = remote_signature(transport, remote_path, block_size, python, timeout)
+    with open(local_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            try:
+                ops = plan_delta(data, block_size, signature, int(size * (1 - min_savings)), digest, scan_timeout)
+            except DeltaUnavailable:
+                if digest is not None:
+                    digest.reset()
+                raise
+            sha256 = hashlib.sha256(data).hexdigest()
+            tmp = '%s.delta-%d' % (remote_path, os.getpid())
+            chan = _exec(transport, _remote_python(python, PATCH_SCRIPT, remote_path, block_size, sha256, tmp),
+                         timeout)
+            stats = {'size': size, 'literal': 0, 'copied_blocks': 0, 'sent': 0}
+            try:
+                for op in ops:
+                    if op[0] == 'C':
+                        message = b'C' + struct.pack('>QI', op[1], op[2])
+                        chan.sendall(message)
+                        stats['sent'] += len(message)
+                        stats['copied_blocks'] += op[2]
+                    else:
+                        offset, length = op[1], op[2]
+                        for start in range(offset, offset + length, 1024 ** 2):
+                            chunk = data[start:min(start + 1024 ** 2, offset + length)]
+                            chan.sendall(b'L' + struct.pack('>I', len(chunk)) + chunk)
+                            stats['sent'] += len(chunk) + 5
+                        stats['literal'] += length
+                chan.sendall(b'E')
+                chan.shutdown_write()
+                with chan.makefile_stderr('r') as f:
+                    error = f.read().decode().strip()
+                status = chan.recv_exit_status()
+            finally:
+                chan.close()
+        finally:
+            data.close()
+    if status != 0:
+        if digest is not None:
+            digest.reset()
+        raise DeltaUnavailable('patching %s failed with status %d: %s' % (remote_path, status, error))
+    logger.info("Delta upload of %s: %d of %d bytes sent, %d blocks reused" %
+                (local_path, stats['literal'], size, stats['copied_blocks']))
+    return stats
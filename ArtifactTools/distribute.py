@@ -0,0 +1,248 @@
+import os
+import copy
+import time
+import shlex
+import logging
+import posixpath
+import threading
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from JenkinsTools import lazy_import, ContextExecutor
+from SSHTools import get_pool
+from ArtifactTools.checksum import DigestCache, checksum_name
+
+paramiko = lazy_import('paramiko')
+
+"""
+Fan-out distribution of one artifact to many hosts over ssh.
+The agent uploads to the first few seed hosts only. Every host holding a verified copy then serves as a source for
+the rest: the copy runs on the receiving host and pulls from a finished peer, so the agent sends the artifact once per
+seed however many hosts there are, and the number of sources doubles (or more, with fan_out) every round.
+Each hop, agent uploads included, lands in a temporary file beside the target, its sha256 is checked against the
+agent's and only then is it renamed into place, so a host only becomes a source once its copy is known good. A failed
+copy is retried from another peer, then uploaded from the agent.
+
+"""
+
+logger = logging.getLogger('ArtifactTools')
+
+__all__ = ['PEER_COPY', 'HopResult', 'Distribution', 'parse_host']
+
+# Run on the receiving host; the hosts need ssh access to each other, e.g. through forward_agent
+PEER_COPY = 'scp -q -o BatchMode=yes -o StrictHostKeyChecking=accept-new -P {source_port} ' \
+            '{user}@{source}:{path} {tmp}'
+
+AGENT = 'agent'
+
+
+def parse_host(host, default_port=22):
+    """
+    :param str host: host or host:port
+    :return tuple: host, port
+    """
+    if ':' in host:
+        name, port = host.rsplit(':', 1)
+        return name, int(port)
+    return host, int(default_port)
+
+
+class HopResult(object):
+    """
+    How one host received the artifact
+    """
+    def __init__(self, host):
+        self.host = host
+        self.source = None
+        self.ok = False
+        self.error = None
+        self.attempts = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return '<HopResult %s from %s ok=%s>' % (self.host, self.source, self.ok)
+
+
+class Distribution(object):
+    """
+    Distributes the artifact of an ssh ArtifactUploader to many hosts.
+
+    :param ArtifactUploader uploader: supplies the artifact, target_path, user, identity file and default port
+    :param list hosts: host or host:port for each target
+    :param int seeds: hosts uploaded to directly from the agent
+    :param int fan_out: copies a host serves to peers at once
+    :param int max_in_flight: uploads and copies running at once
+    :param str peer_copy: command run on the receiving host, formatted with source, source_port, user, path and tmp
+    :param int retries: peer copies tried per host before uploading it from the agent, 0 to upload every host
+    :param bool forward_agent: forward the local ssh agent to the receiving host for the peer copy
+    """
+    def __init__(self, uploader, hosts, seeds=2, fan_out=4, max_in_flight=16, peer_copy=PEER_COPY, retries=2,
+                 forward_agent=False):
+        self.uploader = uploader
+        self.hosts = [parse_host(h, uploader.target_port) for h in hosts]
+        self.seeds = max(1, int(seeds))
+        self.fan_out = max(1, int(fan_out))
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.peer_copy = peer_copy
+        self.retries = max(0, int(retries))
+        self.forward_agent = forward_agent
+        self.path = uploader.target_path
+        self.stats = {'agent_uploads': 0, 'peer_copies': 0, 'rejected': 0}
+        self.digests = {}
+        self._lock = threading.Lock()
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _name(self, host):
+        return '%s:%s' % host
+
+    def _run(self, host, command, timeout=3600):
+        """
+        :return tuple: exit status, stdout, stderr
+        """
+        chan = get_pool().transport(host[0], host[1], self.uploader.user,
+                                    self.uploader.identity_file).open_session(timeout=60)
+        try:
+            if self.forward_agent:
+                paramiko.agent.AgentRequestHandler(chan)
+            chan.settimeout(timeout)
+            chan.exec_command(command)
+            with chan.makefile('r') as out, chan.makefile_stderr('r') as err:
+                stdout, stderr = out.read().decode(), err.read().decode()
+            return chan.recv_exit_status(), stdout, stderr
+        finally:
+            chan.close()
+
+    def _verify(self, host, path):
+        status, out, err = self._run(host, 'sha256sum %s' % shlex.quote(path))
+        found = out.split()[0] if status == 0 and out.strip() else None
+        if found != self.digests['sha256']:
+            self._count('rejected')
+            raise IOError('sha256 mismatch on %s, expected %s got %s' %
+                          (self._name(host), self.digests['sha256'], found or err.strip()))
+
+    def _publish(self, host, tmp):
+        commands = ['mv -f %s %s' % (shlex.quote(tmp), shlex.quote(self.path))]
+        for algorithm in self.uploader.algorithms:
+            commands.append('printf %%s %s > %s' % (self.digests[algorithm],
+                                                    shlex.quote(checksum_name(self.path, algorithm))))
+        status, out, err = self._run(host, ' && '.join(commands))
+        if status != 0:
+            raise IOError('publishing on %s failed: %s' % (self._name(host), err.strip()))
+
+    def _discard(self, host, paths):
+        try:
+            self._run(host, 'rm -f %s' % ' '.join(shlex.quote(p) for p in paths))
+        except Exception as e:
+            logger.debug("Could not remove %s on %s: %s" % (', '.join(paths), self._name(host), e))
+
+    def _from_agent(self, host):
+        tmp = '%s.agent-%d' % (self.path, os.getpid())
+        uploader = copy.copy(self.uploader)
+        uploader.target, uploader.target_port = host
+        uploader.target_path = tmp
+        # put_to_server leaves checksum files beside the staged copy; _publish writes the real ones
+        staged = [tmp] + [checksum_name(tmp, algorithm) for algorithm in uploader.algorithms]
+        try:
+            if uploader.delta:
+                # gives the delta upload the host's current copy to patch, if it has one
+                self._run(host, 'cp -f %s %s 2>/dev/null || true' % (shlex.quote(self.path), shlex.quote(tmp)))
+            uploader.put_to_server()
+            self._verify(host, tmp)
+            self._publish(host, tmp)
+        except Exception:
+            self._discard(host, staged)
+            raise
+        self._discard(host, staged[1:])
+        self._count('agent_uploads')
+
+    def _from_peer(self, host, source):
+        tmp = '%s.peer-%d' % (self.path, os.getpid())
+        command = self.peer_copy.format(source=shlex.quote(source[0]), source_port=source[1],
+                                        user=shlex.quote(self.uploader.user), path=shlex.quote(self.path),
+                                        tmp=shlex.quote(tmp))
+        directory = posixpath.dirname(self.path)
+        if directory:
+            command = 'mkdir -p %s && %s' % (shlex.quote(directory), command)
+        try:
+            status, out, err = self._run(host, command)
+            if status != 0:
+                raise IOError('copy from %s failed with status %d: %s' % (self._name(source), status, err.strip()))
+            self._verify(host, tmp)
+            self._publish(host, tmp)
+        except Exception:
+            self._discard(host, [tmp])
+            raise
+        self._count('peer_copies')
+
+    def _transfer(self, result, host, source):
+        start = time.time()
+        result.attempts += 1
+        result.source = AGENT if source is None else self._name(source)
+        try:
+            if source is None:
+                self._from_agent(host)
+            else:
+                self._from_peer(host, source)
+            result.ok, result.error = True, None
+            logger.info("%s received %s from %s in %.1fs" % (self._name(host), self.path, result.source,
+                                                           time.time() - start))
+        except Exception as e:
+            result.ok, result.error = False, str(e)
+            logger.warning("%s could not get %s from %s: %s" % (self._name(host), self.path, result.source, e))
+        result.elapsed += time.time() - start
+        return result
+
+    def run(self):
+        """
+        :return list: HopResult per host, in the order given
+        """
+        self.digests = DigestCache().digests(self.uploader.artifact,
+                                             sorted(set(self.uploader.algorithms) | {'sha256'}))
+        results = dict((host, HopResult(self._name(host))) for host in self.hosts)
+        pending = deque(self.hosts)
+        sources = {}
+        tried = dict((host, set()) for host in self.hosts)
+        running = {}
+        start = time.time()
+
+        with ContextExecutor(max_workers=self.max_in_flight) as pool:
+            def submit(host, source):
+                if source is not None:
+                    sources[source] += 1
+                    tried[host].add(source)
+                running[pool.submit(self._transfer, results[host], host, source)] = (host, source)
+
+            while pending or running:
+                seeding = sum(1 for h, s in running.values() if s is None)
+                while pending and len(running) < self.max_in_flight:
+                    host = pending[0]
+                    free = [s for s, busy in sources.items() if busy < self.fan_out and s not in tried[host]]
+                    if free and len(tried[host]) < self.retries:
+                        pending.popleft()
+                        submit(host, min(free, key=lambda s: sources[s]))
+                    elif (self.stats['agent_uploads'] + seeding < self.seeds or len(tried[host]) >= self.retries or
+                          not running):
+                        # still seeding, out of peer attempts, or nothing running that could free up a source
+                        pending.popleft()
+                        submit(host, None)
+                        seeding += 1
+                    else:
+                        break
+                done, not_done = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    host, source = running.pop(future)
+                    if source is not None:
+                        sources[source] -= 1
+                    result = future.result()
+                    if result.ok:
+                        sources[host] = 0
+                    elif source is not None:
+                        pending.appendleft(host)
+        ordered = [results[host] for host in self.hosts]
+        size = os.path.getsize(self.uploader.artifact)
+        logger.info("Distributed %s to %d of %d hosts in %.1fs: %d from the agent (%d bytes sent), %d from peers" %
+                    (self.uploader.artifact, len([r for r in ordered if r.ok]), len(ordered), time.time() - start,
+                     self.stats['agent_uploads'], self.stats['agent_uploads'] * size, self.stats['peer_copies']))
+        return ordered
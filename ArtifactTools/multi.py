@@ -0,0 +1,423 @@
+import os
+import json
+import time
+import logging
+import io
+from collections import deque
+from JenkinsTools import lazy_import
+from JenkinsTools.metrics import record_curl
+from ArtifactTools.checksum import StreamDigest, HashingReader
+
+pycurl = lazy_import('pycurl')
+
+"""
+Runs many HTTP transfers through a single pycurl.CurlMulti loop.
+Easy handles are recycled and share the multi handle's connection cache, plus a CurlShare for DNS and TLS sessions,
+so a release of many artifacts from the same repository pays for one connection per host rather than one per file.
+A download resumes from its .part file only while <artifact>.part.state records the same url, size and validator
+(ETag or Last-Modified), and asks with If-Range, so a changed artifact is downloaded again from the start.
+
+"""
+
+logger = logging.getLogger('ArtifactTools')
+
+__all__ = ['TransferQueue', 'TransferResult', 'keep_connections', 'connection_share']
+
+_connection_share = None
+
+
+def keep_connections():
+    """
+    Shares open connections, DNS and TLS sessions between every transfer in the process from now on, for long-running
+    processes such as the deploy daemon, so later jobs to the same repository skip the connect and TLS handshake
+    :return pycurl.CurlShare:
+    """
+    global _connection_share
+    if _connection_share is None:
+        share = pycurl.CurlShare()
+        for data in (pycurl.LOCK_DATA_CONNECT, pycurl.LOCK_DATA_DNS, pycurl.LOCK_DATA_SSL_SESSION):
+            share.setopt(pycurl.SH_SHARE, data)
+        _connection_share = share
+    return _connection_share
+
+
+def connection_share():
+    """
+    :return pycurl.CurlShare: the process wide share set up by keep_connections, or None
+    """
+    return _connection_share
+
+
+class TransferResult(object):
+    """
+    Outcome of one transfer
+    """
+    DOWNLOAD = 'download'
+    UPLOAD = 'upload'
+
+    def __init__(self, kind, url, path):
+        self.kind = kind
+        self.url = url
+        self.path = path
+        self.ok = False
+        self.error = None
+        self.status = None
+        self.bytes = 0
+        self.attempts = 0
+        self.elapsed = 0.0
+        self.digests = {}
+
+    def __repr__(self):
+        return '<TransferResult %s %s ok=%s>' % (self.kind, self.url, self.ok)
+
+
+class _Transfer(object):
+    def __init__(self, result, auth=None, headers=None, algorithms=()):
+        self.result = result
+        self.auth = auth
+        self.headers = headers or []
+        self.digest = StreamDigest(algorithms)
+        self.not_before = 0.0
+        self.started = None
+        self.file = None
+        self.status = None
+
+    def check(self):
+        """
+        :return str: why a transfer the server answered successfully is still not complete, or None
+        """
+        return None
+
+    def header(self, line):
+        line = line.decode('iso-8859-1')
+        if line.startswith('HTTP/'):
+            self.status = int(line.split()[1])
+
+
+class _Download(_Transfer):
+    def __init__(self, url, path, auth=None, headers=None, algorithms=()):
+        _Transfer.__init__(self, TransferResult(TransferResult.DOWNLOAD, url, path), auth, headers, algorithms)
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.state'
+        self.offset = 0
+        self.validator = None
+        self.size = None
+        self._response = {}
+
+    def header(self, line):
+        _Transfer.header(self, line)
+        name, _, value = line.decode('iso-8859-1').partition(':')
+        if name.startswith('HTTP/'):
+            # a new response, e.g. after a redirect
+            self._response = {}
+        elif value:
+            self._response[name.strip().lower()] = value.strip()
+
+    def _load_state(self):
+        """
+        :return int: bytes of the .part file that can be kept, 0 unless its state matches and it is incomplete
+        """
+        if not os.path.exists(self.part_path):
+            return 0
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = {}
+        offset = os.path.getsize(self.part_path)
+        if state.get('url') != self.result.url or not state.get('validator') or not state.get('size') or \
+                offset >= state['size']:
+            if offset:
+                logger.info("Discarding partial download of %s, it cannot be resumed" % self.result.path)
+            return 0
+        self.validator, self.size = state['validator'], state['size']
+        return offset
+
+    def _start_response(self):
+        """
+        Checks the first data of a response against the resume request and records what the .part file holds
+        """
+        if self.status == 200 and self.offset:
+            # the server ignored the range, or If-Range found the artifact changed: start the file again
+            self.file.seek(0)
+            self.file.truncate()
+            self.offset = 0
+            self.digest.reset()
+        headers = self._response
+        total = headers.get('content-range', '').rpartition('/')[2]
+        size = int(total) if total.isdigit() else (int(headers['content-length']) if self.status == 200 and
+                                                   headers.get('content-length', '').isdigit() else None)
+        self.validator = headers.get('etag') or headers.get('last-modified')
+        self.size = size
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'url': self.result.url, 'size': size, 'validator': self.validator}, f)
+        os.rename(tmp, self.state_path)
+        self._response = None
+
+    def write(self, data):
+        if self.status is not None and self.status >= 400:
+            return
+        if self._response is not None:
+            self._start_response()
+        self.file.write(data)
+        self.digest.update(data)
+        self.result.bytes += len(data)
+
+    def check(self):
+        if self.size is not None and self.file.tell() != self.size:
+            return 'received %d of %d bytes' % (self.file.tell(), self.size)
+        return None
+
+    def prepare(self, c):
+        self.offset = self._load_state()
+        self._response = {}
+        if not self.offset:
+            self.digest.reset()
+        elif self.digest.length != self.offset:
+            # left over from an earlier run, bring the digest up to date with what is already on disk
+            self.digest.reset()
+            with open(self.part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                    self.digest.update(chunk)
+        self.file = open(self.part_path, 'ab' if self.offset else 'wb')
+        c.setopt(pycurl.URL, self.result.url)
+        c.setopt(pycurl.WRITEFUNCTION, self.write)
+        if self.offset:
+            # RANGE rather than RESUME_FROM, which fails the transfer instead of taking a full 200 reply
+            c.setopt(pycurl.RANGE, '%d-' % self.offset)
+            c.setopt(pycurl.HTTPHEADER, list(self.headers) + ['If-Range: %s' % self.validator])
+
+    def finish(self, ok):
+        self.file.close()
+        if ok:
+            os.rename(self.part_path, self.result.path)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            self.result.digests = self.digest.hexdigests()
+
+
+class _RangeReader(object):
+    """
+    Reads length bytes of a file from offset
+    """
+    def __init__(self, path, offset, length):
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class _Upload(_Transfer):
+    def __init__(self, url, path, auth=None, headers=None, algorithms=(), data=None, offset=0, length=None):
+        _Transfer.__init__(self, TransferResult(TransferResult.UPLOAD, url, path), auth, headers, algorithms)
+        self.data = data
+        self.offset = offset
+        self.length = length
+
+    def prepare(self, c):
+        if self.data is not None:
+            source, size = io.BytesIO(self.data), len(self.data)
+        elif self.length is not None:
+            source, size = _RangeReader(self.result.path, self.offset, self.length), self.length
+        else:
+            source, size = open(self.result.path, 'rb'), os.path.getsize(self.result.path)
+        self.digest.reset()
+        self.file = HashingReader(source, self.digest)
+        c.setopt(pycurl.URL, self.result.url)
+        c.setopt(pycurl.UPLOAD, 1)
+        c.setopt(pycurl.READFUNCTION, self.file.read)
+        c.setopt(pycurl.INFILESIZE_LARGE, size)
+        c.setopt(pycurl.WRITEFUNCTION, lambda data: None)
+
+    def finish(self, ok):
+        if ok:
+            self.result.bytes = self.digest.length
+            self.result.digests = self.digest.hexdigests()
+        self.file.close()
+
+
+class TransferQueue(object):
+    """
+    Queues downloads and uploads and runs them concurrently on one CurlMulti handle.
+    Failed transfers are retried with an exponential backoff; interrupted downloads resume from their .part file
+    while the remote artifact is unchanged.
+
+    :param int max_concurrent: transfers in flight at once
+    :param int max_host_connections: connections kept open per host
+    :param int retries: attempts per transfer
+    :param float backoff: initial delay between attempts in seconds, doubled after each failure
+    :param int low_speed_time: abort a transfer running under 1KB/s for this many seconds
+    """
+    def __init__(self, max_concurrent=8, max_host_connections=4, retries=3, backoff=1.0, low_speed_time=60,
+                 connect_timeout=30):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_host_connections = max(1, int(max_host_connections))
+        self.retries = max(1, int(retries))
+        self.backoff = backoff
+        self.low_speed_time = low_speed_time
+        self.connect_timeout = connect_timeout
+        self._queue = deque()
+        self._results = []
+
+    def add_download(self, url, path, auth=None, headers=None, algorithms=()):
+        """
+        :param str url: source url
+        :param str path: local destination
+        :param tuple auth: optional (username, password) for basic auth
+        :param list headers: extra request headers as 'Name: value' strings
+        :param list algorithms: checksums to compute while downloading, returned in the result's digests
+        :return TransferResult: filled in once run() completes
+        """
+        transfer = _Download(url, path, auth, headers, algorithms)
+        self._queue.append(transfer)
+        self._results.append(transfer.result)
+        return transfer.result
+
+    def add_upload(self, url, path, auth=None, headers=None, algorithms=(), data=None, offset=0, length=None):
+        """
+        Queues an HTTP PUT of a local file, or of data if given
+        :param list algorithms: checksums to compute while uploading, returned in the result's digests
+        :param int offset: with length, send only this part of the file, e.g. for a ranged PUT
+        :param int length:
+        :return TransferResult: filled in once run() completes
+        """
+        transfer = _Upload(url, path, auth, headers, algorithms, data, offset, length)
+        self._queue.append(transfer)
+        self._results.append(transfer.result)
+        return transfer.result
+
+    def _setup(self, c, transfer):
+        c.reset()
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.MAXREDIRS, 3)
+        c.setopt(pycurl.NOSIGNAL, 1)
+        c.setopt(pycurl.CONNECTTIMEOUT, self.connect_timeout)
+        c.setopt(pycurl.LOW_SPEED_LIMIT, 1024)
+        c.setopt(pycurl.LOW_SPEED_TIME, self.low_speed_time)
+        c.setopt(pycurl.HEADERFUNCTION, transfer.header)
+        if transfer.auth:
+            c.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+            c.setopt(pycurl.USERPWD, "%s:%s" % transfer.auth)
+        if transfer.headers:
+            c.setopt(pycurl.HTTPHEADER, transfer.headers)
+        transfer.status = None
+        transfer.prepare(c)
+        c.transfer = transfer
+
+    def _complete(self, c, error=None):
+        transfer = c.transfer
+        result = transfer.result
+        result.attempts += 1
+        result.status = transfer.status
+        if error is None and (transfer.status is None or transfer.status >= 400):
+            error = 'HTTP status %s' % transfer.status
+        if error is None:
+            error = transfer.check()
+        record_curl('http.transfer', c, result.url, error is None, kind='queued_%s' % result.kind)
+        transfer.finish(error is None)
+        if error is None:
+            result.ok = True
+            result.error = None
+            result.elapsed = time.time() - transfer.started
+            logger.info("%s of %s complete (%d bytes in %.2fs)" %
+                        (result.kind.capitalize(), result.url, result.bytes, result.elapsed))
+            return
+        result.error = error
+        if result.attempts < self.retries:
+            delay = min(self.backoff * 2 ** (result.attempts - 1), 30)
+            logger.warning("%s of %s failed (attempt %d/%d), retrying in %.1fs: %s" %
+                           (result.kind.capitalize(), result.url, result.attempts, self.retries, delay, error))
+            transfer.not_before = time.time() + delay
+            self._queue.append(transfer)
+        else:
+            result.elapsed = time.time() - transfer.started
+            logger.error("%s of %s failed after %d attempts: %s" %
+                         (result.kind.capitalize(), result.url, result.attempts, error))
+
+    def _next_ready(self):
+        now = time.time()
+        for i in range(len(self._queue)):
+            if self._queue[i].not_before <= now:
+                transfer = self._queue[i]
+                del self._queue[i]
+                return transfer
+        return None
+
+    def run(self):
+        """
+        Runs every queued transfer to completion
+        :return list: TransferResult for each queued transfer, in the order they were added
+        """
+        multi = pycurl.CurlMulti()
+        multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, self.max_host_connections)
+        multi.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, self.max_concurrent)
+        self._share = connection_share()
+        if self._share is None:
+            self._share = pycurl.CurlShare()
+            self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+            self._share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        free = []
+        handles = []
+        active = 0
+        try:
+            while self._queue or active:
+                while active < self.max_concurrent:
+                    transfer = self._next_ready()
+                    if transfer is None:
+                        break
+                    if free:
+                        c = free.pop()
+                    else:
+                        c = pycurl.Curl()
+                        c.setopt(pycurl.SHARE, self._share)
+                        handles.append(c)
+                    if transfer.started is None:
+                        transfer.started = time.time()
+                    try:
+                        self._setup(c, transfer)
+                    except (IOError, OSError) as e:
+                        transfer.result.error = str(e)
+                        logger.error("Cannot start %s of %s: %s" % (transfer.result.kind, transfer.result.url, e))
+                        free.append(c)
+                        continue
+                    multi.add_handle(c)
+                    active += 1
+                while True:
+                    ret, running = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    remaining, succeeded, failed = multi.info_read()
+                    for c in succeeded:
+                        multi.remove_handle(c)
+                        active -= 1
+                        self._complete(c)
+                        free.append(c)
+                    for c, errno, message in failed:
+                        multi.remove_handle(c)
+                        active -= 1
+                        self._complete(c, message)
+                        free.append(c)
+                    if not remaining:
+                        break
+                if active:
+                    multi.select(1.0)
+                elif self._queue:
+                    time.sleep(max(0.0, min(t.not_before for t in self._queue) - time.time()))
+        finally:
+            for c in handles:
+                c.close()
+            multi.close()
+            if self._share is not connection_share():
+                self._share.close()
+        return list(self._results)
@@ -0,0 +1,175 @@
+import io
+import uuid
+import logging
+from JenkinsTools import lazy_import
+from JenkinsTools.metrics import record_curl
+from ArtifactTools.segmented import _Response
+from ArtifactTools.multi import TransferQueue, connection_share
+from ArtifactTools.checksum import checksum_name, parse_checksum
+
+pycurl = lazy_import('pycurl')
+
+"""
+Publishing to Artifactory and Nexus without sending more than the repository needs.
+Checksum deploy: Artifactory is sent a PUT carrying X-Checksum-Deploy and the artifact's digests but no body, and
+answers 201 when it already stores that content (it is linked to the target path) or 404 when the body is needed.
+Nexus has no equivalent, so the .sha1 it serves next to the target is compared instead.
+Chunked upload: large artifacts are sent as ranged PUTs (Content-Range) in parallel over a TransferQueue. Neither
+Artifactory nor Nexus honour ranges on a plain PUT, so this is for WebDAV servers that do, such as Apache mod_dav.
+The chunks go to a scratch url beside the target, which is moved into place (WebDAV MOVE) once all of them are
+stored, so the target never holds part of the artifact. The last chunk is sent first: a server that honoured the
+range reports the full size afterwards, one that did not reports the chunk's, and the scratch file is deleted and
+the artifact sent in a single PUT instead.
+
+"""
+
+logger = logging.getLogger('ArtifactTools')
+
+__all__ = ['CHECKSUM_HEADERS', 'RepoError', 'checksum_headers', 'request', 'checksum_deploy', 'chunked_put']
+
+# Headers Artifactory reads the expected digests of a deployed artifact from
+CHECKSUM_HEADERS = {'md5': 'X-Checksum-Md5', 'sha1': 'X-Checksum-Sha1', 'sha256': 'X-Checksum-Sha256'}
+
+
+class RepoError(Exception):
+    pass
+
+
+def checksum_headers(digests):
+    """
+    :param dict digests: algorithm -> hex digest
+    :return list: X-Checksum-* request headers
+    """
+    return ['%s: %s' % (CHECKSUM_HEADERS[a], v) for a, v in sorted(digests.items()) if a in CHECKSUM_HEADERS]
+
+
+def request(url, method='GET', auth=None, headers=None, data=None, connect_timeout=30):
+    """
+    Makes a single request
+    :param str url:
+    :param str method: GET, HEAD, PUT, or a bodiless method such as DELETE or MOVE
+    :param tuple auth: optional (username, password) for basic auth
+    :param list headers: extra request headers as 'Name: value' strings
+    :param bytes data: body of a PUT
+    :return tuple: status, response headers with lower case names, body
+    """
+    response = _Response()
+    body = io.BytesIO()
+    c = pycurl.Curl()
+    try:
+        if connection_share() is not None:
+            c.setopt(pycurl.SHARE, connection_share())
+        c.setopt(pycurl.URL, url)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.MAXREDIRS, 3)
+        c.setopt(pycurl.NOSIGNAL, 1)
+        c.setopt(pycurl.CONNECTTIMEOUT, connect_timeout)
+        if method == 'HEAD':
+            c.setopt(pycurl.NOBODY, 1)
+        elif method == 'PUT':
+            data = data or b''
+            c.setopt(pycurl.UPLOAD, 1)
+            c.setopt(pycurl.READFUNCTION, io.BytesIO(data).read)
+            c.setopt(pycurl.INFILESIZE_LARGE, len(data))
+        elif method != 'GET':
+            c.setopt(pycurl.CUSTOMREQUEST, method)
+        c.setopt(pycurl.HEADERFUNCTION, response.header)
+        c.setopt(pycurl.WRITEFUNCTION, body.write)
+        if auth:
+            c.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+            c.setopt(pycurl.USERPWD, "%s:%s" % auth)
+        if headers:
+            c.setopt(pycurl.HTTPHEADER, headers)
+        c.perform()
+    finally:
+        record_curl('http.transfer', c, url, kind=method.lower())
+        c.close()
+    return response.status, response.headers, body.getvalue()
+
+
+def checksum_deploy(url, digests, auth=None, headers=None, repository='artifactory'):
+    """
+    Publishes url from content the repository already holds, without sending it
+    :param str url: target of the upload
+    :param dict digests: the artifact's digests, sha1 is needed and sha256 is sent too when present
+    :param tuple auth: optional (username, password) for basic auth
+    :param list headers: extra request headers, e.g. the api key
+    :param str repository: artifactory or nexus
+    :return bool: True if the repository now has the artifact at url, False if the body has to be sent
+    :raises RepoError: if the repository refuses the request
+    """
+    if 'sha1' not in digests:
+        return False
+    headers = list(headers or [])
+    if repository == 'nexus':
+        status, response, body = request(checksum_name(url, 'sha1'), 'GET', auth, headers)
+        return status == 200 and parse_checksum(body) == digests['sha1']
+    headers.append('X-Checksum-Deploy: true')
+    headers.extend(h for h in checksum_headers(digests) if h not in headers)
+    status, response, body = request(url, 'PUT', auth, headers)
+    if status in (200, 201):
+        return True
+    if status == 404:
+        return False
+    raise RepoError("Checksum deploy to %s refused with HTTP status %s" % (url, status))
+
+
+def chunked_put(url, path, size, chunk_size, connections=4, auth=None, headers=None, retries=3, backoff=1.0):
+    """
+    Uploads path as parallel ranged PUTs of chunk_size bytes to a scratch url beside url, then moves it to url
+    :param str url:
+    :param str path: local artifact
+    :param int size: bytes in the artifact
+    :param int chunk_size:
+    :param int connections: chunks in flight at once
+    :param tuple auth: optional (username, password) for basic auth
+    :param list headers: extra request headers
+    :param int retries: attempts per chunk
+    :param float backoff: initial delay between attempts in seconds
+    :return bool: False if the server does not accept ranged PUTs or MOVE; url is untouched
+    :raises RepoError: if a chunk fails once the server has accepted ranges; url is untouched
+    """
+    headers = list(headers or [])
+    scratch = '%s.chunks-%s' % (url, uuid.uuid4().hex[:12])
+    chunks = [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+
+    def add(queue, offset, length):
+        return queue.add_upload(scratch, path, auth, headers + ['Content-Range: bytes %d-%d/%d' %
+                                                                (offset, offset + length - 1, size)],
+                                offset=offset, length=length)
+
+    def stored_size():
+        status, response, body = request(scratch, 'HEAD', auth, headers)
+        return int(response.get('content-length', -1)) if status == 200 else None
+
+    def discard():
+        try:
+            request(scratch, 'DELETE', auth, headers)
+        except pycurl.error as e:
+            logger.warning("Cannot remove %s: %s" % (scratch, e))
+
+    probe = TransferQueue(1, 1, retries, backoff)
+    result = add(probe, *chunks.pop())
+    probe.run()
+    if not result.ok or stored_size() != size:
+        discard()
+        logger.info("%s does not accept ranged PUTs (%s), sending it whole" % (url, result.error or 'range ignored'))
+        return False
+    queue = TransferQueue(connections, connections, retries, backoff)
+    results = [add(queue, offset, length) for offset, length in chunks]
+    queue.run()
+    failed = [r for r in results if not r.ok]
+    if failed:
+        discard()
+        raise RepoError("%d of %d chunks of %s failed, first error: %s" %
+                        (len(failed), len(results) + 1, url, failed[0].error))
+    if stored_size() != size:
+        discard()
+        raise RepoError("%s holds a different size to the %d bytes sent" % (scratch, size))
+    status, response, body = request(scratch, 'MOVE', auth, headers + ['Destination: %s' % url, 'Overwrite: T'])
+    if status not in (200, 201, 204):
+        discard()
+        logger.info("%s does not accept MOVE (HTTP status %s), sending it whole" % (url, status))
+        return False
+    logger.info("Uploaded %s to %s in %d chunks over %d connections" % (path, url, len(results) + 1, connections))
+    return True
@@ -0,0 +1,150 @@
+import os
+import hmac
+import hashlib
+import datetime
+from urllib.parse import urlparse, quote, unquote, parse_qsl
+from xml.etree import ElementTree
+from ArtifactTools.segmented import parse_size
+from ArtifactTools.transport import HttpTransport, Stream, TransportError, _StreamReader
+
+"""
+S3-compatible object stores (AWS S3, MinIO, Ceph RGW) over path style urls, signed with Signature Version 4 without
+an SDK. s3://bucket/key is sent to <endpoint>/bucket/key. Objects up to part_size go in a single PUT, from the local
+file with sendfile where possible; larger objects and streams of unknown size become a multipart upload with one
+part held in memory at a time. Bodies are sent as UNSIGNED-PAYLOAD so they are never read twice, TLS and the MD5
+ETag of each part cover their integrity.
+
+"""
+
+__all__ = ['sign_v4', 'S3Transport']
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+def sign_v4(method, url, headers, access_key, secret_key, region='us-east-1', service='s3',
+            payload_hash=UNSIGNED_PAYLOAD, now=None):
+    """
+    Signs a request with AWS Signature Version 4
+    :param str method:
+    :param str url: full url including any query string
+    :param dict headers: headers to sign besides host, x-amz-date and x-amz-content-sha256
+    :param str access_key:
+    :param str secret_key:
+    :param str region:
+    :param str service:
+    :param str payload_hash: hex sha256 of the body, or UNSIGNED-PAYLOAD
+    :param datetime.datetime now: signing time in UTC, the current time if not given
+    :return dict: headers to send, including Authorization (host is left to the HTTP client)
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    parsed = urlparse(url)
+    signed = dict((k.lower(), ' '.join(str(v).split())) for k, v in headers.items())
+    signed.update({'host': parsed.netloc, 'x-amz-date': amz_date, 'x-amz-content-sha256': payload_hash})
+    names = sorted(signed)
+    query = '&'.join('%s=%s' % (quote(k, safe='-_.~'), quote(v, safe='-_.~'))
+                     for k, v in sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    canonical = '\n'.join([method, quote(unquote(parsed.path) or '/', safe='/-_.~'), query,
+                           ''.join('%s:%s\n' % (name, signed[name]) for name in names), ';'.join(names),
+                           payload_hash])
+    scope = '%s/%s/%s/aws4_request' % (amz_date[:8], region, service)
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                hashlib.sha256(canonical.encode('utf-8')).hexdigest()])
+    key = _hmac(_hmac(_hmac(_hmac(('AWS4' + secret_key).encode('utf-8'), amz_date[:8]), region), service),
+                'aws4_request')
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    result = dict((k, v) for k, v in signed.items() if k != 'host')
+    result['authorization'] = 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % \
+                              (access_key, scope, ';'.join(names), signature)
+    return result
+
+
+def _find(body, tag):
+    for element in ElementTree.fromstring(body).iter():
+        if element.tag.split('}')[-1] == tag:
+            return element.text
+    return None
+
+
+class S3Transport(HttpTransport):
+    """
+    s3://bucket/key with options endpoint, region (default us-east-1), access_key and secret_key (or the
+    AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY environment variables) and part_size (default 64M)
+    """
+    schemes = ('s3',)
+
+    def __init__(self, options=None):
+        HttpTransport.__init__(self, options)
+        self.endpoint = self.options.get('endpoint', 'https://s3.amazonaws.com').rstrip('/')
+        self.region = self.options.get('region', 'us-east-1')
+        self.access_key = self.options.get('access_key') or os.environ.get('AWS_ACCESS_KEY_ID', '')
+        self.secret_key = self.options.get('secret_key') or os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        self.part_size = parse_size(self.options.get('part_size', '64M'))
+
+    def _auth_headers(self):
+        return []
+
+    def http_url(self, url):
+        """
+        :return str: the endpoint url for s3://bucket/key
+        """
+        parsed = urlparse(url)
+        return '%s/%s/%s' % (self.endpoint, parsed.netloc, quote(parsed.path.lstrip('/'), safe='/-_.~'))
+
+    def _signed(self, method, url, payload_hash=UNSIGNED_PAYLOAD):
+        headers = sign_v4(method, url, {}, self.access_key, self.secret_key, self.region,
+                          payload_hash=payload_hash)
+        return ['%s: %s' % item for item in sorted(headers.items())]
+
+    def _send(self, method, url, stream):
+        status, headers, body = self.request(url, stream, self._signed(method, url), method)
+        if status is None or status >= 300 or (method == 'POST' and b'<Error>' in body):
+            raise TransportError("%s %s failed with HTTP status %s: %s" %
+                                 (method, url.split('?')[0], status, body.decode('utf-8', 'replace')[:200]))
+        return headers, body
+
+    def open(self, url):
+        http_url = self.http_url(url)
+        return HttpTransport.open(self, http_url, self._signed('GET', http_url, EMPTY_SHA256))
+
+    def remove(self, url):
+        self._send('DELETE', self.http_url(url), Stream.from_bytes(b''))
+
+    def put(self, url, stream):
+        http_url = self.http_url(url)
+        if stream.size is not None and stream.size <= self.part_size:
+            self._send('PUT', http_url, stream)
+            return stream.size
+        reader = _StreamReader(stream)
+        part = reader.read(self.part_size)
+        if len(part) < self.part_size:
+            self._send('PUT', http_url, Stream.from_bytes(part))
+            return len(part)
+        headers, body = self._send('POST', http_url + '?uploads', Stream.from_bytes(b''))
+        upload_id = _find(body, 'UploadId')
+        upload = '%s?uploadId=%s' % (http_url, quote(upload_id, safe=''))
+        etags = []
+        sent = 0
+        try:
+            while part:
+                part_url = '%s?partNumber=%d&uploadId=%s' % (http_url, len(etags) + 1, quote(upload_id, safe=''))
+                headers, body = self._send('PUT', part_url, Stream.from_bytes(part))
+                etags.append(headers.get('etag'))
+                sent += len(part)
+                part = reader.read(self.part_size)
+            complete = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+                '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (number, etag)
+                for number, etag in enumerate(etags, 1))
+            self._send('POST', upload, Stream.from_bytes(complete.encode('utf-8')))
+        except TransportError:
+            try:
+                self._send('DELETE', upload, Stream.from_bytes(b''))
+            except TransportError:
+                pass
+            raise
+        return sent
@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import logging
+import threading
+from JenkinsTools import lazy_import, ContextExecutor
+from ArtifactTools.checksum import StreamDigest, OrderedDigest
+from JenkinsTools.metrics import record_curl
+from ArtifactTools.multi import connection_share
+
+pycurl = lazy_import('pycurl')
+
+"""
+Segmented, resumable HTTP downloads.
+The artifact is fetched with Range requests in fixed size segments spread over several connections and written
+in place into a preallocated <artifact>.part file. Progress is recorded in <artifact>.part.state so a failed or
+interrupted download picks up where it left off, provided the remote file has not changed in the meantime.
+
+"""
+
+logger = logging.getLogger('ArtifactTools')
+
+__all__ = ['SegmentedDownload', 'DownloadError', 'parse_size']
+
+_SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_size(size):
+    """
+    Converts a size from the config into bytes, accepting plain integers or a K/M/G suffix e.g. 8M
+    :param size:
+    :return int:
+    """
+    if isinstance(size, int):
+        return size
+    size = str(size).strip().lower().rstrip('b')
+    if size and size[-1] in _SIZE_SUFFIXES:
+        return int(float(size[:-1]) * _SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _Segment(object):
+    def __init__(self, start, end, done=0):
+        self.start = start
+        self.end = end
+        self.done = done
+
+    @property
+    def length(self):
+        return self.end - self.start + 1
+
+    @property
+    def complete(self):
+        return self.done >= self.length
+
+
+class _Response(object):
+    """
+    Collects the status and headers of the final response (redirects reset it)
+    """
+    def __init__(self):
+        self.status = None
+        self.headers = {}
+
+    def header(self, line):
+        line = line.decode('iso-8859-1').strip()
+        if line.startswith('HTTP/'):
+            self.status = int(line.split()[1])
+            self.headers = {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            self.headers[name.strip().lower()] = value.strip()
+
+
+class SegmentedDownload(object):
+    """
+    Downloads a url to a local path over several connections, resuming any previous partial attempt.
+    Servers that do not report a length or do not accept ranges are downloaded over a single connection.
+
+    :param str url: source url
+    :param str path: destination file
+    :param int connections: maximum parallel connections
+    :param int segment_size: bytes per range request
+    :param int retries: attempts per segment before the download is abandoned
+    :param float backoff: initial delay between attempts in seconds, doubled after each failure
+    :param tuple auth: optional (username, password) for basic auth
+    :param int low_speed_time: abort a connection transferring under 1KB/s for this many seconds
+    :param list algorithms: checksums to compute as the data arrives, available from digest once run completes
+    """
+    def __init__(self, url, path, connections=4, segment_size=8 * 1024 ** 2, retries=5, backoff=1.0,
+                 auth=None, low_speed_time=60, connect_timeout=30, algorithms=()):
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.state'
+        self.connections = max(1, int(connections))
+        self.segment_size = max(1, parse_size(segment_size))
+        self.retries = max(1, int(retries))
+        self.backoff = backoff
+        self.auth = auth
+        self.low_speed_time = low_speed_time
+        self.connect_timeout = connect_timeout
+        self.size = None
+        self.validator = None
+        self.resumed_bytes = 0
+        self.algorithms = list(algorithms)
+        self.digest = None
+        self._segments = []
+        self._handles = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _curl(self):
+        c = getattr(self._local, 'curl', None)
+        if c is None:
+            c = pycurl.Curl()
+            self._local.curl = c
+            self._handles.append(c)
+        c.reset()
+        if connection_share() is not None:
+            c.setopt(pycurl.SHARE, connection_share())
+        c.setopt(pycurl.URL, self.url)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.MAXREDIRS, 3)
+        c.setopt(pycurl.NOSIGNAL, 1)
+        c.setopt(pycurl.CONNECTTIMEOUT, self.connect_timeout)
+        c.setopt(pycurl.LOW_SPEED_LIMIT, 1024)
+        c.setopt(pycurl.LOW_SPEED_TIME, self.low_speed_time)
+        if self.auth:
+            c.setopt(pycurl.HTTPAUTH, pycurl.HTTPAUTH_BASIC)
+            c.setopt(pycurl.USERPWD, "%s:%s" % self.auth)
+        return c
+
+    def probe(self):
+        """
+        Issues a HEAD request for the size, range support and a validator (ETag or Last-Modified).
+        A refused HEAD (e.g. 403 from a presigned GET url, or 405) is not an error: the download then
+        runs over a single connection and the GET reports whether the artifact is really unavailable.
+        :return bool: True if the server supports segmented downloads
+        """
+        c = self._curl()
+        response = _Response()
+        c.setopt(pycurl.NOBODY, 1)
+        c.setopt(pycurl.HEADERFUNCTION, response.header)
+        try:
+            c.perform()
+        finally:
+            record_curl('http.transfer', c, self.url, kind='probe')
+        if response.status is None or response.status >= 400:
+            logger.info("HEAD %s returned %s, downloading without segments" % (self.url, response.status))
+            self.size = self.validator = None
+            return False
+        length = response.headers.get('content-length')
+        self.size = int(length) if length is not None else None
+        self.validator = response.headers.get('etag') or response.headers.get('last-modified')
+        return self.size is not None and response.headers.get('accept-ranges', '').lower() == 'bytes'
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if (state.get('url') != self.url or state.get('size') != self.size or
+                state.get('validator') != self.validator or state.get('segment_size') != self.segment_size or
+                not os.path.exists(self.part_path)):
+            logger.info("Discarding partial download of %s, remote file has changed" % self.path)
+            return {}
+        return dict((int(k), v) for k, v in state.get('done', {}).items())
+
+    def _save_state(self):
+        with self._lock:
+            state = {'url': self.url, 'size': self.size, 'validator': self.validator,
+                     'segment_size': self.segment_size,
+                     'done': dict((str(s.start), s.done) for s in self._segments if s.done)}
+            tmp = self.state_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp, self.state_path)
+
+    def _preallocate(self):
+        fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, self.size)
+                if hasattr(os, 'posix_fallocate') and self.size:
+                    try:
+                        os.posix_fallocate(fd, 0, self.size)
+                    except OSError:
+                        pass
+        finally:
+            os.close(fd)
+
+    def _fetch_segment(self, segment, fd):
+        for attempt in range(self.retries):
+            if segment.complete:
+                return
+            c = self._curl()
+            response = _Response()
+            offset = [segment.start + segment.done]
+
+            def write(data):
+                if response.status != 206:
+                    return 0
+                data = data[:segment.end + 1 - offset[0]]
+                os.pwrite(fd, data, offset[0])
+                self.digest.feed(offset[0], data)
+                offset[0] += len(data)
+                segment.done = offset[0] - segment.start
+                return None
+
+            c.setopt(pycurl.RANGE, '%d-%d' % (offset[0], segment.end))
+            c.setopt(pycurl.HEADERFUNCTION, response.header)
+            c.setopt(pycurl.WRITEFUNCTION, write)
+            try:
+                c.perform()
+            except pycurl.error as e:
+                record_curl('http.transfer', c, self.url, False, kind='segment')
+                if response.status is not None and response.status != 206:
+                    raise DownloadError("Range request for %s returned %s" % (self.url, response.status))
+                logger.warning("Segment %d-%d of %s failed at %d bytes (attempt %d/%d): %s" %
+                               (segment.start, segment.end, self.url, segment.done, attempt + 1, self.retries, e))
+            else:
+                record_curl('http.transfer', c, self.url, response.status == 206, kind='segment')
+                if response.status != 206:
+                    raise DownloadError("Range request for %s returned %s" % (self.url, response.status))
+                if segment.complete:
+                    self._save_state()
+                    return
+            self._save_state()
+            if attempt + 1 < self.retries:
+                time.sleep(min(self.backoff * 2 ** attempt, 30))
+        raise DownloadError("Segment %d-%d of %s failed after %d attempts" %
+                            (segment.start, segment.end, self.url, self.retries))
+
+    def _run_segmented(self):
+        done = self._load_state()
+        self._segments = []
+        for start in range(0, self.size, self.segment_size):
+            end = min(start + self.segment_size, self.size) - 1
+            self._segments.append(_Segment(start, end, min(done.get(start, 0), end - start + 1)))
+        self.resumed_bytes = sum(s.done for s in self._segments)
+        if self.resumed_bytes:
+            logger.info("Resuming download of %s with %d of %d bytes already present" %
+                        (self.path, self.resumed_bytes, self.size))
+        self._preallocate()
+        pending = [s for s in self._segments if not s.complete]
+        fd = os.open(self.part_path, os.O_RDWR)
+        try:
+            self.digest = OrderedDigest(self.algorithms, lambda offset, length: os.pread(fd, length, offset))
+            for segment in self._segments:
+                self.digest.on_disk(segment.start, segment.done)
+            with ContextExecutor(max_workers=min(self.connections, len(pending) or 1)) as pool:
+                for future in [pool.submit(self._fetch_segment, s, fd) for s in pending]:
+                    future.result()
+        finally:
+            os.close(fd)
+        if self.digest.length != self.size:
+            raise DownloadError("Only %d of %d bytes of %s were checksummed" % (self.digest.length, self.size, self.url))
+
+    def _run_single(self):
+        self.digest = StreamDigest(self.algorithms)
+        for attempt in range(self.retries):
+            c = self._curl()
+            response = _Response()
+            c.setopt(pycurl.HEADERFUNCTION, response.header)
+            self.digest.reset()
+            with open(self.part_path, 'wb') as f:
+                def write(data):
+                    f.write(data)
+                    self.digest.update(data)
+
+                c.setopt(pycurl.WRITEFUNCTION, write)
+                try:
+                    c.perform()
+                except pycurl.error as e:
+                    record_curl('http.transfer', c, self.url, False, kind='single')
+                    logger.warning("Download of %s failed (attempt %d/%d): %s" %
+                                   (self.url, attempt + 1, self.retries, e))
+                else:
+                    record_curl('http.transfer', c, self.url, kind='single')
+                    if response.status is not None and response.status < 400:
+                        return
+                    raise DownloadError("GET %s returned %s" % (self.url, response.status))
+            if attempt + 1 < self.retries:
+                time.sleep(min(self.backoff * 2 ** attempt, 30))
+        raise DownloadError("Download of %s failed after %d attempts" % (self.url, self.retries))
+
+    def run(self):
+        """
+        Performs the download, moving the completed file into place
+        :return str: the downloaded path
+        """
+        self._handles = []
+        self._local = threading.local()
+        try:
+            if self.probe() and self.size > 0:
+                self._run_segmented()
+            else:
+                if self.size is not None:
+                    logger.info("Server does not support ranges for %s, downloading over one connection" % self.url)
+                self._run_single()
+        finally:
+            for c in self._handles:
+                c.close()
+        os.rename(self.part_path, self.path)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+        return self.path
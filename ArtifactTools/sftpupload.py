@@ -0,0 +1,144 @@
+import time
+import logging
+from collections import deque
+from JenkinsTools import lazy_import
+
+"""
+Pipelined sftp uploads.
+paramiko's put stops to collect every outstanding ack whenever more than 100 writes are in flight and one has
+arrived, so the pipe repeatedly drains to empty. Here writes are sent without waiting until max_outstanding are in
+flight, then one ack is collected per write sent, keeping a steady max_outstanding * 32K on the wire. The default
+of 256 (8MB) with a session window to match covers the bandwidth-delay product of a 1 Gbit link at around 50ms.
+Progress is logged every few seconds with the rate and time remaining.
+
+"""
+
+logger = logging.getLogger('ArtifactTools')
+
+paramiko = lazy_import('paramiko')
+
+__all__ = ['TransferProgress', 'pipelined_put', 'format_bytes']
+
+# The most paramiko sends in a single SFTP write request
+REQUEST_SIZE = 32768
+
+
+def format_bytes(count):
+    """
+    :param count: number of bytes
+    :return str: e.g. 12.5MiB
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(count) < 1024 or unit == 'GiB':
+            return ('%d%s' if unit == 'B' else '%.1f%s') % (count, unit)
+        count /= 1024.0
+
+
+class TransferProgress(object):
+    """
+    Progress callback for transfers, called with the bytes sent so far and the total.
+    Logs the percentage, rate and ETA at most every interval seconds, and a summary once the total is reached.
+
+    :param str name: what is being transferred, used in the log lines
+    :param int interval: seconds between progress lines, 0 to only log the summary
+    :param log: logging function, logger.info by default
+    """
+    def __init__(self, name, interval=5, log=None):
+        self.name = name
+        self.interval = interval
+        self.log = log or logger.info
+        self.start = time.time()
+        self.last_logged = self.start
+        self.sent = 0
+        self.total = 0
+        self.finished = False
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        """
+        :return float: bytes per second so far
+        """
+        elapsed = self.elapsed
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """
+        :return float: seconds until the total is reached at the current rate, None if unknown
+        """
+        rate = self.rate
+        if not rate or not self.total:
+            return None
+        return max(0.0, (self.total - self.sent) / rate)
+
+    def __call__(self, sent, total):
+        self.sent = sent
+        self.total = total
+        now = time.time()
+        if total and sent >= total:
+            if not self.finished:
+                self.finished = True
+                self.log("%s: sent %s in %.1fs, %s/s" % (self.name, format_bytes(sent), now - self.start,
+                                                         format_bytes(self.rate)))
+        elif self.interval and now - self.last_logged >= self.interval:
+            self.last_logged = now
+            eta = self.eta
+            self.log("%s: %s of %s (%d%%), %s/s, ETA %s" %
+                     (self.name, format_bytes(sent), format_bytes(total), 100 * sent // total if total else 0,
+                      format_bytes(self.rate), '%ds' % eta if eta is not None else 'unknown'))
+
+
+def pipelined_put(sftp, fileobj, remote_path, size=0, max_outstanding=256, chunk_size=1024 ** 2, progress=None,
+                  confirm=True):
+    """
+    Writes fileobj to remote_path keeping up to max_outstanding write requests unacknowledged
+    :param paramiko.SFTPClient sftp:
+    :param fileobj: file-like object to read from, e.g. a HashingReader
+    :param str remote_path:
+    :param int size: expected size, passed to progress and checked against the remote file if confirm is set
+    :param int max_outstanding: SFTP write requests (of up to 32K each) in flight at once
+    :param int chunk_size: bytes read from fileobj at a time
+    :param progress: callable(sent, total), e.g. a TransferProgress
+    :param bool confirm: stat the remote file afterwards and check its size
+    :return int: bytes sent
+    :raises IOError: if the server rejects a write or the remote size does not match
+    """
+    max_outstanding = max(1, int(max_outstanding))
+    sent = 0
+    pending = deque()
+    CMD_WRITE, CMD_STATUS, int64 = paramiko.sftp.CMD_WRITE, paramiko.sftp.CMD_STATUS, paramiko.sftp.int64
+
+    def collect():
+        # _read_response raises for an error status, the same way SFTPFile checks its pipelined writes
+        t, msg = sftp._read_response(pending.popleft())
+        if t != CMD_STATUS:
+            raise paramiko.SFTPError('Expected status')
+
+    with sftp.open(remote_path, 'wb') as remote:
+        # Requests are issued directly rather than through SFTPFile.write, which drains every outstanding
+        # write whenever more than 100 are in flight
+        while True:
+            data = fileobj.read(chunk_size)
+            if not data:
+                break
+            for start in range(0, len(data), REQUEST_SIZE):
+                pending.append(sftp._async_request(type(None), CMD_WRITE, remote.handle, int64(sent + start),
+                                                   data[start:start + REQUEST_SIZE]))
+                while len(pending) > max_outstanding:
+                    collect()
+            sent += len(data)
+            if progress is not None:
+                progress(sent, size or sent)
+        while pending:
+            collect()
+    if progress is not None and not size:
+        progress(sent, sent)
+    if confirm:
+        remote_size = sftp.stat(remote_path).st_size
+        if remote_size != sent:
+            raise IOError("size mismatch in put, %d sent but %s has %d bytes" % (sent, remote_path, remote_size))
+    return sent
@@ -0,0 +1,533 @@
+import os
+import mmap
+import shutil
+import logging
+from base64 import b64encode
+from collections import deque
+from urllib.parse import urlparse, unquote
+from JenkinsTools import lazy_import
+from JenkinsTools.metrics import span, record_curl, register_secret
+from SSHTools import get_pool
+from ArtifactTools.segmented import _Response
+from ArtifactTools.sftpupload import pipelined_put
+from ArtifactTools.checksum import StreamDigest, DigestCache, checksum_name, parse_checksum
+
+pycurl = lazy_import('pycurl')
+http_client = lazy_import('http.client')
+
+"""
+Streaming transports for artifacts: local files, HTTP(S), SFTP and S3-compatible object stores behind one interface.
+A transport opens a url as a Stream, an iterator of byte chunks, and writes a Stream to a url, so any source can be
+relayed to any destination without the artifact landing on local disk. When the data is a local file the Stream
+carries its path, and writers hand the file to the kernel instead: copy via sendfile for file destinations, and
+socket.sendfile for plain HTTP uploads. File chunks are memoryviews of an mmap rather than copies.
+
+"""
+
+logger = logging.getLogger('ArtifactTools')
+
+__all__ = ['Stream', 'Transport', 'TransportError', 'FileTransport', 'HttpTransport', 'SftpTransport',
+           'get_transport', 'transport_options', 'relay']
+
+CHUNK_SIZE = 1024 ** 2
+
+# Job config keys passed on to transports
+TRANSPORT_OPTIONS = ('username', 'password', 'apikey', 'identity_file', 'endpoint', 'region', 'access_key',
+                     'secret_key', 'part_size', 'chunk_size')
+
+
+class TransportError(Exception):
+    pass
+
+
+class Stream(object):
+    """
+    An artifact being read: an iterator of byte chunks with the size, when known.
+    path is set when the bytes come straight from a local file, so writers can pass the file to the kernel.
+
+    :param chunks: iterable of bytes-like objects
+    :param int size: total bytes, or None
+    :param str path: local file holding exactly these bytes
+    :param closer: callable releasing the source, called by close
+    """
+    def __init__(self, chunks, size=None, path=None, closer=None):
+        self.chunks = chunks
+        self.size = size
+        self.path = path
+        self.closer = closer
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        if self.closer is not None:
+            self.closer()
+            self.closer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls([data], len(data))
+
+
+class _StreamReader(object):
+    """
+    File-like read() over a Stream's chunks, for APIs that pull data
+    """
+    def __init__(self, stream):
+        self.chunks = iter(stream)
+        self.current = memoryview(b'')
+
+    def read(self, size=-1):
+        if size < 0:
+            data = b''.join([self.current] + list(self.chunks))
+            self.current = memoryview(b'')
+            return data
+        pieces = []
+        while size > 0:
+            if not len(self.current):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.current = memoryview(chunk)
+                continue
+            piece = self.current[:size]
+            pieces.append(piece)
+            self.current = self.current[len(piece):]
+            size -= len(piece)
+        return b''.join(pieces)
+
+
+class Transport(object):
+    """
+    Base class for transports.
+    Options are taken from the job config: username, password, apikey, identity_file, and for S3 endpoint, region,
+    access_key and secret_key.
+
+    :param dict options:
+    """
+    schemes = ()
+    # put writes to a temporary name and renames it into place, so a failed put never leaves part of an artifact
+    atomic = False
+
+    def __init__(self, options=None):
+        self.options = options or {}
+        for secret in ('password', 'apikey', 'secret_key'):
+            register_secret(self.options.get(secret))
+        self.chunk_size = int(self.options.get('chunk_size', CHUNK_SIZE))
+
+    def open(self, url):
+        """
+        :param str url:
+        :return Stream:
+        :raises TransportError: if the artifact cannot be read
+        """
+        raise NotImplementedError
+
+    def put(self, url, stream):
+        """
+        :param str url:
+        :param Stream stream:
+        :return int: bytes written
+        :raises TransportError: if the artifact cannot be written
+        """
+        raise NotImplementedError
+
+    def remove(self, url):
+        """
+        Deletes an artifact, e.g. one a failed put may have left behind on a transport that is not atomic
+        :param str url:
+        :raises TransportError: if it cannot be deleted
+        """
+        raise NotImplementedError
+
+
+class FileTransport(Transport):
+    """
+    Local files, as file:// urls or plain paths
+    """
+    schemes = ('file', '')
+    atomic = True
+
+    @staticmethod
+    def path(url):
+        parsed = urlparse(url)
+        return unquote(parsed.path) if parsed.scheme == 'file' else url
+
+    def open(self, url):
+        path = self.path(url)
+        try:
+            f = open(path, 'rb')
+        except (IOError, OSError) as e:
+            raise TransportError("Cannot read %s: %s" % (path, e))
+        size = os.fstat(f.fileno()).st_size
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        view = memoryview(mapped) if mapped is not None else memoryview(b'')
+
+        def chunks():
+            for start in range(0, size, self.chunk_size):
+                yield view[start:start + self.chunk_size]
+
+        def closer():
+            view.release()
+            if mapped is not None:
+                mapped.close()
+            f.close()
+        return Stream(chunks(), size, path, closer)
+
+    def put(self, url, stream):
+        path = self.path(url)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '%s.part-%d' % (path, os.getpid())
+        try:
+            if stream.path is not None:
+                # copyfile uses sendfile on Linux, the data does not pass through python
+                shutil.copyfile(stream.path, tmp)
+            else:
+                with open(tmp, 'wb') as f:
+                    for chunk in stream:
+                        f.write(chunk)
+            os.rename(tmp, path)
+        except BaseException as e:
+            # including errors raised by the stream, e.g. a relay's checksum mismatch
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            if isinstance(e, (IOError, OSError)):
+                raise TransportError("Cannot write %s: %s" % (path, e))
+            raise
+        return os.path.getsize(path)
+
+
+class _CurlStream(object):
+    """
+    Pulls a response body through a CurlMulti handle one chunk at a time, so it can be consumed as an iterator
+    """
+    def __init__(self, c, url):
+        self.c = c
+        self.url = url
+        self.response = _Response()
+        self.buffered = deque()
+        self.headers_done = False
+        self.multi = pycurl.CurlMulti()
+        c.setopt(pycurl.HEADERFUNCTION, self.header)
+        c.setopt(pycurl.WRITEFUNCTION, self.write)
+        self.multi.add_handle(c)
+        self.running = True
+
+    def header(self, line):
+        self.response.header(line)
+        if line in (b'\r\n', b'\n') and self.response.status not in (100, 301, 302, 303, 307, 308):
+            self.headers_done = True
+
+    def write(self, data):
+        if self.headers_done and self.response.status < 400:
+            self.buffered.append(data)
+
+    def step(self):
+        while True:
+            ret, running = self.multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        if not running:
+            self.running = False
+            remaining, succeeded, failed = self.multi.info_read()
+            if failed:
+                raise TransportError("Transfer of %s failed: %s" % (self.url, failed[0][2]))
+        elif not self.buffered:
+            self.multi.select(1.0)
+
+    def start(self):
+        while self.running and not self.headers_done:
+            self.step()
+        if self.response.status is None or self.response.status >= 400:
+            self.close()
+            raise TransportError("GET %s failed with HTTP status %s" % (self.url, self.response.status))
+        length = self.response.headers.get('content-length')
+        return int(length) if length is not None else None
+
+    def __iter__(self):
+        while self.running or self.buffered:
+            while self.buffered:
+                yield self.buffered.popleft()
+            if self.running:
+                self.step()
+
+    def close(self):
+        if self.multi is not None:
+            record_curl('http.transfer', self.c, self.url, self.response.status is not None, kind='stream')
+            self.multi.remove_handle(self.c)
+            self.multi.close()
+            self.c.close()
+            self.multi = None
+
+
+class HttpTransport(Transport):
+    """
+    HTTP(S) with basic auth or an Artifactory api key
+    """
+    schemes = ('http', 'https')
+
+    def _auth_headers(self):
+        headers = []
+        if self.options.get('apikey'):
+            headers.append('X-JFrog-Art-Api: %s' % self.options['apikey'])
+        elif self.options.get('username'):
+            credentials = '%s:%s' % (self.options['username'], self.options.get('password') or '')
+            headers.append('Authorization: Basic %s' % b64encode(credentials.encode()).decode())
+        return headers
+
+    def _curl(self, url, headers):
+        c = pycurl.Curl()
+        c.setopt(pycurl.URL, url)
+        c.setopt(pycurl.FOLLOWLOCATION, 1)
+        c.setopt(pycurl.MAXREDIRS, 3)
+        c.setopt(pycurl.NOSIGNAL, 1)
+        c.setopt(pycurl.CONNECTTIMEOUT, 30)
+        c.setopt(pycurl.LOW_SPEED_LIMIT, 1024)
+        c.setopt(pycurl.LOW_SPEED_TIME, 60)
+        c.setopt(pycurl.HTTPHEADER, self._auth_headers() + list(headers or []))
+        return c
+
+    def open(self, url, headers=None):
+        body = _CurlStream(self._curl(url, headers), url)
+        try:
+            size = body.start()
+        except pycurl.error as e:
+            body.close()
+            raise TransportError("GET %s failed: %s" % (url, e))
+        return Stream(body, size, closer=body.close)
+
+    def _sendfile(self, url, stream, headers):
+        parsed = urlparse(url)
+        conn = http_client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=300)
+        try:
+            conn.putrequest('PUT', parsed.path + ('?' + parsed.query if parsed.query else ''), skip_accept_encoding=True)
+            conn.putheader('Content-Length', str(stream.size))
+            for header in self._auth_headers() + list(headers or []):
+                name, value = header.split(':', 1)
+                conn.putheader(name.strip(), value.strip())
+            conn.endheaders()
+            with open(stream.path, 'rb') as f:
+                conn.sock.sendfile(f)
+            response = conn.getresponse()
+            return response.status, dict((k.lower(), v) for k, v in response.getheaders()), response.read()
+        finally:
+            conn.close()
+
+    def request(self, url, stream, headers=None, method='PUT'):
+        """
+        Sends stream as the body of a request, with sendfile when it is a local file going to a plain http url
+        :return tuple: status, response headers with lower case names, response body
+        """
+        if method == 'PUT' and stream.path is not None and stream.size and urlparse(url).scheme == 'http':
+            return self._sendfile(url, stream, headers)
+        response = _Response()
+        c = self._curl(url, headers)
+        reader = _StreamReader(stream)
+        failed = []
+
+        def read(size):
+            try:
+                return reader.read(size)
+            except Exception as e:
+                # raised again below, rather than printed by pycurl
+                failed.append(e)
+                return pycurl.READFUNC_ABORT
+        try:
+            c.setopt(pycurl.UPLOAD, 1)
+            if method != 'PUT':
+                c.setopt(pycurl.CUSTOMREQUEST, method)
+            c.setopt(pycurl.READFUNCTION, read)
+            if stream.size is not None:
+                c.setopt(pycurl.INFILESIZE_LARGE, stream.size)
+            c.setopt(pycurl.HEADERFUNCTION, response.header)
+            body = []
+            c.setopt(pycurl.WRITEFUNCTION, body.append)
+            c.perform()
+        except pycurl.error as e:
+            if failed:
+                raise failed[0]
+            raise TransportError("%s %s failed: %s" % (method, url, e))
+        finally:
+            record_curl('http.transfer', c, url, kind=method.lower())
+            c.close()
+        return response.status, response.headers, b''.join(body)
+
+    def put(self, url, stream, headers=None):
+        try:
+            status, response, body = self.request(url, stream, headers)
+        except (IOError, OSError, http_client.HTTPException) as e:
+            raise TransportError("PUT %s failed: %s" % (url, e))
+        if status is None or status >= 400:
+            raise TransportError("PUT %s failed with HTTP status %s" % (url, status))
+        return stream.size
+
+    def remove(self, url):
+        status, response, body = self.request(url, Stream.from_bytes(b''), method='DELETE')
+        if status is None or (status >= 400 and status != 404):
+            raise TransportError("DELETE %s failed with HTTP status %s" % (url, status))
+
+
+class SftpTransport(Transport):
+    """
+    sftp://user@host:port/path over the shared SSHTools pool; /~/path is relative to the user's home
+    """
+    schemes = ('sftp', 'ssh')
+    atomic = True
+
+    def _connect(self, url):
+        parsed = urlparse(url)
+        user = parsed.username or self.options.get('username')
+        path = unquote(parsed.path)
+        if path.startswith('/~/'):
+            path = path[3:]
+        sftp = get_pool().sftp(parsed.hostname, parsed.port or 22, user,
+                               self.options.get('identity_file', '~/.ssh/id_rsa'),
+                               window_size=16 * 1024 ** 2)
+        return sftp, path
+
+    def open(self, url):
+        sftp, path = self._connect(url)
+        try:
+            f = sftp.open(path, 'rb')
+            size = f.stat().st_size
+            f.prefetch(size)
+        except (IOError, OSError) as e:
+            sftp.close()
+            raise TransportError("Cannot read %s: %s" % (url, e))
+
+        def chunks():
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                yield chunk
+
+        def closer():
+            f.close()
+            sftp.close()
+        return Stream(chunks(), size, closer=closer)
+
+    def put(self, url, stream):
+        sftp, path = self._connect(url)
+        tmp = '%s.part-%d' % (path, os.getpid())
+        try:
+            sent = pipelined_put(sftp, _StreamReader(stream), tmp, stream.size or 0)
+            sftp.posix_rename(tmp, path)
+            return sent
+        except BaseException as e:
+            try:
+                sftp.remove(tmp)
+            except (IOError, OSError):
+                pass
+            if isinstance(e, (IOError, OSError)):
+                raise TransportError("Cannot write %s: %s" % (url, e))
+            raise
+        finally:
+            sftp.close()
+
+
+def get_transport(url, options=None):
+    """
+    :param str url: file path or url with a file, http(s), sftp or s3 scheme
+    :param dict options: credentials and settings for the transport
+    :return Transport:
+    """
+    scheme = urlparse(url).scheme
+    if scheme == 's3':
+        from ArtifactTools.s3 import S3Transport
+        return S3Transport(options)
+    for transport in (FileTransport, HttpTransport, SftpTransport):
+        if scheme in transport.schemes:
+            return transport(options)
+    raise TransportError("No transport for %s" % url)
+
+
+def transport_options(config):
+    """
+    :param dict config: a job's config
+    :return dict: the keys transports use
+    """
+    return dict((k, config[k]) for k in TRANSPORT_OPTIONS if config.get(k) is not None)
+
+
+def _published_checksum(transport, url, algorithm):
+    try:
+        with transport.open(checksum_name(url, algorithm)) as stream:
+            return parse_checksum(b''.join(bytes(c) for c in stream))
+    except TransportError:
+        return None
+
+
+def relay(source, destination, source_options=None, destination_options=None, algorithms=()):
+    """
+    Streams an artifact from source to destination, computing checksums on the way.
+    The checksums are compared with any published next to the source before the destination is complete: the last
+    chunk is held back until they match, so a writer never renames or completes a mismatching artifact into place,
+    and what an http or s3 destination received is deleted. They are then published next to the destination.
+    :param str source: url or path
+    :param str destination: url or path
+    :param dict source_options:
+    :param dict destination_options:
+    :param list algorithms:
+    :return dict: algorithm -> hex digest
+    :raises TransportError: if either side fails or a checksum does not match
+    """
+    reader = get_transport(source, source_options)
+    writer = get_transport(destination, destination_options)
+    digest = StreamDigest(algorithms)
+    published = dict((algorithm, _published_checksum(reader, source, algorithm)) for algorithm in algorithms)
+
+    def verify(digests):
+        for algorithm, value in digests.items():
+            expected = published.get(algorithm)
+            if expected is not None and expected != value:
+                raise TransportError("%s mismatch relaying %s: published %s, got %s"
+                                     % (algorithm, source, expected, value))
+
+    with span('artifact.relay', source=urlparse(source).scheme or 'file',
+              destination=urlparse(destination).scheme or 'file') as s, reader.open(source) as stream:
+        if stream.path is not None:
+            # keep the zero copy path, the digests come from the file (and are cached with it)
+            digests = DigestCache().digests(stream.path, algorithms)
+            verify(digests)
+            sent = writer.put(destination, stream)
+        else:
+            mismatch = []
+
+            def hashed():
+                held = None
+                for chunk in stream:
+                    digest.update(chunk)
+                    if held is not None:
+                        yield held
+                    held = chunk
+                try:
+                    verify(digest.hexdigests())
+                except TransportError as e:
+                    mismatch.append(e)
+                    raise
+                if held is not None:
+                    yield held
+            try:
+                sent = writer.put(destination, Stream(hashed(), stream.size))
+            except TransportError:
+                if not mismatch:
+                    raise
+                if not writer.atomic:
+                    # the server may have kept the body it received up to the mismatch
+                    try:
+                        writer.remove(destination)
+                    except TransportError as e:
+                        logger.warning("Cannot remove %s after the checksum mismatch: %s" % (destination, e))
+                raise mismatch[0]
+            digests = digest.hexdigests()
+        s.set(source_url=source, destination_url=destination, bytes=sent)
+    for algorithm, value in digests.items():
+        writer.put(checksum_name(destination, algorithm), Stream.from_bytes(value.encode('ascii')))
+    logger.info("Relayed %s to %s (%s bytes)" % (source, destination, sent))
+    return digests
@@ -1,9 +1,16 @@
 from sys import exit
 import os
-import yaml
 from operator import itemgetter
+import shlex
 import logging
+import selectors
 import subprocess
+from JenkinsTools import load_yaml_file
+from JenkinsTools.metrics import span
+from DockerTools.scheduler import BuildScheduler, StepResult
+from DockerTools.warm import ContainerPool, measure_overhead
+from DockerTools.stepcache import StepCache
+from DockerTools.prepull import ImagePuller
 
 """
 Wrapper for jenkins to perform tasks inside a docker containers
@@ -20,16 +27,44 @@ Last update: 2016-09-01
 
 log_level = logging.INFO
 
-sh = logging.StreamHandler()
-sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+# handlers are left to the entry point, see JenkinsTools.configure_logging
 logger = logging.getLogger('DockerTools')
-logger.addHandler(sh)
 logger.setLevel(log_level)
 
 
+class _LineLog(object):
+    """
+    Logs a stream of output a line at a time, prefixed with the step name, holding at most max_line bytes
+    """
+    def __init__(self, log, prefix, max_line):
+        self.log = log
+        self.prefix = prefix
+        self.max_line = max_line
+        self.pending = b''
+
+    def feed(self, data):
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        while len(self.pending) > self.max_line:
+            lines.append(self.pending[:self.max_line])
+            self.pending = self.pending[self.max_line:]
+        for line in lines:
+            self.log("[%s] %s" % (self.prefix, line.rstrip(b'\r').decode('utf-8', 'replace')))
+
+    def flush(self):
+        if self.pending:
+            self.log("[%s] %s" % (self.prefix, self.pending.decode('utf-8', 'replace')))
+            self.pending = b''
+
+
 class DockerBuilder:
-    def __init__(self):
-        self.base_cmd = 'docker run -v'
+    # Longest line held in memory before it is logged in pieces
+    max_line = 64 * 1024
+
+    def __init__(self, docker='docker'):
+        self.docker = docker
+        self.base_cmd = '%s run -v' % docker
+        self.name = None
         self.sudoit = False
         self.cmd = ''
         self.image = ''
@@ -38,6 +73,8 @@ class DockerBuilder:
         self.volume = '/tmp'
 
     def set_command(self, kwargs):
+        if "name" in kwargs:
+            self.name = kwargs['name']
         if "command" in kwargs:
             self.cmd = kwargs['command']
         if "image" in kwargs:
@@ -60,16 +97,16 @@ class DockerBuilder:
             logger.info('Running the docker command: "%s"' % self.exec_me)
             my_env = os.environ.copy()
             my_env['PATH'] = '/usr/bin:' + my_env['PATH']
-            p = subprocess.Popen(self.exec_me.split(),
+            p = subprocess.Popen(shlex.split(self.exec_me),
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.PIPE,
                                  env=my_env,
                                  shell=False)
-            std_out, std_err = p.communicate()
-            if len(std_err) > 0:
-                logger.error(str(std_err))
-            if len(std_out) > 0:
-                logger.info(str(std_out))
+            self.stream_output(p.stdout, p.stderr)
+            p.wait()
+            if p.returncode != 0:
+                logger.error("[%s] exited with status %d" % (self.name or self.image, p.returncode))
+            return p.returncode
         except OSError as e:
             logger.error("OSError thrown in docker command execution output was \n %s" % e)
             exit(2)
@@ -79,14 +116,73 @@ class DockerBuilder:
         except RuntimeWarning as e:
             logger.warning("RuntimeWarning on docker command, output was \n %s" % e)
 
+    def run_engine(self, engine):
+        """
+        Runs the step through the Docker Engine API instead of the docker CLI, see DockerTools.engine.
+        The command is split like a shell would, and the step's sudo setting is not needed.
+        :param EngineClient engine:
+        :return int: the container's exit code, 125 if the daemon could not run it (as docker run)
+        """
+        from DockerTools.engine import EngineError, STDERR
+        image = '%s:%s' % (self.image, self.label)
+        host, container = self.volume.rsplit(':', 1)
+        logger.info('Running "%s" in %s with %s mounted on %s' % (self.cmd, image, host, container))
+        prefix = self.name or self.image
+        out = _LineLog(logger.info, prefix, self.max_line)
+        err = _LineLog(logger.warning, prefix, self.max_line)
+        try:
+            returncode = engine.run(image, shlex.split(self.cmd), ['%s:%s' % (os.path.abspath(host), container)],
+                                    lambda stream, data: (err if stream == STDERR else out).feed(data))
+        except EngineError as e:
+            logger.error("[%s] %s" % (prefix, e))
+            returncode = 125
+        finally:
+            out.flush()
+            err.flush()
+        if returncode != 0:
+            logger.error("[%s] exited with status %d" % (prefix, returncode))
+        return returncode
+
+    def stream_output(self, stdout, stderr):
+        """
+        Logs the container's output line by line as it is produced, prefixed with the step name.
+        stdout is logged at INFO and stderr at WARNING; at most max_line bytes of each stream are held at a time.
+        :param stdout: stdout pipe of the docker process
+        :param stderr: stderr pipe of the docker process
+        """
+        prefix = self.name or self.image
+        sel = selectors.DefaultSelector()
+        sel.register(stdout, selectors.EVENT_READ, _LineLog(logger.info, prefix, self.max_line))
+        sel.register(stderr, selectors.EVENT_READ, _LineLog(logger.warning, prefix, self.max_line))
+        while sel.get_map():
+            for key, mask in sel.select():
+                data = os.read(key.fd, 65536)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    key.data.flush()
+                    continue
+                key.data.feed(data)
+        sel.close()
+
     def set_cmd(self, cmd=None):
         self.cmd = cmd
 
     def assemble_command(self):
+        volume = shlex.quote(self.volume)
         if self.sudoit:
-            self.exec_me = '%s %s %s %s:%s %s' % ('sudo', self.base_cmd, self.volume, self.image, self.label, self.cmd)
+            self.exec_me = '%s %s %s %s:%s %s' % ('sudo', self.base_cmd, volume, self.image, self.label, self.cmd)
         else:
-            self.exec_me = '%s %s %s:%s %s' % (self.base_cmd, self.volume, self.image, self.label, self.cmd)
+            self.exec_me = '%s %s %s:%s %s' % (self.base_cmd, volume, self.image, self.label, self.cmd)
+        return self.exec_me
+
+    def assemble_exec(self, container):
+        """
+        Runs the command in an already running container instead of starting a new one
+        :param str container: container id from ContainerPool
+        """
+        self.exec_me = '%s exec %s %s' % (self.docker, container, self.cmd)
+        if self.sudoit:
+            self.exec_me = 'sudo %s' % self.exec_me
         return self.exec_me
 
 
@@ -94,49 +190,162 @@ class BuildConf:
     """
     Loads a yaml file into a dictionary for the module to pull from
     :param str filename: yml file to read config from - has default value.
+    :param int workers: maximum steps running at once
+    :param bool warm: run steps with docker exec in one long-lived container per image, label and volume
+    :param str docker: docker executable
+    :param str cache_dir: when set, steps declaring inputs are skipped if their inputs match a previous success
+    :param int pulls: images pulled at once before their steps run; 0 leaves pulling to docker run
+    :param str backend: 'cli' to run steps with the docker command, 'engine' to use the Docker Engine API socket
+                        (warm containers are still started and run with the docker command)
+    :param str docker_host: engine socket, $DOCKER_HOST or /var/run/docker.sock if not given
 
     """
 
-    def __init__(self, filename='docker-runner.yml'):
+    def __init__(self, filename='docker-runner.yml', workers=4, warm=False, docker='docker', cache_dir=None,
+                 pulls=3, backend='cli', docker_host=None):
         logger.debug("Loading config file %s " % filename)
         self.npm_build_conf = {}
         self.filename = filename
+        self.workers = workers
+        self.warm = warm
+        self.docker = docker
+        self.pool = None
+        self.cache = StepCache(cache_dir, docker) if cache_dir else None
+        self.cached = set()
+        self.engine = None
+        if backend == 'engine':
+            from DockerTools.engine import EngineClient
+            self.engine = EngineClient(docker_host)
+        elif backend != 'cli':
+            logger.fatal("FATAL: Unknown docker backend %s" % backend)
+            exit(2)
+        self.puller = ImagePuller(docker, pulls, self.engine) if pulls else None
         self.read_config()
         self.command_list = []
+        self.results = []
 
     def read_config(self):
         try:
-            f = open(self.filename)
+            self.npm_build_conf = load_yaml_file(self.filename)
         except (OSError, IOError):
             logger.fatal("FATAL: Config file (%s) not found" % self.filename)
             exit(2)
-        else:
-            self.npm_build_conf = yaml.safe_load(f)
+
+    def run_step(self, cmd):
+        key = None
+        if self.cache is not None and cmd.get('inputs'):
+            key = self.cache.key(cmd)
+            if self.cache.restore(key, cmd):
+                logger.info("[%s] inputs unchanged, restored outputs from the step cache" % cmd['name'])
+                self.cached.add(cmd['name'])
+                return 0
+        run = DockerBuilder(self.docker)
+        run.set_command(cmd)
+        with span('docker.step', step=cmd['name']) as s:
+            if self.pool is not None:
+                run.assemble_exec(self.pool.container_for(run))
+                returncode = run.run_command()
+            elif self.engine is not None:
+                returncode = run.run_engine(self.engine)
+            else:
+                returncode = run.run_command()
+            s.ok = returncode == 0
+            s.set(image='%s:%s' % (run.image, run.label), returncode=returncode,
+                  mode='exec' if self.pool is not None else 'engine' if self.engine is not None else 'run')
+        if key is not None and returncode == 0:
+            self.cache.store(key, cmd)
+        return returncode
 
     def run_commands(self):
+        """
+        Runs the steps as a dependency graph, up to self.workers at a time.
+        Steps run once everything in their depends_on has succeeded; steps without depends_on wait for all
+        steps with a lower order. Dependents of a failed step are skipped.
+        Images missing on the agent are pulled first, self.puller's concurrency at a time, and only the steps that
+        use them wait for the pull; the pull times are reported apart from the step times.
+        :return bool: True if every step succeeded
+        """
+        try:
+            scheduler = BuildScheduler(self.command_list, self.run_step, self.workers)
+        except ValueError as e:
+            logger.fatal("FATAL: %s" % e)
+            exit(2)
+        if self.puller is not None:
+            self.puller.start(self.command_list)
+            scheduler.waits = self.puller.waiting_for(self.command_list)
+        if self.warm:
+            self.pool = ContainerPool(self.docker)
+        try:
+            self.results = scheduler.run()
+        finally:
+            if self.puller is not None:
+                self.puller.close()
+                self.puller.report()
+            if self.engine is not None:
+                self.engine.close()
+            if self.pool is not None:
+                for key, seconds in self.pool.start_times.items():
+                    logger.info("Warm container for %s:%s started in %.2fs" % (key[0], key[1], seconds))
+                self.pool.close()
+                self.pool = None
+        path, seconds = scheduler.critical_path()
+        logger.info("Critical path: %s (%.2fs)" % (' -> '.join(path), seconds))
+        for result in self.results:
+            status = 'cached' if result.name in self.cached else result.status
+            logger.info("%-20s %-8s %7.2fs %s" % (result.name, status, result.elapsed, result.error or ''))
+        return all(r.status == StepResult.OK for r in self.results)
+
+    def exit_code(self):
+        """
+        :return int: exit status of the first failed step (1 if it did not report one), 0 if all succeeded
+        """
+        for result in self.results:
+            if result.status == StepResult.FAILED:
+                return result.returncode or 1
+        return 0 if all(r.status == StepResult.OK for r in self.results) else 1
+
+    def measure_overhead(self, runs=3):
+        """
+        Times a no-op step with docker run and with docker exec for each image, label and volume in the config
+        :param int runs: repetitions averaged for each mode
+        :return dict: (image, label, volume) -> timings from DockerTools.warm.measure_overhead
+        """
+        timings = {}
         for cmd in self.command_list:
-            run = DockerBuilder()
+            run = DockerBuilder(self.docker)
             run.set_command(cmd)
-            run.run_command()
+            key = (run.image, run.label, run.volume)
+            if key not in timings:
+                timings[key] = measure_overhead(run, runs, self.docker)
+                logger.info("Step overhead for %s:%s - docker run %.2fs, docker exec %.2fs "
+                            "(warm container start %.2fs)" % (run.image, run.label, timings[key]['run'],
+                                                              timings[key]['exec'], timings[key]['start']))
+        return timings
 
     def build_command_list(self):
         command_list = []
         command = {}
         conf = self.npm_build_conf
         for key in conf:
-            command['order'] = conf[key]['order']
-            if conf[key]['sudo']:
+            command['name'] = key
+            command['order'] = conf[key].get('order', 0)
+            if conf[key].get('sudo'):
                 command['sudoit'] = conf[key]['sudo']
-            if conf[key]['command']:
+            if conf[key].get('command'):
                 command['command'] = conf[key]['command']
-            if conf[key]['label']:
+            if conf[key].get('label'):
                 command['label'] = conf[key]['label']
-            if conf[key]['image']:
+            if conf[key].get('image'):
                 command['image'] = conf[key]['image']
-            if conf[key]['volume']:
+            if conf[key].get('volume'):
                 command['volume'] = conf[key]['volume']
+            for option in ('inputs', 'outputs'):
+                if conf[key].get(option):
+                    value = conf[key][option]
+                    command[option] = [value] if isinstance(value, str) else list(value)
+            if 'depends_on' in conf[key]:
+                command['depends_on'] = conf[key]['depends_on'] or []
             command_list.append(command.copy())
             command.clear()
         self.command_list = sorted(command_list, key=itemgetter('order'))
         # self.run_commands()
-
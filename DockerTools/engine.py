@@ -0,0 +1,405 @@
+import os
+import json
+import base64
+import socket
+import struct
+import logging
+import threading
+import http.client as http_client
+from urllib.parse import quote, urlencode
+
+"""
+Docker Engine API backend. Steps are run by talking HTTP to the daemon's Unix socket instead of forking the docker
+CLI (and sudo) for each one: create the container, attach to its output, start it, stream the log, wait for the
+exit code and remove it. Each worker thread keeps its connection to the daemon open for the whole build; only the
+attach stream, which the daemon takes over until the container exits, and pulls use connections of their own.
+Pulls from private registries send the credentials docker login stored in the docker config (X-Registry-Auth);
+credentials kept by a credential helper can only be read by the docker CLI, so those pulls raise AuthUnavailable.
+The command is passed to the container as an argument list, so quoted arguments survive intact.
+BuildConf imports this module only when the engine backend is chosen.
+
+"""
+
+logger = logging.getLogger('DockerTools')
+
+__all__ = ['EngineClient', 'EngineError', 'AuthUnavailable', 'registry_auth', 'DEFAULT_SOCKET']
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+# Key of Docker Hub in the docker config's auths, as docker login writes it
+DOCKER_HUB = 'https://index.docker.io/v1/'
+
+# Requests that can safely be sent again if the daemon dropped the connection before answering
+IDEMPOTENT = frozenset(['GET', 'HEAD', 'PUT', 'DELETE'])
+
+# Stream ids in the multiplexed attach stream of a container without a tty
+STDOUT, STDERR = 1, 2
+
+
+class EngineError(Exception):
+    """
+    The daemon could not be reached or rejected a request
+    :param int status: HTTP status, None if the request was not answered
+    """
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class AuthUnavailable(EngineError):
+    """
+    The registry's credentials are kept by a docker credential helper, so the image has to be pulled with the docker
+    CLI
+    """
+
+
+class _UnixConnection(http_client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        http_client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.unix_path)
+        self.sock = sock
+
+
+def socket_path(docker_host=None):
+    """
+    :param str docker_host: unix:///path, or a plain path; $DOCKER_HOST or the default socket if not given
+    :return str: the socket path
+    """
+    docker_host = docker_host or os.environ.get('DOCKER_HOST') or DEFAULT_SOCKET
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    if '://' in docker_host:
+        raise EngineError('only unix sockets are supported, not %s' % docker_host)
+    return docker_host
+
+
+def _split(image):
+    """
+    :param str image: image:label, or an image without a label
+    :return tuple: (name, label)
+    """
+    name, _, tag = image.rpartition(':')
+    if '/' in tag or not name:
+        return image, 'latest'
+    return name, tag
+
+
+def _registry(image):
+    """
+    :param str image: image:label
+    :return str: host[:port] of the registry the image is pulled from
+    """
+    first, _, rest = _split(image)[0].partition('/')
+    if rest and ('.' in first or ':' in first or first == 'localhost'):
+        return first
+    return 'index.docker.io'
+
+
+def _host(key):
+    host = key.split('://', 1)[-1].split('/', 1)[0]
+    return 'index.docker.io' if host in ('docker.io', 'registry-1.docker.io') else host
+
+
+def registry_auth(image, config=None):
+    """
+    Credentials for pulling an image, from the docker config written by docker login
+    :param str image: image:label
+    :param str config: docker config file; $DOCKER_CONFIG/config.json or ~/.docker/config.json if not given
+    :return str: X-Registry-Auth header value, or None to pull anonymously
+    :raises AuthUnavailable: if a credential helper keeps the registry's credentials
+    """
+    config = config or os.path.join(os.environ.get('DOCKER_CONFIG') or os.path.expanduser('~/.docker'),
+                                    'config.json')
+    try:
+        with open(config) as f:
+            settings = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    registry = _registry(image)
+    entry = next((value for key, value in (settings.get('auths') or {}).items() if _host(key) == registry), None)
+    helper = next((value for key, value in (settings.get('credHelpers') or {}).items() if _host(key) == registry),
+                  None)
+    if helper or (entry is not None and not entry.get('auth') and not entry.get('identitytoken')
+                  and settings.get('credsStore')):
+        raise AuthUnavailable('credentials for %s are kept by docker-credential-%s'
+                              % (registry, helper or settings['credsStore']))
+    if not entry:
+        return None
+    address = DOCKER_HUB if registry == 'index.docker.io' else registry
+    if entry.get('identitytoken'):
+        auth = {'identitytoken': entry['identitytoken'], 'serveraddress': address}
+    elif entry.get('auth'):
+        username, _, password = base64.b64decode(entry['auth']).decode('utf-8').partition(':')
+        auth = {'username': username, 'password': password, 'serveraddress': address}
+    else:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(auth).encode('utf-8')).decode('ascii')
+
+
+class EngineClient(object):
+    """
+    :param str path: the daemon socket, see socket_path
+    :param str version: API version prefix for every request
+    :param float timeout: seconds allowed for a request, not counting attach and wait
+    :param str docker_config: docker config holding registry credentials, see registry_auth
+    """
+    def __init__(self, path=None, version='v1.41', timeout=60, docker_config=None):
+        self.path = socket_path(path)
+        self.version = version
+        self.timeout = timeout
+        self.docker_config = docker_config
+        self.connections = 0
+        self._local = threading.local()
+        self._open = []
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn.sock is not None and _closed(conn.sock):
+            self._drop()
+            conn = None
+        if conn is None:
+            conn = _UnixConnection(self.path, self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._open.append(conn)
+                self.connections += 1
+        return conn
+
+    def _drop(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+            with self._lock:
+                self._open.remove(conn)
+
+    def _url(self, path, query=None):
+        return '/%s%s%s' % (self.version, path, '?' + urlencode(query) if query else '')
+
+    def request(self, method, path, body=None, query=None, blocking=False):
+        """
+        Sends a request over this thread's connection, reconnecting first if the daemon has closed it while idle.
+        If a reused connection is dropped before the answer arrives anyway, the request is sent once more only when
+        it never left or repeating it is harmless; a container create or start is not repeated.
+        :param str method:
+        :param str path: e.g. /containers/create
+        :param dict body: sent as JSON
+        :param dict query:
+        :param bool blocking: wait for the answer however long it takes, e.g. for a container to exit
+        :return: the decoded JSON response, or None if it had no body
+        :raises EngineError:
+        """
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if data is not None else {}
+        for attempt in (1, 2):
+            conn = self._connection()
+            reused, sent = conn.sock is not None, False
+            try:
+                conn.request(method, self._url(path, query), data, headers)
+                sent = True
+                if conn.sock is not None:
+                    conn.sock.settimeout(None if blocking else self.timeout)
+                response = conn.getresponse()
+                payload = response.read()
+                break
+            except (http_client.HTTPException, socket.error) as e:
+                self._drop()
+                dropped = isinstance(e, (http_client.RemoteDisconnected, BrokenPipeError, ConnectionResetError))
+                if not (attempt == 1 and reused and dropped and (not sent or method in IDEMPOTENT)):
+                    raise EngineError('%s %s failed: %s' % (method, path, e))
+        if response.status >= 400:
+            try:
+                message = json.loads(payload.decode('utf-8')).get('message')
+            except ValueError:
+                message = payload.decode('utf-8', 'replace')
+            raise EngineError('%s %s returned %s: %s' % (method, path, response.status, message), response.status)
+        if not payload:
+            return None
+        return json.loads(payload.decode('utf-8'))
+
+    def create(self, image, cmd, binds=(), entrypoint=None):
+        """
+        :param str image: image:label
+        :param list cmd: command and arguments
+        :param list binds: volumes as host:container[:options]
+        :param list entrypoint: replaces the image's entrypoint if given
+        :return str: container id
+        """
+        config = {'Image': image, 'Cmd': list(cmd) or None, 'AttachStdout': True, 'AttachStderr': True,
+                  'HostConfig': {'Binds': list(binds)}}
+        if entrypoint is not None:
+            config['Entrypoint'] = list(entrypoint)
+        return self.request('POST', '/containers/create', config)['Id']
+
+    def attach(self, container):
+        """
+        Opens the container's output stream; attach before start so nothing is missed
+        :param str container:
+        :return: iterator of (STDOUT or STDERR, bytes) ending when the container exits
+        """
+        conn = _UnixConnection(self.path, self.timeout)
+        try:
+            conn.request('POST', self._url('/containers/%s/attach' % quote(container),
+                                           {'stream': 1, 'stdout': 1, 'stderr': 1, 'logs': 1}))
+            # the stream stays open as long as the container runs
+            conn.sock.settimeout(None)
+            response = conn.getresponse()
+        except (http_client.HTTPException, socket.error) as e:
+            conn.close()
+            raise EngineError('attach to %s failed: %s' % (container, e))
+        if response.status >= 400:
+            response.close()
+            conn.close()
+            raise EngineError('attach to %s returned %s' % (container, response.status), response.status)
+        return _frames(response, conn)
+
+    def start(self, container):
+        self.request('POST', '/containers/%s/start' % quote(container))
+
+    def wait(self, container):
+        """
+        :return int: the container's exit code
+        """
+        result = self.request('POST', '/containers/%s/wait' % quote(container), blocking=True)
+        if result.get('Error') and result['Error'].get('Message'):
+            raise EngineError('waiting for %s failed: %s' % (container, result['Error']['Message']))
+        return result['StatusCode']
+
+    def remove(self, container):
+        self.request('DELETE', '/containers/%s' % quote(container), query={'force': 1, 'v': 1})
+
+    def inspect_image(self, image):
+        """
+        :param str image: image:label
+        :return str: the local image id, or None if the image is not on the agent
+        """
+        try:
+            return self.request('GET', '/images/%s/json' % quote(image, safe='/:'))['Id']
+        except EngineError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def pull(self, image):
+        """
+        Pulls image:label with the registry credentials in the docker config, if it has any
+        :raises AuthUnavailable: if only the docker CLI can read the credentials
+        :raises EngineError: if the daemon reports a failure, possibly part way through
+        """
+        name, tag = _split(image)
+        auth = registry_auth(image, self.docker_config)
+        conn = _UnixConnection(self.path, None)
+        try:
+            conn.request('POST', self._url('/images/create', {'fromImage': name, 'tag': tag}),
+                         headers={'X-Registry-Auth': auth} if auth else {})
+            response = conn.getresponse()
+            progress = response.read().decode('utf-8', 'replace')
+        except (http_client.HTTPException, socket.error) as e:
+            raise EngineError('pull of %s failed: %s' % (image, e))
+        finally:
+            conn.close()
+        if response.status >= 400:
+            raise EngineError('pull of %s returned %s: %s' % (image, response.status, progress.strip()),
+                              response.status)
+        for line in progress.splitlines():
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get('error'):
+                raise EngineError('pull of %s failed: %s' % (image, message['error']))
+
+    def run(self, image, cmd, binds=(), output=None):
+        """
+        Runs a container to completion and removes it
+        :param str image: image:label
+        :param list cmd: command and arguments
+        :param list binds: volumes as host:container[:options]
+        :param output: callable(stream, bytes) given the container's output as it arrives
+        :return int: the container's exit code
+        """
+        container = self.create(image, cmd, binds)
+        try:
+            frames = self.attach(container)
+            try:
+                self.start(container)
+                for stream, data in frames:
+                    if output is not None:
+                        output(stream, data)
+            finally:
+                frames.close()
+            return self.wait(container)
+        finally:
+            try:
+                self.remove(container)
+            except EngineError as e:
+                logger.warning("Unable to remove container %s: %s" % (container, e))
+
+    def close(self):
+        """
+        Closes every thread's connection
+        """
+        with self._lock:
+            connections, self._open = self._open, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _closed(sock):
+    """
+    :return bool: True if the daemon has closed an idle connection, or sent something unasked, so it cannot be reused
+    """
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+        return True
+    except BlockingIOError:
+        return False
+    except socket.error:
+        return True
+    finally:
+        sock.settimeout(timeout)
+
+
+def _read_exactly(response, size):
+    data = b''
+    while len(data) < size:
+        chunk = response.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _frames(response, conn):
+    """
+    Splits the multiplexed attach stream into (stream, bytes): an 8 byte header of stream id, three zero bytes and
+    a big-endian length, then the payload
+    """
+    try:
+        while True:
+            header = _read_exactly(response, 8)
+            if header is None:
+                return
+            stream, length = struct.unpack('>BxxxL', header)
+            data = _read_exactly(response, length)
+            if data is None:
+                return
+            yield stream, data
+    finally:
+        response.close()
+        conn.close()
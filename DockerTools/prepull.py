@@ -0,0 +1,158 @@
+import os
+import time
+import logging
+import threading
+import subprocess
+from JenkinsTools import ContextExecutor
+from JenkinsTools.metrics import span
+
+"""
+Pulls the images a build needs before its steps ask for them.
+Every distinct image:label in the config is looked up with docker image inspect; images already on the agent are
+pinned to their id straight away, and missing ones are pulled a few at a time in the background. BuildScheduler only
+holds back the steps whose image is still being pulled, so steps with local images start at once instead of waiting
+behind a serial pull inside docker run.
+
+"""
+
+logger = logging.getLogger('DockerTools')
+
+__all__ = ['ImagePuller', 'PullError']
+
+
+class PullError(Exception):
+    """
+    docker pull failed, or the image was still missing afterwards
+    """
+
+
+class ImagePuller(object):
+    """
+    :param str docker: docker executable
+    :param int concurrency: pulls running at once
+    :param EngineClient engine: look up and pull images through the Docker Engine API rather than the docker command
+    """
+    def __init__(self, docker='docker', concurrency=3, engine=None):
+        self.docker = docker
+        self.engine = engine
+        self.concurrency = max(1, int(concurrency))
+        self.digests = {}
+        self.pull_times = {}
+        self.pulls = {}
+        self.pull_started = None
+        self.pull_finished = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _docker(self, sudoit, args):
+        argv = ([self.docker] + args) if not sudoit else (['sudo', self.docker] + args)
+        my_env = os.environ.copy()
+        my_env['PATH'] = '/usr/bin:' + my_env['PATH']
+        return subprocess.run(argv, env=my_env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def inspect(self, image, sudoit=False):
+        """
+        :param str image: image:label
+        :return str: the local image id, or None if the image is not on the agent
+        """
+        if self.engine is not None:
+            from DockerTools.engine import EngineError
+            try:
+                return self.engine.inspect_image(image)
+            except EngineError as e:
+                logger.warning("Unable to inspect image %s: %s" % (image, e))
+                return None
+        try:
+            done = self._docker(sudoit, ['image', 'inspect', '--format', '{{.Id}}', image])
+        except OSError as e:
+            logger.warning("Unable to inspect image %s: %s" % (image, e))
+            return None
+        if done.returncode != 0:
+            return None
+        return done.stdout.decode().strip() or None
+
+    def _pull(self, image, sudoit):
+        start = time.time()
+        with span('docker.pull', image=image):
+            logger.info("Pulling %s" % image)
+            pulled = False
+            if self.engine is not None:
+                from DockerTools.engine import EngineError, AuthUnavailable
+                try:
+                    self.engine.pull(image)
+                    pulled = True
+                except AuthUnavailable as e:
+                    logger.info("Pulling %s with the docker CLI: %s" % (image, e))
+                except EngineError as e:
+                    raise PullError(str(e))
+            if not pulled:
+                done = self._docker(sudoit, ['pull', '--quiet', image])
+                if done.returncode != 0:
+                    error = done.stderr.decode('utf-8', 'replace').strip()
+                    raise PullError("docker pull %s failed: %s" % (image, error))
+            digest = self.inspect(image, sudoit)
+            if digest is None:
+                raise PullError("%s is still missing after docker pull" % image)
+        with self._lock:
+            self.digests[image] = digest
+            self.pull_finished = time.time()
+            self.pull_times[image] = self.pull_finished - start
+        logger.info("Pulled %s (%s) in %.2fs" % (image, digest, self.pull_times[image]))
+        return digest
+
+    def start(self, commands):
+        """
+        Resolves every image the steps use and starts pulling the missing ones
+        :param list commands: command dicts from BuildConf.build_command_list
+        :return dict: image:label -> Future for each image being pulled
+        """
+        images = {}
+        for command in commands:
+            if not command.get('image'):
+                continue
+            image = '%s:%s' % (command['image'], command.get('label', 'latest'))
+            images[image] = images.get(image, False) or bool(command.get('sudoit'))
+        for image, sudoit in sorted(images.items()):
+            digest = self.inspect(image, sudoit)
+            if digest is not None:
+                self.digests[image] = digest
+                logger.debug("%s is present (%s)" % (image, digest))
+                continue
+            if self._pool is None:
+                self._pool = ContextExecutor(max_workers=self.concurrency, thread_name_prefix='pull')
+                self.pull_started = time.time()
+            self.pulls[image] = self._pool.submit(self._pull, image, sudoit)
+        return dict(self.pulls)
+
+    def waiting_for(self, commands):
+        """
+        :param list commands: command dicts
+        :return dict: step name -> Future of the pull it has to wait for, for the steps whose image is being pulled
+        """
+        waits = {}
+        for command in commands:
+            future = self.pulls.get('%s:%s' % (command.get('image'), command.get('label', 'latest')))
+            if future is not None:
+                waits[command['name']] = future
+        return waits
+
+    def close(self):
+        """
+        Waits for any pulls still running
+        """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def report(self):
+        """
+        Logs how long the pulls took, wall clock and per image, separately from the build steps
+        """
+        failed = [image for image, future in sorted(self.pulls.items())
+                  if future.done() and future.exception() is not None]
+        if self.pull_times:
+            logger.info("Pulled %d image(s) in %.2fs (%s)" % (
+                len(self.pull_times), self.pull_finished - self.pull_started,
+                ', '.join('%s %.2fs' % (image, seconds) for image, seconds in sorted(self.pull_times.items()))))
+        for image in failed:
+            logger.error("Pull of %s failed: %s" % (image, self.pulls[image].exception()))
@@ -0,0 +1,190 @@
+import time
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+from JenkinsTools import ContextExecutor
+
+"""
+Runs BuildConf steps as a dependency graph on a pool of workers.
+Each step waits only for the steps it depends on, so independent containers run at the same time.
+When a step fails, everything that depends on it (directly or not) is skipped.
+
+"""
+
+logger = logging.getLogger('DockerTools')
+
+__all__ = ['BuildScheduler', 'StepResult', 'resolve_dependencies']
+
+
+class StepResult(object):
+    """
+    Outcome of one build step
+    """
+    PENDING = 'pending'
+    OK = 'ok'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name, depends_on):
+        self.name = name
+        self.depends_on = list(depends_on)
+        self.status = StepResult.PENDING
+        self.returncode = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def elapsed(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def __repr__(self):
+        return '<StepResult %s %s>' % (self.name, self.status)
+
+
+def resolve_dependencies(commands):
+    """
+    Works out what each step waits for. A step's depends_on (a name or list of names) is used if given,
+    otherwise it depends on every step with a lower order, so configs without depends_on run as before.
+    :param list commands: command dicts from BuildConf.build_command_list
+    :return dict: step name -> list of step names it depends on
+    :raises ValueError: on unknown step names or dependency cycles
+    """
+    names = [c['name'] for c in commands]
+    graph = {}
+    for command in commands:
+        depends_on = command.get('depends_on')
+        if depends_on is None:
+            depends_on = [c['name'] for c in commands if c.get('order', 0) < command.get('order', 0)]
+        elif isinstance(depends_on, str):
+            depends_on = [depends_on]
+        for dependency in depends_on:
+            if dependency not in names:
+                raise ValueError("Step %s depends on unknown step %s" % (command['name'], dependency))
+        graph[command['name']] = list(depends_on)
+
+    visiting, done = set(), set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError("Dependency cycle: %s" % ' -> '.join(path + [name]))
+        visiting.add(name)
+        for dependency in graph[name]:
+            visit(dependency, path + [name])
+        visiting.discard(name)
+        done.add(name)
+
+    for name in names:
+        visit(name, [])
+    return graph
+
+
+class BuildScheduler(object):
+    """
+    :param list commands: command dicts from BuildConf.build_command_list
+    :param run_step: callable(command) running one step and returning its exit code
+    :param int workers: maximum steps running at once
+    :param dict waits: step name -> Future the step also waits for, e.g. the pull of its image; if the future fails
+                       the step fails with its exception
+    """
+    def __init__(self, commands, run_step, workers=4, waits=None):
+        self.commands = dict((c['name'], c) for c in commands)
+        self.order = [c['name'] for c in commands]
+        self.graph = resolve_dependencies(commands)
+        self.run_step = run_step
+        self.workers = max(1, int(workers))
+        self.results = dict((name, StepResult(name, self.graph[name])) for name in self.order)
+        self.waits = dict(waits or {})
+        self._lock = threading.Lock()
+
+    def _execute(self, name):
+        result = self.results[name]
+        result.start = time.time()
+        try:
+            result.returncode = self.run_step(self.commands[name])
+            result.status = StepResult.OK if not result.returncode else StepResult.FAILED
+        except BaseException as e:
+            result.status = StepResult.FAILED
+            result.error = '%s: %s' % (e.__class__.__name__, e)
+        result.end = time.time()
+        if result.status == StepResult.FAILED:
+            logger.error("Step %s failed (exit code %s%s)" %
+                         (name, result.returncode, ', %s' % result.error if result.error else ''))
+        else:
+            logger.info("Step %s completed in %.2fs" % (name, result.elapsed))
+        return name
+
+    def _skip_dependents(self, failed):
+        for name in self.order:
+            result = self.results[name]
+            if result.status == StepResult.PENDING and failed in self._ancestors(name):
+                result.status = StepResult.SKIPPED
+                result.error = 'depends on failed step %s' % failed
+                logger.warning("Skipping step %s, it depends on failed step %s" % (name, failed))
+
+    def _ancestors(self, name):
+        seen = set()
+        stack = list(self.graph[name])
+        while stack:
+            dependency = stack.pop()
+            if dependency not in seen:
+                seen.add(dependency)
+                stack.extend(self.graph[dependency])
+        return seen
+
+    def run(self):
+        """
+        Runs every step once its dependencies have succeeded
+        :return list: StepResult for each step, in config order
+        """
+        running = {}
+        with ContextExecutor(max_workers=self.workers) as pool:
+            while True:
+                for name in self.order:
+                    result = self.results[name]
+                    if result.status != StepResult.PENDING or name in running.values():
+                        continue
+                    if not all(self.results[d].status == StepResult.OK for d in self.graph[name]):
+                        continue
+                    waiting = self.waits.get(name)
+                    if waiting is not None and not waiting.done():
+                        continue
+                    if waiting is not None and waiting.exception() is not None:
+                        result.status = StepResult.FAILED
+                        result.error = str(waiting.exception())
+                        logger.error("Step %s failed: %s" % (name, result.error))
+                        self._skip_dependents(name)
+                        continue
+                    running[pool.submit(self._execute, name)] = name
+                pending = [self.waits[name] for name in self.order if self.results[name].status ==
+                           StepResult.PENDING and name in self.waits and not self.waits[name].done()]
+                if not running and not pending:
+                    break
+                finished, _ = wait(list(running) + pending, return_when=FIRST_COMPLETED)
+                finished = [f for f in finished if f in running]
+                for future in finished:
+                    name = running.pop(future)
+                    if self.results[name].status == StepResult.FAILED:
+                        self._skip_dependents(name)
+        return [self.results[name] for name in self.order]
+
+    def critical_path(self):
+        """
+        The chain of dependent steps that took longest, i.e. the one that set the total build time
+        :return tuple: (list of step names, seconds)
+        """
+        best = {}
+
+        def longest(name):
+            if name not in best:
+                chains = [longest(d) for d in self.graph[name]]
+                path, seconds = max(chains, key=lambda c: c[1]) if chains else ([], 0.0)
+                best[name] = (path + [name], seconds + self.results[name].elapsed)
+            return best[name]
+
+        chains = [longest(name) for name in self.order]
+        return max(chains, key=lambda c: c[1]) if chains else ([], 0.0)
@@ -0,0 +1,173 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+
+"""
+Skips build steps whose inputs have not changed since they last succeeded.
+A step declares its inputs as file globs relative to its volume; these are hashed together with the image id,
+label and command into a key. When a step succeeds its declared outputs are copied under <cache_dir>/<key>,
+and the next time the key comes up the outputs are restored from there instead of running the step.
+File hashes are remembered by size and mtime so unchanged trees are not read again.
+
+"""
+
+logger = logging.getLogger('DockerTools')
+
+__all__ = ['StepCache']
+
+
+class StepCache(object):
+    """
+    :param str directory: where step outputs and the file hash index are kept
+    :param str docker: docker executable used to look up image ids
+    """
+    def __init__(self, directory, docker='docker'):
+        self.directory = os.path.expanduser(directory)
+        self.docker = docker
+        self.stats = {'hits': 0, 'misses': 0}
+        self._images = {}
+        self._lock = threading.Lock()
+        self._hashes_path = os.path.join(self.directory, 'hashes.json')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        try:
+            with open(self._hashes_path) as f:
+                self._hashes = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._hashes = {}
+
+    def image_id(self, image, label, sudoit=False):
+        """
+        :return str: the local id of image:label, so a re-tagged image invalidates its steps
+        """
+        name = '%s:%s' % (image, label)
+        with self._lock:
+            if name not in self._images:
+                argv = ['sudo', self.docker] if sudoit else [self.docker]
+                my_env = os.environ.copy()
+                my_env['PATH'] = '/usr/bin:' + my_env['PATH']
+                try:
+                    self._images[name] = subprocess.check_output(
+                        argv + ['image', 'inspect', '--format', '{{.Id}}', name], env=my_env).decode().strip()
+                except (OSError, subprocess.CalledProcessError) as e:
+                    logger.warning("Unable to inspect image %s, caching on its name only: %s" % (name, e))
+                    self._images[name] = name
+            return self._images[name]
+
+    def _file_hash(self, path):
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            known = self._hashes.get(path)
+        if known and known[:2] == stamp:
+            return known[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                h.update(chunk)
+        with self._lock:
+            self._hashes[path] = stamp + [h.hexdigest()]
+        return h.hexdigest()
+
+    @staticmethod
+    def _root(cmd):
+        return os.path.abspath(os.path.expanduser(cmd.get('volume') or './'))
+
+    def key(self, cmd):
+        """
+        Hashes a step's command, image and input files
+        :param dict cmd: command dict from BuildConf.build_command_list, with inputs
+        :return str: cache key
+        """
+        root = self._root(cmd)
+        label = str(cmd.get('label', 'latest'))
+        h = hashlib.sha256()
+        for part in (cmd.get('command', ''), cmd['image'], label,
+                     self.image_id(cmd['image'], label, cmd.get('sudoit'))):
+            h.update(part.encode() + b'\0')
+        outputs = [os.path.join(root, o).rstrip('/') for o in cmd.get('outputs') or []]
+        files = set()
+        for pattern in cmd['inputs']:
+            for path in glob.glob(os.path.join(root, pattern), recursive=True):
+                if os.path.isdir(path):
+                    for dirpath, dirnames, filenames in os.walk(path):
+                        files.update(os.path.join(dirpath, f) for f in filenames)
+                else:
+                    files.add(path)
+        for path in sorted(files):
+            if any(path == o or path.startswith(o + os.sep) for o in outputs):
+                continue
+            if os.path.isfile(path):
+                h.update(os.path.relpath(path, root).encode() + b'\0' + self._file_hash(path).encode() + b'\0')
+        self.save_hashes()
+        return h.hexdigest()
+
+    def restore(self, key, cmd):
+        """
+        Puts the outputs stored for key back in the step's volume
+        :return bool: False if there is no successful run recorded for key
+        """
+        entry = os.path.join(self.directory, key)
+        if not os.path.exists(os.path.join(entry, 'step.json')):
+            self.stats['misses'] += 1
+            return False
+        root = self._root(cmd)
+        for output in cmd.get('outputs') or []:
+            stored = os.path.join(entry, 'outputs', output)
+            target = os.path.join(root, output)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                os.remove(target)
+            if os.path.isdir(stored):
+                shutil.copytree(stored, target, symlinks=True)
+            elif os.path.lexists(stored):
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                shutil.copy2(stored, target)
+        self.stats['hits'] += 1
+        return True
+
+    def store(self, key, cmd):
+        """
+        Records a successful run of a step along with copies of its outputs
+        """
+        entry = os.path.join(self.directory, key)
+        if os.path.exists(entry):
+            return
+        tmp = tempfile.mkdtemp(prefix='.%s-' % key, dir=self.directory)
+        try:
+            root = self._root(cmd)
+            for output in cmd.get('outputs') or []:
+                source = os.path.join(root, output)
+                stored = os.path.join(tmp, 'outputs', output)
+                if os.path.isdir(source):
+                    shutil.copytree(source, stored, symlinks=True)
+                elif os.path.lexists(source):
+                    if not os.path.isdir(os.path.dirname(stored)):
+                        os.makedirs(os.path.dirname(stored))
+                    shutil.copy2(source, stored)
+                else:
+                    logger.warning("[%s] declared output %s was not produced" % (cmd['name'], output))
+            with open(os.path.join(tmp, 'step.json'), 'w') as f:
+                json.dump({'name': cmd['name'], 'command': cmd.get('command', ''),
+                           'outputs': cmd.get('outputs') or []}, f)
+            os.rename(tmp, entry)
+        except OSError as e:
+            logger.warning("[%s] unable to cache step outputs: %s" % (cmd['name'], e))
+        finally:
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+
+    def save_hashes(self):
+        with self._lock:
+            tmp = '%s.%d.tmp' % (self._hashes_path, threading.get_ident())
+            with open(tmp, 'w') as f:
+                json.dump(self._hashes, f)
+            os.rename(tmp, self._hashes_path)
@@ -0,0 +1,106 @@
+import os
+import time
+import logging
+import threading
+import subprocess
+
+"""
+Long-lived build containers.
+Rather than a fresh docker run per step, one container is started for each (image, label, volume, sudo) combination
+with its entrypoint replaced by an idle process, and each step is run in it with docker exec.
+Steps therefore run without the image's entrypoint, in the container's working directory.
+
+"""
+
+logger = logging.getLogger('DockerTools')
+
+__all__ = ['ContainerPool']
+
+
+class ContainerPool(object):
+    """
+    Starts containers on first use and removes them all on close
+    :param str docker: docker executable
+    """
+    def __init__(self, docker='docker'):
+        self.docker = docker
+        self.containers = {}
+        self.start_times = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(builder):
+        return builder.image, builder.label, builder.volume, bool(builder.sudoit)
+
+    def _docker(self, sudoit, args):
+        argv = ([self.docker] + args) if not sudoit else (['sudo', self.docker] + args)
+        my_env = os.environ.copy()
+        my_env['PATH'] = '/usr/bin:' + my_env['PATH']
+        return subprocess.check_output(argv, env=my_env).decode().strip()
+
+    def container_for(self, builder):
+        """
+        Returns the id of the warm container for a DockerBuilder's image, label, volume and sudo setting,
+        starting it if this is the first step to need it
+        :param DockerBuilder builder:
+        :return str: container id
+        """
+        key = self.key(builder)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.containers:
+                start = time.time()
+                logger.info("Starting warm container for %s:%s with volume %s" % (builder.image, builder.label,
+                                                                                 builder.volume))
+                self.containers[key] = self._docker(builder.sudoit, ['run', '-d', '--rm', '-v', builder.volume,
+                                                                     '--entrypoint', 'tail',
+                                                                     '%s:%s' % (builder.image, builder.label),
+                                                                     '-f', '/dev/null'])
+                self.start_times[key] = time.time() - start
+            return self.containers[key]
+
+    def close(self):
+        """
+        Removes every container started by the pool
+        """
+        with self._lock:
+            containers = list(self.containers.items())
+            self.containers = {}
+        for key, container in containers:
+            try:
+                self._docker(key[3], ['rm', '-f', container])
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning("Unable to remove container %s: %s" % (container, e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def measure_overhead(builder, runs=3, docker='docker'):
+    """
+    Times a no-op step both as a fresh docker run and as a docker exec in a warm container,
+    showing the per-step overhead each mode adds
+    :param DockerBuilder builder: supplies the image, label, volume and sudo setting
+    :param int runs: repetitions averaged for each mode
+    :return dict: mean seconds for 'run' and 'exec', plus the one-off 'start' of the warm container
+    """
+    prefix = ['sudo', docker] if builder.sudoit else [docker]
+    image = '%s:%s' % (builder.image, builder.label)
+    timings = {}
+    start = time.time()
+    for i in range(runs):
+        subprocess.check_call(prefix + ['run', '--rm', '-v', builder.volume, '--entrypoint', 'true', image])
+    timings['run'] = (time.time() - start) / runs
+    with ContainerPool(docker) as pool:
+        container = pool.container_for(builder)
+        timings['start'] = pool.start_times[pool.key(builder)]
+        start = time.time()
+        for i in range(runs):
+            subprocess.check_call(prefix + ['exec', container, 'true'])
+        timings['exec'] = (time.time() - start) / runs
+    return timings
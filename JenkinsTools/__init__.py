@@ -0,0 +1,122 @@
+import os
+import sys
+import copy
+import logging
+import importlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+JenkinsTools module - helpers shared by the other packages and the jenkins-tools command line.
+Only the standard library is imported here, so the packages can use these without adding to their import time.
+
+"""
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+__all__ = ['lazy_import', 'load_yaml', 'load_yaml_file', 'configure_logging', 'ContextExecutor', 'LOG_FORMAT']
+
+
+class _LazyModule(object):
+    """
+    Stands in for a module until one of its attributes is first used, then imports it and takes over its namespace
+    so later lookups cost no more than on the module itself
+    """
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_lock'] = threading.Lock()
+
+    def __getattr__(self, attr):
+        with self._lazy_lock:
+            if '_lazy_module' not in self.__dict__:
+                module = importlib.import_module(self._lazy_name)
+                self.__dict__.update(module.__dict__)
+                self.__dict__['_lazy_module'] = module
+        # submodules imported after the first use are not in the copied namespace
+        return getattr(self._lazy_module, attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._lazy_name
+
+
+def lazy_import(name):
+    """
+    Defers importing a module until it is used, for heavy dependencies (pycurl, paramiko, yaml) that only some code
+    paths need. Returns the module itself if something has already imported it.
+    :param str name: module name, as for import
+    :return: the module, or a stand-in that imports it on first attribute access
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return _LazyModule(name)
+
+
+yaml = lazy_import('yaml')
+
+
+class ContextExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor running each call in a copy of the submitting thread's context variables, as asyncio does for
+    its callbacks, so the deploy daemon can tell which job the work, and the records it logs, belong to
+    """
+    def submit(self, fn, *args, **kwargs):
+        return ThreadPoolExecutor.submit(self, contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def load_yaml(stream):
+    """
+    yaml.safe_load, using libyaml's CSafeLoader when PyYAML was built with it
+    :param stream: open file or string
+    :return: the loaded document
+    """
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+_config_cache = {}
+_config_lock = threading.Lock()
+config_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def load_yaml_file(path):
+    """
+    Loads a yaml config file, reusing the parsed document while the file's size and mtime are unchanged, which pays
+    off in long-running processes such as the deploy daemon. Each caller gets its own copy to modify.
+    :param str path:
+    :return: the loaded document
+    :raises IOError: if the file cannot be read
+    """
+    path = os.path.abspath(path)
+    with open(path) as f:
+        st = os.fstat(f.fileno())
+        stamp = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with _config_lock:
+            cached = _config_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            config_cache_stats['hits'] += 1
+            return copy.deepcopy(cached[1])
+        document = load_yaml(f)
+    config_cache_stats['misses'] += 1
+    with _config_lock:
+        _config_cache[path] = (stamp, document)
+    return copy.deepcopy(document)
+
+
+def configure_logging(level=None):
+    """
+    Sends log records to stderr in the format the tools have always used, with credentials masked. The packages
+    attach no handlers of their own, so this is for entry points only; calling it again reuses the handler.
+    :param level: lowest level written, e.g. logging.INFO or 'INFO'; every package logger's own level if not given
+    :return logging.Handler:
+    """
+    root = logging.getLogger()
+    handler = next((h for h in root.handlers if getattr(h, '_jenkins_tools', False)), None)
+    if handler is None:
+        from JenkinsTools.metrics import RedactingFilter
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handler.addFilter(RedactingFilter())
+        handler._jenkins_tools = True
+        root.addHandler(handler)
+    handler.setLevel(level or logging.NOTSET)
+    return handler
@@ -0,0 +1,4 @@
+import sys
+from JenkinsTools.cli import main
+
+sys.exit(main())
@@ -0,0 +1,179 @@
+import os
+import sys
+import signal
+import logging
+import argparse
+import threading
+from JenkinsTools import configure_logging, metrics
+
+"""
+jenkins-tools - one command line for the deploy-artifact, docker-runner and service-manager jobs.
+Only the package for the chosen subcommand is imported, and each package imports pycurl, paramiko and yaml on first
+use, so a download job never loads paramiko and --help loads none of them.
+
+    jenkins-tools deploy-artifact --config deploy-artifact.yml
+    jenkins-tools docker-runner --workers 8 --warm
+    jenkins-tools service-manager --config service-config.yml --action restart
+
+With --socket (or JENKINS_TOOLS_SOCKET) the job is handed to a running jenkins-tools daemon, see JenkinsTools.daemon,
+and runs here as before if there is none.
+--metrics-jsonl and --metrics-prom record how long each transfer, handshake, service command and build step took,
+see JenkinsTools.metrics. For the daemon they are given when it is started and cover every job it runs.
+
+"""
+
+__all__ = ['main', 'build_parser']
+
+
+def deploy_artifact(args):
+    from ArtifactTools import ArtifactConfig, ArtifactDownloader, ArtifactUploader, run_jobs, logger
+    dc = ArtifactConfig(args.config)
+    if isinstance(dc.config.get('download'), list) or isinstance(dc.config.get('upload'), list) or \
+            'relay' in dc.config:
+        outcomes = run_jobs(dc)
+        for job_type, artifact, ok, error in outcomes:
+            logger.info("%s %s: %s" % (job_type, artifact, 'OK' if ok else 'FAILED - %s' % error))
+        return 0 if all(ok for job_type, artifact, ok, error in outcomes) else 1
+    if 'download' in dc.config:
+        ad = ArtifactDownloader(dc.config, 'download')
+        ad.download()
+        if ad.failures:
+            return 1
+        if ad.algorithms:
+            ad.download(ArtifactDownloader.CHECKSUM)
+            if not ad.check_checksum():
+                return 1
+    if 'upload' in dc.config:
+        au = ArtifactUploader(dc.config, 'upload')
+        au.upload()
+        if au.failures:
+            return 1
+    return 0
+
+
+def docker_runner(args):
+    from DockerTools import BuildConf
+    bc = BuildConf(args.config, args.workers, args.warm, cache_dir=args.cache, pulls=args.pulls,
+                   backend=args.backend, docker_host=args.docker_host)
+    bc.build_command_list()
+    if args.timing:
+        bc.measure_overhead()
+    if not bc.run_commands():
+        return bc.exit_code()
+    return 0
+
+
+def service_manager(args):
+    from ServiceTools import (ServiceConfig, BasicSysVTemplate, BasicSysDTemplate, deploy_service, rolling_restart,
+                              make_probe, format_results, logger)
+    sc = ServiceConfig(args.config)
+    if sc.conf['system'] == 'sysv':
+        template = BasicSysVTemplate()
+    elif sc.conf['system'] == 'systemd':
+        template = BasicSysDTemplate()
+    else:
+        logger.fatal("FATAL: Unknown system %s in %s" % (sc.conf['system'], args.config))
+        return 2
+
+    if sc.readiness is not None:
+        results = deploy_service(sc, template.template, None, args.identity_file)
+        results = rolling_restart(sc, make_probe(sc, sc.render(template.template)), args.action, results=results,
+                                  identity_file=args.identity_file)
+    else:
+        results = deploy_service(sc, template.template, args.action, args.identity_file)
+    logger.info("Deployment results:\n%s" % format_results(results))
+    return 0 if all(r.ok for r in results) else 1
+
+
+def run_daemon(args):
+    from JenkinsTools.daemon import DeployDaemon
+    daemon = DeployDaemon(args.socket or os.path.expanduser('~/.jenkins-tools.sock'), args.workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=daemon.server.shutdown).start())
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+    return 0
+
+
+def build_parser():
+    """
+    :return argparse.ArgumentParser: the jenkins-tools parser with a subcommand per tool
+    """
+    parser = argparse.ArgumentParser(prog='jenkins-tools', description='Artifact, docker build and service jobs for '
+                                                                       'Jenkins')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='only log records at this level or above (default: every package\'s own level)')
+    parser.add_argument('--socket', default=os.environ.get('JENKINS_TOOLS_SOCKET'),
+                        help='run the job in the deploy daemon listening on this socket, if there is one '
+                             '(default: $JENKINS_TOOLS_SOCKET)')
+    parser.add_argument('--metrics-jsonl', metavar='FILE', default=os.environ.get('JENKINS_TOOLS_METRICS_JSONL'),
+                        help='append a JSON line per timed phase to FILE (default: $JENKINS_TOOLS_METRICS_JSONL)')
+    parser.add_argument('--metrics-prom', metavar='FILE', default=os.environ.get('JENKINS_TOOLS_METRICS_PROM'),
+                        help='write phase timings to FILE in the Prometheus textfile format when the job ends '
+                             '(default: $JENKINS_TOOLS_METRICS_PROM)')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    artifact = commands.add_parser('deploy-artifact', help='download, upload and relay artifacts')
+    artifact.add_argument('--config', default='artifact-deploy.yml', help='artifact config to load')
+    artifact.set_defaults(run=deploy_artifact)
+
+    docker = commands.add_parser('docker-runner', help='run the build steps in docker-runner.yml')
+    docker.add_argument('--config', default='docker-runner.yml', help='build config to load')
+    docker.add_argument('--workers', type=int, default=4, help='maximum steps running at once')
+    docker.add_argument('--warm', action='store_true',
+                        help='run steps with docker exec in one long-lived container per image, label and volume')
+    docker.add_argument('--timing', action='store_true',
+                        help='measure the per step overhead of docker run and docker exec before building')
+    docker.add_argument('--cache', metavar='DIR', help='skip steps whose declared inputs match a previous successful '
+                                                       'run, restoring their outputs')
+    docker.add_argument('--pulls', type=int, default=3, metavar='N',
+                        help='pull missing images N at a time while steps with local images run (0: leave pulling '
+                             'to docker run)')
+    docker.add_argument('--backend', choices=['cli', 'engine'], default='cli',
+                        help='run steps with the docker command, or through the Docker Engine API on its Unix '
+                             'socket with one open connection per worker (default: cli)')
+    docker.add_argument('--docker-host', metavar='SOCKET',
+                        help='engine socket for --backend engine (default: $DOCKER_HOST or /var/run/docker.sock)')
+    docker.set_defaults(run=docker_runner)
+
+    service = commands.add_parser('service-manager', help='push service units to hosts and restart them')
+    service.add_argument('--config', default='sample_configs/service-config.yml', help='service config to load')
+    service.add_argument('--identity-file', default='~/.ssh/jenkins_rsa', help='ssh key for the hosts')
+    service.add_argument('--action', default='restart', choices=['start', 'stop', 'restart'],
+                         help='service action once the unit is in place')
+    service.set_defaults(run=service_manager)
+
+    daemon = commands.add_parser('daemon', help='run jobs sent to --socket (default ~/.jenkins-tools.sock) with warm '
+                                                'connections and configs')
+    daemon.add_argument('--workers', type=int, default=4, help='jobs running at once')
+    daemon.set_defaults(run=run_daemon)
+    return parser
+
+
+def main(argv=None):
+    """
+    :param list argv: arguments after the program name, sys.argv[1:] if not given
+    :return int: exit status
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = build_parser().parse_args(argv)
+    configure_logging(args.log_level)
+    if args.socket and args.command != 'daemon':
+        from JenkinsTools.daemon import submit, DaemonUnavailable
+        try:
+            return submit(args.socket, argv)
+        except DaemonUnavailable as e:
+            logging.getLogger('JenkinsTools').warning("%s, running the job here" % e)
+    metrics.configure(args.metrics_jsonl, args.metrics_prom)
+    try:
+        return args.run(args)
+    finally:
+        metrics.flush()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
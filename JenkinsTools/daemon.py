@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import socket
+import logging
+import threading
+import contextvars
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from JenkinsTools import LOG_FORMAT, config_cache_stats
+from JenkinsTools import metrics
+
+"""
+Optional agent-side deploy daemon. jenkins-tools daemon listens on a Unix socket; jenkins-tools (and the old entry
+point scripts) with --socket or JENKINS_TOOLS_SOCKET set send their arguments and working directory to it instead
+of running the job themselves, and print the log lines it streams back. The daemon runs jobs on a shared pool of
+workers in one process, so the ssh transport pool, a process wide curl connection share and parsed configs stay
+warm from one Jenkins step to the next.
+
+The protocol is one JSON object per line. A client sends {"argv": [...], "cwd": "..."} and receives {"log": "..."}
+lines followed by {"exit": status}; {"status": true} returns counters instead.
+The working directory belongs to the process, so jobs from the same directory run side by side while a job from
+another directory waits for them to finish. Each job runs with its own context, which the packages' thread pools
+(JenkinsTools.ContextExecutor) hand on to their workers, so log records from a job's helper threads reach its caller
+too. Records logged outside any job, such as by paramiko's transport threads that jobs share, reach no caller.
+
+"""
+
+logger = logging.getLogger('JenkinsTools')
+logger.setLevel(logging.INFO)
+
+_current_job = contextvars.ContextVar('job', default=None)
+
+__all__ = ['DeployDaemon', 'submit', 'daemon_status', 'DaemonUnavailable']
+
+
+class DaemonUnavailable(IOError):
+    """
+    Nothing is listening on the daemon socket
+    """
+
+
+class _Job(object):
+    def __init__(self, argv, cwd, wfile):
+        self.argv = list(argv)
+        self.cwd = cwd
+        self.level = logging.NOTSET
+        self._wfile = wfile
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self._lock:
+            try:
+                self._wfile.write(data)
+                self._wfile.flush()
+            except (OSError, ValueError):
+                # the caller went away; the job carries on so the deploy is not left half done
+                pass
+
+
+class _JobLogHandler(logging.Handler):
+    """
+    Streams log records to the callers of the jobs that emitted them, found from the context the record is logged in
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.addFilter(metrics.RedactingFilter())
+
+    def emit(self, record):
+        job = _current_job.get()
+        if job is None or record.levelno < job.level:
+            return
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        job.send({'log': line})
+
+
+class _WorkdirGate(object):
+    """
+    Lets jobs sharing a working directory run together, switching directory once the running jobs are done.
+    A job waiting for another directory holds back new jobs for the current one, so it is not starved.
+    """
+    def __init__(self):
+        self.cwd = os.getcwd()
+        self.running = 0
+        self.waiting = {}
+        self._cond = threading.Condition()
+
+    def enter(self, cwd):
+        with self._cond:
+            self.waiting[cwd] = self.waiting.get(cwd, 0) + 1
+            while not (self.running == 0 or (cwd == self.cwd and not any(
+                    count for other, count in self.waiting.items() if other != cwd))):
+                self._cond.wait()
+            self.waiting[cwd] -= 1
+            if not self.waiting[cwd]:
+                del self.waiting[cwd]
+            if cwd != self.cwd:
+                os.chdir(cwd)
+                self.cwd = cwd
+            self.running += 1
+
+    def leave(self):
+        with self._cond:
+            self.running -= 1
+            self._cond.notify_all()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8') or 'null')
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            return self._reply({'error': 'bad request', 'exit': 2})
+        if request.get('status'):
+            return self._reply(self.server.daemon.status())
+        job = _Job(request.get('argv') or [], request.get('cwd') or os.getcwd(), self.wfile)
+        if not os.path.isdir(job.cwd):
+            return self._reply({'error': 'no such directory %s' % job.cwd, 'exit': 2})
+        job.send({'exit': self.server.daemon.jobs.submit(self.server.daemon.execute, job).result()})
+
+    def _reply(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class DeployDaemon(object):
+    """
+    Runs jenkins-tools jobs sent over a Unix socket with warm connection pools and config cache
+    :param str path: socket path, replaced if a stale socket is left behind
+    :param int workers: jobs running at once, further jobs queue
+    """
+    def __init__(self, path, workers=4):
+        self.path = path
+        self.workers = max(1, int(workers))
+        self.jobs = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        self.completed = 0
+        self.failed = 0
+        self._handler = _JobLogHandler()
+        self._gate = _WorkdirGate()
+        self._active = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                daemon_status(path)
+            except DaemonUnavailable:
+                os.remove(path)
+            else:
+                raise IOError('a daemon is already listening on %s' % path)
+        # created owner-only, so no other user can connect between the bind and a later chmod
+        umask = os.umask(0o177)
+        try:
+            self.server = _Server(path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+
+    def execute(self, job):
+        """
+        Runs one job in a worker thread
+        :return int: exit status
+        """
+        from JenkinsTools.cli import build_parser
+        from ArtifactTools.multi import keep_connections
+        keep_connections()
+        with self._lock:
+            self._active += 1
+        self._gate.enter(job.cwd)
+        token = _current_job.set(job)
+        status = 1
+        try:
+            args = build_parser().parse_args(job.argv)
+            if args.command == 'daemon':
+                raise ValueError('a daemon cannot run another daemon')
+            job.level = logging.getLevelName(args.log_level) if args.log_level else logging.NOTSET
+            status = args.run(args)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception as e:
+            logger.exception("Job %s failed: %s" % (' '.join(job.argv), e))
+            status = 1
+        finally:
+            _current_job.reset(token)
+            self._gate.leave()
+            metrics.flush()
+            with self._lock:
+                self._active -= 1
+                self.completed += 1
+                self.failed += 1 if status else 0
+        return status
+
+    def status(self):
+        """
+        :return dict: job counters and how much of the warm state has been reused
+        """
+        status = {'pid': os.getpid(), 'active': self._active, 'completed': self.completed, 'failed': self.failed,
+                  'workers': self.workers, 'config_cache': dict(config_cache_stats),
+                  'spans': sum(total['count'] for total in metrics.recorder.totals.values())}
+        if 'SSHTools' in sys.modules:
+            status['ssh'] = sys.modules['SSHTools'].get_pool().stats()
+        return status
+
+    def serve_forever(self):
+        logging.getLogger().addHandler(self._handler)
+        logger.info("Deploy daemon %d listening on %s with %d workers" % (os.getpid(), self.path, self.workers))
+        try:
+            self.server.serve_forever()
+        finally:
+            logging.getLogger().removeHandler(self._handler)
+
+    def close(self):
+        """
+        Stops accepting jobs, waits for running ones and removes the socket
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        self.jobs.shutdown(wait=True)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _connect(path, timeout=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except (OSError, socket.error) as e:
+        sock.close()
+        raise DaemonUnavailable('no deploy daemon on %s: %s' % (path, e))
+    return sock
+
+
+def daemon_status(path, timeout=5):
+    """
+    :param str path: daemon socket
+    :return dict: see DeployDaemon.status
+    :raises DaemonUnavailable:
+    """
+    with _connect(path, timeout) as sock:
+        sock.sendall(b'{"status": true}\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+
+
+def submit(path, argv, cwd=None, out=None):
+    """
+    Runs a jenkins-tools command line in the daemon, writing the log lines it streams back to out
+    :param str path: daemon socket
+    :param list argv: arguments after the program name
+    :param str cwd: working directory for the job, the current one if not given
+    :param out: text stream for the job's log, stderr if not given
+    :return int: the job's exit status
+    :raises DaemonUnavailable: if the daemon is not running; once the job is sent a lost connection is an IOError
+    """
+    out = out or sys.stderr
+    sock = _connect(path)
+    with sock, sock.makefile('rb') as f:
+        sock.sendall((json.dumps({'argv': list(argv), 'cwd': cwd or os.getcwd()}) + '\n').encode('utf-8'))
+        for line in f:
+            message = json.loads(line.decode('utf-8'))
+            if 'log' in message:
+                out.write(message['log'] + '\n')
+                out.flush()
+            if 'exit' in message:
+                if message.get('error'):
+                    out.write('deploy daemon: %s\n' % message['error'])
+                return message['exit']
+    raise IOError('deploy daemon on %s closed the connection before the job finished' % path)
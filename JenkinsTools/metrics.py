@@ -0,0 +1,315 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from JenkinsTools import lazy_import
+
+"""
+Timing spans for every phase of a deploy, exported as JSON lines and as a Prometheus textfile.
+Each span has a name (artifact.download, http.transfer, ssh.handshake, service.command, docker.step, ...), a few low
+cardinality labels (host, kind, step) that become Prometheus labels, and free form attributes (url, bytes, curl
+phase timings) that only go to the JSON lines. Spans are always aggregated in memory, which costs a dictionary update
+each; nothing is written unless configure() is given a path.
+
+Secrets never leave the process: attributes are passed through redact(), which masks url credentials, password /
+apikey / secret / token values, Authorization style headers and any value given to register_secret(). The same is
+applied to log records through RedactingFilter.
+
+"""
+
+logger = logging.getLogger('JenkinsTools')
+
+__all__ = ['span', 'record', 'record_curl', 'curl_info', 'configure', 'flush', 'redact', 'register_secret',
+           'RedactingFilter', 'recorder']
+
+pycurl = lazy_import('pycurl')
+
+MASK = '***'
+
+_URL_CREDENTIALS = re.compile(r'(\b[a-z][a-z0-9+.-]*://[^/\s:@]+:)[^/\s@]+@', re.I)
+_KEY_VALUE = re.compile(r'''(\b(?:password|passwd|pass|apikey|api_key|api-key|secret|secret_key|access_token|token)'''
+                        r'''['"]?\s*[:=]\s*['"]?)(?!None\b)[^'"\s,}&]+''', re.I)
+_HEADERS = re.compile(r'''(\b(?:authorization|proxy-authorization|x-jfrog-art-api|x-amz-security-token)\s*:\s*)'''
+                      r'''[^'"\n]+''', re.I)
+
+_secrets = set()
+
+
+def register_secret(value):
+    """
+    Masks every later occurrence of value in logs and metrics, e.g. a password read from a config
+    :param str value: ignored if empty or shorter than 4 characters
+    """
+    if value and len(str(value)) >= 4:
+        _secrets.add(str(value))
+
+
+def redact(text):
+    """
+    :param str text:
+    :return str: text with credentials masked
+    """
+    text = _URL_CREDENTIALS.sub(r'\1' + MASK + '@', text)
+    text = _KEY_VALUE.sub(r'\1' + MASK, text)
+    text = _HEADERS.sub(r'\1' + MASK, text)
+    for secret in _secrets:
+        if secret in text:
+            text = text.replace(secret, MASK)
+    return text
+
+
+class RedactingFilter(logging.Filter):
+    """
+    Masks credentials in the formatted message of every record passing through the handler it is added to
+    """
+    def filter(self, record):
+        try:
+            message = record.getMessage()
+        except Exception:
+            # left for the handler to report
+            return True
+        masked = redact(message)
+        if masked != message:
+            record.msg, record.args = masked, None
+        return True
+
+
+def _clean(value):
+    if isinstance(value, str):
+        return redact(value)
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    return redact(str(value))
+
+
+class Span(object):
+    """
+    One timed phase
+    """
+    def __init__(self, name, labels=None, **attributes):
+        self.name = name
+        self.labels = dict((k, str(v)) for k, v in (labels or {}).items() if v is not None)
+        self.attributes = attributes
+        self.start = time.time()
+        self.seconds = None
+        self.ok = True
+        self._clock = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, seconds=None):
+        self.seconds = time.perf_counter() - self._clock if seconds is None else seconds
+        recorder.add(self)
+
+    def as_dict(self):
+        return {'ts': round(self.start, 6), 'span': self.name, 'seconds': round(self.seconds, 6),
+                'status': 'ok' if self.ok else 'error',
+                'labels': dict((k, _clean(v)) for k, v in self.labels.items()),
+                'attributes': dict((k, _clean(v)) for k, v in self.attributes.items())}
+
+
+class Recorder(object):
+    """
+    Aggregates finished spans for the Prometheus textfile and appends them to the JSON lines file if configured.
+    The file is kept open, line buffered, and written outside the lock guarding the totals.
+    """
+    def __init__(self):
+        self.jsonl = None
+        self.prometheus = None
+        self.totals = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_lock = threading.Lock()
+
+    def add(self, span):
+        key = (span.name, tuple(sorted((k, _clean(v)) for k, v in span.labels.items())))
+        line = json.dumps(span.as_dict(), sort_keys=True) + '\n' if self.jsonl else None
+        with self._lock:
+            total = self.totals.setdefault(key, {'count': 0, 'seconds': 0.0, 'errors': 0, 'last': 0.0,
+                                                 'bytes': 0, 'phases': {}})
+            total['count'] += 1
+            total['seconds'] += span.seconds
+            total['last'] = span.seconds
+            total['errors'] += 0 if span.ok else 1
+            total['bytes'] += int(span.attributes.get('bytes') or 0)
+            for name, value in span.attributes.items():
+                if name.endswith('_time') and isinstance(value, (int, float)):
+                    phase = name[:-len('_time')]
+                    total['phases'][phase] = total['phases'].get(phase, 0.0) + value
+        if line is not None:
+            self._append(line)
+
+    def _append(self, line):
+        with self._file_lock:
+            path = self.jsonl
+            try:
+                if self._file is not None and self._file.name != path:
+                    self._file.close()
+                    self._file = None
+                if self._file is None:
+                    self._file = open(path, 'a', buffering=1)
+                self._file.write(line)
+            except (IOError, OSError) as e:
+                logger.warning("Cannot append metrics to %s: %s" % (path, e))
+
+    def close(self):
+        """
+        Closes the JSON lines file; the next span reopens it
+        """
+        with self._file_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def prometheus_text(self):
+        """
+        :return str: the aggregated spans in the Prometheus text exposition format
+        """
+        with self._lock:
+            totals = sorted(self.totals.items())
+        families = [
+            ('jenkins_tools_span_seconds', 'summary', 'Time spent in each instrumented phase',
+             lambda t: [('_sum', {}, t['seconds']), ('_count', {}, t['count'])]),
+            ('jenkins_tools_span_last_seconds', 'gauge', 'Duration of the latest span',
+             lambda t: [('', {}, t['last'])]),
+            ('jenkins_tools_span_errors_total', 'counter', 'Spans that ended in an error',
+             lambda t: [('', {}, t['errors'])]),
+            ('jenkins_tools_span_bytes_total', 'counter', 'Bytes moved by the spans',
+             lambda t: [('', {}, t['bytes'])] if t['bytes'] else []),
+            ('jenkins_tools_http_phase_seconds_total', 'counter',
+             'Cumulative curl phase times (namelookup, connect, appconnect, pretransfer, starttransfer, total)',
+             lambda t: [('', {'phase': p}, v) for p, v in sorted(t['phases'].items())]),
+        ]
+        lines = []
+        for metric, kind, help, samples in families:
+            lines.append('# HELP %s %s' % (metric, help))
+            lines.append('# TYPE %s %s' % (metric, kind))
+            for (name, labels), total in totals:
+                for suffix, extra, value in samples(total):
+                    pairs = [('span', name)] + list(labels) + sorted(extra.items())
+                    lines.append('%s%s{%s} %s' % (metric, suffix, ','.join('%s="%s"' % (k, _escape(v))
+                                                                          for k, v in pairs), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path=None):
+        """
+        Writes the textfile for node_exporter's textfile collector, replacing it atomically
+        :param str path: defaults to the configured path; nothing is written without one
+        """
+        path = path or self.prometheus
+        if not path:
+            return
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.prometheus_text())
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            logger.warning("Cannot write metrics to %s: %s" % (path, e))
+
+    def reset(self):
+        with self._lock:
+            self.totals = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+recorder = Recorder()
+
+
+def configure(jsonl=None, prometheus=None):
+    """
+    :param str jsonl: file each finished span is appended to as a JSON line
+    :param str prometheus: Prometheus textfile written by flush()
+    """
+    recorder.close()
+    recorder.jsonl = jsonl
+    recorder.prometheus = prometheus
+
+
+def flush():
+    """
+    Writes the Prometheus textfile, if one is configured
+    """
+    recorder.write_prometheus()
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Times the body of a with block. Attributes can be added through the yielded Span's set().
+    An exception marks the span as an error and is re-raised.
+    :param str name: e.g. artifact.download
+    :param labels: low cardinality labels, e.g. host or step
+    """
+    s = Span(name, labels)
+    try:
+        yield s
+    except BaseException:
+        s.ok = False
+        raise
+    finally:
+        s.finish()
+
+
+def record(name, seconds, ok=True, labels=None, **attributes):
+    """
+    Records a span that was timed elsewhere, e.g. by curl or paramiko
+    :return Span:
+    """
+    s = Span(name, labels, **attributes)
+    s.ok = ok
+    s.finish(seconds)
+    return s
+
+
+CURL_PHASES = (('namelookup', 'NAMELOOKUP_TIME'), ('connect', 'CONNECT_TIME'), ('appconnect', 'APPCONNECT_TIME'),
+               ('pretransfer', 'PRETRANSFER_TIME'), ('starttransfer', 'STARTTRANSFER_TIME'),
+               ('total', 'TOTAL_TIME'))
+
+
+def curl_info(c):
+    """
+    Timings and counters of the transfer a curl handle has just made; call before the handle is reset or closed
+    :param pycurl.Curl c:
+    :return dict: <phase>_time seconds from the start of the transfer, speeds in bytes/s, sizes and connection reuse
+    """
+    info = dict(('%s_time' % phase, c.getinfo(getattr(pycurl, option))) for phase, option in CURL_PHASES)
+
+    def counter(option):
+        # the integer _T variants replace the double ones in newer libcurl
+        return c.getinfo(getattr(pycurl, option + '_T', None) or getattr(pycurl, option))
+
+    info.update({'speed_download': counter('SPEED_DOWNLOAD'), 'speed_upload': counter('SPEED_UPLOAD'),
+                 'status': c.getinfo(pycurl.RESPONSE_CODE), 'new_connections': c.getinfo(pycurl.NUM_CONNECTS),
+                 'bytes': int(counter('SIZE_DOWNLOAD') + counter('SIZE_UPLOAD'))})
+    return info
+
+
+def record_curl(name, c, url, ok=True, **labels):
+    """
+    Records the transfer a curl handle has just made as a span timed by curl itself
+    :param str name: e.g. http.segment
+    :param pycurl.Curl c:
+    :param str url: kept as an attribute, with any credentials masked
+    :param bool ok:
+    :param labels: e.g. kind=upload
+    :return Span:
+    """
+    try:
+        info = curl_info(c)
+    except pycurl.error:
+        return None
+    host = url.split('://', 1)[-1].split('/', 1)[0].rsplit('@', 1)[-1]
+    labels.setdefault('host', host)
+    return record(name, info['total_time'], ok and 0 < info['status'] < 400, labels, url=url, **info)
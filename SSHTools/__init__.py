@@ -0,0 +1,227 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from JenkinsTools import lazy_import
+from JenkinsTools.metrics import span
+
+paramiko = lazy_import('paramiko')
+
+"""
+SSHTools module - a shared pool of authenticated paramiko transports, so that ServiceTools and ArtifactTools
+pay for one key load and one SSH handshake per (user, host, port, key) rather than one per operation.
+
+"""
+
+# set logging level for the module
+log_level = logging.DEBUG
+
+# handlers are left to the entry point, see JenkinsTools.configure_logging
+logger = logging.getLogger('SSHTools')
+logger.setLevel(log_level)
+
+__all__ = ['SSHConnectionPool', 'get_pool', 'load_key']
+
+_key_cache = {}
+_key_lock = threading.Lock()
+
+
+def load_key(identity_file):
+    """
+    Loads an RSA private key, caching the parsed key until the file changes
+    :param str identity_file: path to the key, ~ is expanded
+    :return paramiko.RSAKey:
+    """
+    path = os.path.expanduser(identity_file)
+    mtime = os.path.getmtime(path)
+    with _key_lock:
+        cached = _key_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    key = paramiko.RSAKey.from_private_key_file(path)
+    with _key_lock:
+        _key_cache[path] = (mtime, key)
+    return key
+
+
+class _PooledTransport(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transport = None
+        self.last_used = 0.0
+
+
+def _open_channels(t):
+    """
+    :param paramiko.Transport t:
+    :return int: channels (commands, sftp sessions) on the transport that have not been closed yet
+    """
+    return len([chan for chan in t._channels.values() if not chan.closed])
+
+
+class SSHConnectionPool(object):
+    """
+    Keeps authenticated transports open, keyed by (user, host, port, identity file).
+    Transports idle for longer than idle_timeout are closed on the next pool access (or evict_idle),
+    and transports in use send a keepalive every keepalive seconds. A transport with an open channel (a running
+    command or an sftp session) is never idle, however long the channel has been running.
+    Safe to share between threads - channels (sftp sessions, commands) are multiplexed over the one transport.
+
+    :param int idle_timeout: seconds a transport may sit unused before it is closed
+    :param int keepalive: keepalive interval in seconds, 0 to disable
+    :param str known_hosts: known_hosts file used to verify host keys, unknown hosts are accepted
+    """
+    def __init__(self, idle_timeout=300, keepalive=30, known_hosts='~/.ssh/known_hosts'):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.known_hosts = known_hosts
+        self.handshakes = 0
+        self.handshakes_saved = 0
+        self._host_keys = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _host_key(self, host):
+        if self._host_keys is None:
+            try:
+                self._host_keys = paramiko.util.load_host_keys(os.path.expanduser(self.known_hosts))
+            except IOError:
+                logger.warning('Unable to open host keys file %s' % self.known_hosts)
+                self._host_keys = {}
+        if host in self._host_keys:
+            keys = self._host_keys[host]
+            return keys[list(keys.keys())[0]]
+        return None
+
+    def transport(self, host, port=22, user='root', identity_file='~/.ssh/id_rsa', compress=False):
+        """
+        Returns an authenticated transport for the given connection details, reusing an open one if possible
+        :param str host:
+        :param int port:
+        :param str user:
+        :param str identity_file:
+        :param bool compress: ask for zlib compression; compressed and plain transports are pooled separately
+        :return paramiko.Transport:
+        """
+        self.evict_idle()
+        key = (user, host, int(port), os.path.expanduser(identity_file), bool(compress))
+        with self._lock:
+            entry = self._entries.setdefault(key, _PooledTransport())
+        with entry.lock:
+            t = entry.transport
+            if t is not None and t.is_active() and t.is_authenticated():
+                with self._lock:
+                    self.handshakes_saved += 1
+            else:
+                if t is not None:
+                    t.close()
+                entry.transport = None
+                pkey = load_key(identity_file)
+                logger.debug("Opening ssh transport to %s@%s:%s" % (user, host, port))
+                with span('ssh.handshake', host=host) as s:
+                    s.set(port=int(port), user=user, compress=bool(compress))
+                    t = paramiko.Transport((host, int(port)))
+                    t.use_compression(bool(compress))
+                    try:
+                        t.connect(hostkey=self._host_key(host), username=user, pkey=pkey)
+                    except Exception:
+                        t.close()
+                        raise
+                if self.keepalive:
+                    t.set_keepalive(self.keepalive)
+                entry.transport = t
+                with self._lock:
+                    self.handshakes += 1
+            entry.last_used = time.time()
+            return t
+
+    def sftp(self, host, port=22, user='root', identity_file='~/.ssh/id_rsa', compress=False, window_size=None,
+             max_packet_size=None):
+        """
+        Opens an SFTP session over a pooled transport. Closing the session leaves the transport open.
+        :param bool compress: use a compressed transport
+        :param int window_size: session window in bytes, paramiko's 2MB default if not given
+        :param int max_packet_size: largest packet the server may send on the session
+        :return paramiko.SFTPClient:
+        """
+        return paramiko.SFTPClient.from_transport(self.transport(host, port, user, identity_file, compress),
+                                                  window_size, max_packet_size)
+
+    def exec_command(self, command, host, port=22, user='root', identity_file='~/.ssh/id_rsa',
+                     timeout=None, get_pty=False):
+        """
+        Runs a command over a pooled transport, mirroring paramiko.SSHClient.exec_command
+        :return tuple: stdin, stdout, stderr file objects for the channel
+        """
+        chan = self.transport(host, port, user, identity_file).open_session(timeout=timeout)
+        if get_pty:
+            chan.get_pty()
+        chan.settimeout(timeout)
+        chan.exec_command(command)
+        return chan.makefile_stdin('wb'), chan.makefile('r'), chan.makefile_stderr('r')
+
+    def evict_idle(self):
+        """
+        Closes transports that have been unused for longer than idle_timeout, or have dropped.
+        A transport with open channels counts as in use; its idle time starts again once they have closed.
+        :return int: number of transports closed
+        """
+        now = time.time()
+        evicted = 0
+        with self._lock:
+            entries = list(self._entries.items())
+        for key, entry in entries:
+            if not entry.lock.acquire(False):
+                continue
+            try:
+                t = entry.transport
+                if t is not None and t.is_active() and _open_channels(t):
+                    entry.last_used = now
+                elif t is not None and (now - entry.last_used > self.idle_timeout or not t.is_active()):
+                    logger.debug("Closing idle ssh transport to %s@%s:%s" % key[:3])
+                    t.close()
+                    entry.transport = None
+                    evicted += 1
+            finally:
+                entry.lock.release()
+        return evicted
+
+    def close_all(self):
+        """
+        Closes every pooled transport
+        """
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries = {}
+        for entry in entries:
+            with entry.lock:
+                if entry.transport is not None:
+                    entry.transport.close()
+                    entry.transport = None
+
+    def stats(self):
+        """
+        :return dict: handshakes performed, handshakes saved by reuse and transports currently open
+        """
+        with self._lock:
+            open_transports = len([e for e in self._entries.values() if e.transport is not None])
+        return {'handshakes': self.handshakes, 'handshakes_saved': self.handshakes_saved,
+                'open': open_transports}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process wide connection pool shared by ServiceTools and ArtifactTools
+    :return SSHConnectionPool:
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SSHConnectionPool()
+            atexit.register(_pool.close_all)
+        return _pool
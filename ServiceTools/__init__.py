@@ -1,11 +1,17 @@
+import io
 import logging
-import yaml
-from string import Template
-import paramiko
+import uuid
+import shlex
+import hashlib
 import traceback
-import select
 import sys
 import os
+import time
+from JenkinsTools import lazy_import, load_yaml, load_yaml_file, ContextExecutor
+from SSHTools import get_pool
+from ServiceTools.remote import CommandResult, control_service_async, control_services_async, control_services
+from ServiceTools.health import make_probe, rolling_restart_async, rolling_restart
+from ServiceTools.templates import CompiledTemplate, TemplateError, TemplateRegistry, get_registry, unit_path
 
 """
 ServiceTools module for templating sys-v and sys-d scripts, managing run-levels and start-ups
@@ -15,15 +21,17 @@ ServiceTools module for templating sys-v and sys-d scripts, managing run-levels
 # set logging level for the module
 log_level = logging.DEBUG
 
-# Set up logging stream
-sh = logging.StreamHandler()
-sh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s'))
+# handlers are left to the entry point, see JenkinsTools.configure_logging
 logger = logging.getLogger('ServiceTools')
-logger.addHandler(sh)
 logger.setLevel(log_level)
 
+asyncio = lazy_import('asyncio')
 
-__all__ = ['ServiceConfig', 'BasicSysVTemplate', 'BasicSysDTemplate', 'control_service']
+__all__ = ['ServiceConfig', 'BasicSysVTemplate', 'BasicSysDTemplate', 'control_service', 'CommandResult',
+           'control_service_async', 'control_services_async', 'control_services',
+           'HostResult', 'plan_waves', 'deploy_service', 'format_results',
+           'make_probe', 'rolling_restart_async', 'rolling_restart',
+           'CompiledTemplate', 'TemplateError', 'TemplateRegistry', 'get_registry', 'unit_path']
 
 
 class ServiceConfig(object):
@@ -39,6 +47,13 @@ class ServiceConfig(object):
         self.app_path = '/opt/apps'
         self.service_description = ''
         self.host = None
+        self.hosts = []
+        self.max_in_flight = 10
+        self.canary = 0
+        self.batch_size = None
+        self.max_unavailable = 1
+        self.readiness = None
+        self.sudo_install = False
         self.deploy_user = 'root'
         self.identity_file = '/Users/sjones/.ssh/jenkins_rsa'
         self.host_port = 22
@@ -48,12 +63,10 @@ class ServiceConfig(object):
 
     def read_config(self):
         try:
-            f = open(self.filename)
+            self.conf = load_yaml_file(self.filename)
         except (OSError, IOError):
             logger.fatal("FATAL: Config file (%s) not found" % self.filename)
             exit(2)
-        else:
-            self.conf = yaml.safe_load(f)
         self.process_config()
 
     def process_config(self):
@@ -64,15 +77,35 @@ class ServiceConfig(object):
             if log_level == logging.DEBUG:
                 logger.debug('Config in use: %s\n' % str(self.conf))
             exit(2)
+        if 'hosts' in self.conf:
+            self.hosts = list(self.conf['hosts'])
+        if 'inventory' in self.conf:
+            self.hosts.extend(read_inventory(self.conf['inventory']))
         if 'host' in self.conf:
             self.host = self.conf['host']
-        if 'system' in self.conf:
-            self.system = self.conf['system']
-        else:
+            if self.host not in self.hosts:
+                self.hosts.insert(0, self.host)
+        elif self.hosts:
+            self.host = self.hosts[0]
+        if not self.hosts:
             logger.fatal("host not specified in config cannot continue")
             if log_level == logging.DEBUG:
                 logger.debug('Config in use: %s\n' % str(self.conf))
             exit(2)
+        if 'system' in self.conf:
+            self.system = self.conf['system']
+        if 'max_in_flight' in self.conf:
+            self.max_in_flight = int(self.conf['max_in_flight'])
+        if 'canary' in self.conf:
+            self.canary = int(self.conf['canary'])
+        if 'batch_size' in self.conf:
+            self.batch_size = int(self.conf['batch_size'])
+        if 'max_unavailable' in self.conf:
+            self.max_unavailable = int(self.conf['max_unavailable'])
+        if 'readiness' in self.conf:
+            self.readiness = self.conf['readiness'] or {}
+        if 'sudo_install' in self.conf:
+            self.sudo_install = bool(self.conf['sudo_install'])
         if 'conf_path' in self.conf:
             self.conf_path = self.conf['conf_path']
         if 'app_path' in self.conf:
@@ -94,53 +127,139 @@ class ServiceConfig(object):
         if 'service_description' in self.conf:
             self.service_description = self.conf['service_description']
 
-    def push_to_server(self, template=None):
+    def render(self, template):
+        """
+        Substitutes this service's values into a template
+        :param Template / CompiledTemplate template:
+        :return str:
+        """
+        if isinstance(template, CompiledTemplate):
+            return template.render(self.variables())
+        return template.safe_substitute(**self.variables())
+
+    def variables(self):
+        """
+        :return dict: values for the template variables
+        """
+        return {'servicename': self.service_name,
+                'conf_path': self.conf_path,
+                'app_path': self.app_path,
+                'env': self.env,
+                'service_description': self.service_description}
+
+    def push_to_server(self, template=None, host=None):
         """
 
         :param BasicSysDTemplate / BasicSysVTemplate template:
+        :param str host: host to push to, defaults to the configured host
         :return:
         """
-        template = template
         if template is not None:
-            template_s = template.safe_substitute(servicename=self.service_name,
-                                                  conf_path=self.conf_path,
-                                                  app_path=self.app_path,
-                                                  env=self.env,
-                                                  service_description=self.service_description)
-            use_gssapi = False
-            do_gssapi_key_exchange = False
-
-            hostkey = None
-            hostkeytype = None
-            try:
-                host_keys = paramiko.util.load_host_keys(os.path.expanduser('~/.ssh/known_hosts'))
-            except IOError:
-                print('*** Unable to open host keys file')
-                host_keys = {}
-
-            if self.host in host_keys:
-                hostkeytype = host_keys[self.host].keys()[0]
-                hostkey = host_keys[self.host][hostkeytype]
-
             try:
-                k = paramiko.RSAKey.from_private_key_file(self.identity_file)
-                t = paramiko.Transport((self.host, self.host_port))
-                t.connect(hostkey=hostkey, username=self.deploy_user, gss_host=self.host,
-                          gss_auth=use_gssapi, gss_kex=do_gssapi_key_exchange, pkey=k)
-                sftp = paramiko.SFTPClient.from_transport(t)
-                with sftp.open('/tmp/outfile.txt', 'w') as f:
-                    f.write(template_s)
-
+                self.push_to_host(template, host or self.host)
             except Exception as e:
                 logger.error('Upload via ssh/sftp failed with error: \n%s\n%s' % (e.__class__, e))
                 if log_level == logging.DEBUG:
                     traceback.print_exc()
-                try:
-                    t.close()
-                except:
-                    pass
                 exit(1)
 
+    def push_to_host(self, template, host):
+        """
+        Renders the template and installs it on a single host, raising on failure rather than exiting
+        so that it can be used from worker threads.
+        :param Template template:
+        :param str host:
+        :return bool: True if the unit on the host was changed
+        """
+        return self.push_unit(host, self.render(template))
+
+    def run_on_host(self, host, command):
+        """
+        Runs a command over the pooled connection to a host
+        :return tuple: exit status, stdout
+        """
+        stdin, stdout, stderr = get_pool().exec_command(command, host, self.host_port, self.deploy_user,
+                                                        self.identity_file, timeout=60)
+        output = stdout.read().decode('utf-8', 'replace')
+        return stdout.channel.recv_exit_status(), output
+
+    def unit_matches(self, sftp, host, path, data):
+        """
+        Checks whether the file at path on the host already holds data: the size from a stat first, then sha256sum
+        :return bool:
+        """
+        try:
+            if sftp.stat(path).st_size != len(data):
+                return False
+        except IOError:
+            return False
+        status, output = self.run_on_host(host, 'sha256sum %s' % shlex.quote(path))
+        return status == 0 and output.split()[:1] == [hashlib.sha256(data).hexdigest()]
+
+    def push_unit(self, host, content, path=None):
+        """
+        Installs a unit file on a host unless the same content is already there.
+        The file is uploaded next to its destination and renamed over it, so the unit is never seen half written;
+        with sudo_install it is uploaded to /tmp and moved into place with sudo instead.
+        systemd is reloaded when a unit changes.
+        :param str host:
+        :param str content: rendered unit
+        :param str path: destination, defaults to the init.d script or systemd unit for the service
+        :return bool: True if the unit was changed
+        """
+        path = path or unit_path(self.service_name, self.system)
+        data = content.encode()
+        mode = 0o644 if self.system == 'systemd' else 0o755
+        sftp = get_pool().sftp(host, self.host_port, self.deploy_user, self.identity_file)
+        try:
+            if self.unit_matches(sftp, host, path, data):
+                logger.info("[%s] %s is up to date" % (host, path))
+                return False
+            if self.sudo_install:
+                tmp = '/tmp/.%s.%s' % (os.path.basename(path), uuid.uuid4().hex)
+                sftp.putfo(io.BytesIO(data), tmp)
+                command = 'sudo install -m %o %s %s && sudo mv -f %s %s; status=$?; rm -f %s; exit $status' % (
+                    mode, shlex.quote(tmp), shlex.quote(path + '.new'), shlex.quote(path + '.new'),
+                    shlex.quote(path), shlex.quote(tmp))
+                status, output = self.run_on_host(host, command)
+                if status != 0:
+                    raise IOError("installing %s failed with status %d: %s" % (path, status, output.strip()))
+            else:
+                tmp = '%s/.%s.%s' % (os.path.dirname(path), os.path.basename(path), uuid.uuid4().hex)
+                sftp.putfo(io.BytesIO(data), tmp)
+                try:
+                    sftp.chmod(tmp, mode)
+                    sftp.posix_rename(tmp, path)
+                except IOError:
+                    sftp.remove(tmp)
+                    raise
+        finally:
+            sftp.close()
+        logger.info("[%s] installed %s" % (host, path))
+        if self.system == 'systemd':
+            status, output = self.run_on_host(host, 'sudo systemctl daemon-reload')
+            if status != 0:
+                raise IOError("systemctl daemon-reload failed with status %d: %s" % (status, output.strip()))
+        return True
+
+
+def read_inventory(inventory):
+    """
+    Reads a list of hosts from an inventory file, either a yaml list (.yml / .yaml)
+    or plain text with one host per line (blank lines and # comments are ignored)
+    :param str inventory: path to the inventory file
+    :return list: host names
+    """
+    try:
+        f = open(os.path.expanduser(inventory))
+    except (OSError, IOError):
+        logger.fatal("FATAL: Inventory file (%s) not found" % inventory)
+        exit(2)
+    with f:
+        if inventory.endswith(('.yml', '.yaml')):
+            return [str(h) for h in load_yaml(f) or []]
+        return [line.split('#')[0].strip() for line in f if line.split('#')[0].strip()]
+
 
 class BasicSysVTemplate:
     """
@@ -148,7 +267,8 @@ class BasicSysVTemplate:
     :param Template template: Specifies the file location to use for the template
     """
     def __init__(self, template='templates/sysv.template'):
-        self.template = Template(open(template).read())
+        self.compiled = get_registry().get(template)
+        self.template = self.compiled.template
 
     def substitute(self, service_name=None, app_path=None, conf_path=None):
         t = self.template.safe_substitute(servicename=service_name, conf_path=conf_path, app_path=app_path)
@@ -161,69 +281,167 @@ class BasicSysDTemplate:
     :param Template template: Specifies the file location to use for the template
     """
     def __init__(self, template='templates/sysd.template'):
-        self.template = Template(open(template).read())
+        self.compiled = get_registry().get(template)
+        self.template = self.compiled.template
 
     def substitute(self, service_name=None, app_path=None, conf_path=None):
         t = self.template.safe_substitute(servicename=service_name, conf_path=conf_path, app_path=app_path)
         return t
 
 
-def control_service(user='root', host='localhost', service=None, type='sysv', action=None, identity_file=None):
+def control_service(user='root', host='localhost', service=None, type='sysv', action=None, identity_file=None,
+                    port=22, timeout=120, get_pty=True):
     """
     Method for sending commands to services over SSH.
     Defaults to local host, but requires a service name and an action to perform on it
     e.g. control_service(host=some_host, service=sshd, action=restart)
     Currently no validation performed on the service or action, so make sure you know what you're doing! :)
+    Output is logged as it arrives; see control_services for many hosts at once.
 
     :param identity_file:
     :param user: user to use to connect, defaults to root
     :param host: host on which to act
     :param service: service on which to act
     :param type: service type we're acting on sysv or systemd
-    :return status: simple bool indicating if we sent the command successfully, no guarantee the command was successful
+    :param port: ssh port on the host
+    :param timeout: seconds allowed for the command to finish
+    :param get_pty: request a pty, as sudo needs on hosts with requiretty set; stderr then arrives with stdout
+    :return status: bool indicating the command ran and exited with status 0
     """
-    status = False
-    if (service is None) or (action is None):
-        logger.error("Service/action cannot be empty, please specify the service name and action to be performed")
-        return status
-    if action not in ['start', 'stop', 'restart']:
-        logger.error("Action unknown, please specify one of start / stop / restart")
-        return status
     if identity_file is None:
         identity_file = os.path.expanduser('~/.ssh/id_rsa')
         logger.info("identity file is %s" % identity_file)
-    try:
-        if '~' in identity_file:
-            k = paramiko.RSAKey.from_private_key_file(os.path.expanduser(identity_file))
-        else:
-            k = paramiko.RSAKey.from_private_key_file(identity_file)
-        ssh = paramiko.SSHClient()
-        ssh.load_system_host_keys()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=user, pkey=k)
-    except paramiko.AuthenticationException:
-        logger.error("Authentication exception - user is %s, id file is %s" % (user, identity_file))
-        pass
-    try:
-        logger.info("trying to perform a %s on %s, running on %s" % (action, service, host))
-        if type == 'sysv':
-            stdin, stdout, stderr = ssh.exec_command("sudo /etc/init.d/%s %s" % (service, action), timeout=15, get_pty=True)
-        elif type == 'systemd':
-            stdin, stdout, stderr = ssh.exec_command("sudo service %s %s" % (service, action), timeout=15, get_pty=True)
-        while not stdout.channel.exit_status_ready():
-            if stdout.channel.recv_ready():
-                rl, wl, xl = select.select([stdout.channel], [], [], 0.0)
-                if len(rl) > 0:
-                    logger.info(stdout.channel.recv(1024),)
-    except paramiko.SSHException as e:
-        if log_level == logging.DEBUG:
-            logger.fatal('Failed with error: \n%s\n%s' % (e.__class__, e))
-            traceback.print_exc()
-        else:
-            pass
-    ssh.close()
-    status = True
-    return status
+    result = asyncio.run(control_service_async(user, host, service, type, action, identity_file, port, timeout,
+                                               get_pty))
+    return result.ok
+
+
+class HostResult(object):
+    """
+    Outcome of deploying a service to a single host
+    """
+    def __init__(self, host, wave=0):
+        self.host = host
+        self.wave = wave
+        self.pushed = False
+        self.changed = None
+        self.controlled = False
+        self.healthy = None
+        self.error = None
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None and (self.controlled or self.changed is False) and self.healthy is not False
+
+    def __repr__(self):
+        return '<HostResult %s ok=%s>' % (self.host, self.ok)
+
+
+def plan_waves(hosts, canary=0, batch_size=None):
+    """
+    Splits a host list into deployment waves.
+    The first ``canary`` hosts form a wave of their own, the rest are split into waves of ``batch_size``
+    (or a single wave if no batch size is given)
+    :param list hosts:
+    :param int canary: number of hosts to deploy to before the rest
+    :param int batch_size: maximum hosts per wave after the canaries
+    :return list: list of lists of hosts
+    """
+    hosts = list(hosts)
+    waves = []
+    if canary and canary > 0:
+        waves.append(hosts[:canary])
+        hosts = hosts[canary:]
+    if not batch_size or batch_size <= 0:
+        batch_size = len(hosts) or 1
+    for i in range(0, len(hosts), batch_size):
+        waves.append(hosts[i:i + batch_size])
+    return waves
+
+
+def deploy_service(service_config, template, action='restart', identity_file=None, hosts=None,
+                   max_in_flight=None, canary=None, batch_size=None, halt_on_failure=True, restart_unchanged=False):
+    """
+    Pushes the rendered template and runs control_service on every host of the service config,
+    running up to max_in_flight hosts at a time. Hosts whose unit was already up to date are not restarted.
+    Hosts are processed in waves (see plan_waves);
+    if halt_on_failure is set, any failure in a wave stops the remaining waves from being started.
+
+    :param ServiceConfig service_config:
+    :param Template template: template to push, or None to only control the service
+    :param str action: start / stop / restart, or None to only push the template
+    :param str identity_file: key to use for control_service, defaults to the config's identity file
+    :param list hosts: overrides service_config.hosts
+    :param int max_in_flight: overrides service_config.max_in_flight
+    :param int canary: overrides service_config.canary
+    :param int batch_size: overrides service_config.batch_size
+    :param bool halt_on_failure:
+    :param bool restart_unchanged: run the action even on hosts whose unit was already up to date
+    :return list: HostResult per host, in host order. Hosts in waves that were not started have an error set.
+    """
+    sc = service_config
+    hosts = hosts if hosts is not None else sc.hosts
+    max_in_flight = max_in_flight or sc.max_in_flight or 1
+    canary = canary if canary is not None else sc.canary
+    batch_size = batch_size if batch_size is not None else sc.batch_size
+    identity_file = identity_file or sc.identity_file
+
+    def run_host(result):
+        start = time.time()
+        try:
+            if template is not None:
+                result.changed = sc.push_to_host(template, result.host)
+                result.pushed = True
+            if action is None:
+                result.controlled = True
+            elif result.changed is False and not restart_unchanged:
+                logger.info("[%s] unit unchanged, not running %s" % (result.host, action))
+            else:
+                result.controlled = control_service(sc.deploy_user, result.host, sc.service_name, sc.system,
+                                                    action, identity_file, sc.host_port)
+                if not result.controlled:
+                    result.error = 'control_service failed'
+        except Exception as e:
+            result.error = '%s: %s' % (e.__class__.__name__, e)
+            logger.error("Deployment to %s failed: %s" % (result.host, result.error))
+        result.elapsed = time.time() - start
+        return result
+
+    results = []
+    halted = False
+    with ContextExecutor(max_workers=max_in_flight) as pool:
+        for number, wave in enumerate(plan_waves(hosts, canary, batch_size)):
+            wave_results = [HostResult(host, number) for host in wave]
+            results.extend(wave_results)
+            if halted:
+                for result in wave_results:
+                    result.error = 'not started, halted after earlier failure'
+                continue
+            logger.info("Deploying wave %d to %d host(s)" % (number, len(wave)))
+            list(pool.map(run_host, wave_results))
+            if halt_on_failure and not all(r.ok for r in wave_results):
+                logger.error("Failures in wave %d, halting deployment" % number)
+                halted = True
+    return results
+
+
+def format_results(results):
+    """
+    Formats a list of HostResult as a plain text table for the Jenkins log
+    :param list results:
+    :return str:
+    """
+    width = max([len('host')] + [len(r.host) for r in results])
+    lines = ['%-*s  %4s  %6s  %7s  %10s  %5s  %8s  %s' % (width, 'host', 'wave', 'pushed', 'changed', 'controlled',
+                                                          'ready', 'time', 'error')]
+    for r in results:
+        lines.append('%-*s  %4d  %6s  %7s  %10s  %5s  %7.2fs  %s' % (width, r.host, r.wave, r.pushed,
+                                                                      '-' if r.changed is None else r.changed,
+                                                                      r.controlled,
+                                                                      '-' if r.healthy is None else r.healthy,
+                                                                      r.elapsed, r.error or ''))
+    return '\n'.join(lines)
 
 
 def test_sysv():
@@ -233,7 +451,7 @@ def test_sysv():
                                         app_path='/opt/apps',
                                         env='dev',
                                         service_description='This is an example service description')
-    print result
+    print(result)
 
 
 def test_sysd():
@@ -243,7 +461,7 @@ def test_sysd():
                                         app_path='/opt/apps',
                                         env='dev',
                                         service_description='This is an example service description')
-    print result
+    print(result)
 
 
 def test_sysv_config():
@@ -0,0 +1,205 @@
+import re
+import time
+import logging
+from JenkinsTools import lazy_import, ContextExecutor
+from ServiceTools.remote import control_service_async, run_command_async
+
+"""
+Health-gated rolling restarts.
+Hosts are restarted in waves; within a wave at most max_unavailable hosts are restarting or not yet ready at once.
+After each restart a readiness probe is polled until the host is healthy, and the next wave starts as soon as every
+host in the current one is. A host that fails to restart or does not become ready in time halts the rollout.
+
+"""
+
+logger = logging.getLogger('ServiceTools')
+
+asyncio = lazy_import('asyncio')
+urllib_request = lazy_import('urllib.request')
+
+__all__ = ['HttpProbe', 'SystemdProbe', 'PidfileProbe', 'template_http_port', 'template_pidfile', 'make_probe',
+           'rolling_restart_async', 'rolling_restart']
+
+
+def template_http_port(text):
+    """
+    :param str text: rendered service template
+    :return int: the -Dhttp.port the service listens on, or None
+    """
+    match = re.search(r'-Dhttp\.port=(\d+)', text)
+    return int(match.group(1)) if match else None
+
+
+def template_pidfile(text):
+    """
+    :param str text: rendered service template
+    :return str: the pidfile the service writes, or None
+    """
+    match = re.search(r'-Dpidfile\.path=(\S+)', text) or re.search(r'^PIDFile=(\S+)', text, re.M)
+    return match.group(1) if match else None
+
+
+class HttpProbe(object):
+    """
+    Ready when GET http://<host>:<port><path> answers with a status below 400
+    """
+    def __init__(self, port, path='/', request_timeout=5):
+        self.port = port
+        self.path = path
+        self.request_timeout = request_timeout
+
+    def _get(self, host):
+        try:
+            url = 'http://%s:%s%s' % (host, self.port, self.path)
+            with urllib_request.urlopen(url, timeout=self.request_timeout) as r:
+                return r.status < 400
+        except (urllib_request.URLError, OSError, ValueError):
+            return False
+
+    async def check(self, host, sc, executor):
+        return await asyncio.get_running_loop().run_in_executor(executor, self._get, host)
+
+    def __str__(self):
+        return 'http port %s%s' % (self.port, self.path)
+
+
+class _CommandProbe(object):
+    command = None
+
+    async def check(self, host, sc, executor):
+        result = await run_command_async(self.command, host, sc.host_port, sc.deploy_user, sc.identity_file,
+                                         timeout=30, executor=executor, quiet=True)
+        return result.ok
+
+    def __str__(self):
+        return self.command
+
+
+class SystemdProbe(_CommandProbe):
+    """
+    Ready when systemctl reports the unit active
+    """
+    def __init__(self, service):
+        self.command = 'systemctl is-active --quiet %s' % service
+
+
+class PidfileProbe(_CommandProbe):
+    """
+    Ready when the pidfile exists and names a running process
+    """
+    def __init__(self, pidfile):
+        self.command = 'sudo kill -0 "$(sudo cat %s)"' % pidfile
+
+
+def make_probe(sc, rendered=None):
+    """
+    Builds the readiness probe from the readiness section of a service config:
+    type is http, systemd or pidfile, with port, path and pidfile overriding what the template declares.
+    Without a type, http is used when the template sets http.port, then systemd or the pidfile by system.
+    :param ServiceConfig sc:
+    :param str rendered: the rendered service template
+    :return: probe, or None if nothing can be probed
+    """
+    readiness = sc.readiness or {}
+    kind = readiness.get('type')
+    port = readiness.get('port') or (template_http_port(rendered) if rendered else None)
+    pidfile = readiness.get('pidfile') or (template_pidfile(rendered) if rendered else None)
+    if kind is None:
+        kind = 'http' if port else ('systemd' if sc.system == 'systemd' else 'pidfile')
+    if kind == 'http' and port:
+        return HttpProbe(port, readiness.get('path', '/'))
+    if kind == 'systemd':
+        return SystemdProbe(sc.service_name)
+    if kind == 'pidfile' and pidfile:
+        return PidfileProbe(pidfile)
+    logger.error("Readiness probe %s has nothing to check, set it in the readiness section" % kind)
+    return None
+
+
+async def _wait_ready(probe, host, sc, executor, timeout, interval):
+    deadline = time.time() + timeout
+    while True:
+        if await probe.check(host, sc, executor):
+            return True
+        if time.time() + interval > deadline:
+            return False
+        await asyncio.sleep(interval)
+
+
+async def rolling_restart_async(sc, probe, action='restart', hosts=None, batch_size=None, max_unavailable=None,
+                                canary=None, timeout=None, interval=None, results=None, restart_unchanged=False,
+                                identity_file=None):
+    """
+    :param ServiceConfig sc:
+    :param probe: readiness probe, see make_probe; None restarts without waiting for readiness
+    :param str action: start or restart
+    :param list hosts: overrides sc.hosts
+    :param int batch_size: overrides sc.batch_size
+    :param int max_unavailable: overrides sc.max_unavailable
+    :param int canary: overrides sc.canary
+    :param int timeout: seconds a host has to become ready, overrides the readiness section
+    :param int interval: seconds between probes, overrides the readiness section
+    :param list results: HostResults to fill in, matched by host; created if not given
+    :param bool restart_unchanged: also restart hosts whose results show an unchanged unit
+    :param str identity_file: key to connect with, defaults to the config's identity file
+    :return list: HostResult per host
+    """
+    from ServiceTools import HostResult, plan_waves
+    readiness = sc.readiness or {}
+    hosts = hosts if hosts is not None else sc.hosts
+    batch_size = batch_size if batch_size is not None else sc.batch_size
+    max_unavailable = max(1, max_unavailable or sc.max_unavailable or 1)
+    canary = canary if canary is not None else sc.canary
+    timeout = timeout or readiness.get('timeout', 120)
+    interval = interval or readiness.get('interval', 2)
+    identity_file = identity_file or sc.identity_file
+    by_host = dict((r.host, r) for r in results or [])
+    ordered = []
+    halted = False
+    semaphore = asyncio.Semaphore(max_unavailable)
+
+    with ContextExecutor(max_workers=min(max_unavailable * 2, 32)) as executor:
+        async def restart(result):
+            async with semaphore:
+                start = time.time()
+                command = await control_service_async(sc.deploy_user, result.host, sc.service_name, sc.system,
+                                                      action, identity_file, sc.host_port, executor=executor)
+                result.controlled = command.ok
+                if not command.ok:
+                    result.error = command.error or 'exited with status %s' % command.exit_status
+                elif probe is not None:
+                    result.healthy = await _wait_ready(probe, result.host, sc, executor, timeout, interval)
+                    if result.healthy:
+                        logger.info("[%s] ready after %.1fs (%s)" % (result.host, time.time() - start, probe))
+                    else:
+                        result.error = 'not ready within %ss (%s)' % (timeout, probe)
+                result.elapsed += time.time() - start
+
+        for number, wave in enumerate(plan_waves(hosts, canary, batch_size)):
+            wave_results = []
+            for host in wave:
+                result = by_host.get(host) or HostResult(host, number)
+                result.wave = number
+                wave_results.append(result)
+            ordered.extend(wave_results)
+            if halted:
+                for result in wave_results:
+                    if result.error is None:
+                        result.error = 'not started, halted after earlier failure'
+                continue
+            pending = [r for r in wave_results if r.error is None and (restart_unchanged or r.changed is not False)]
+            logger.info("Restarting wave %d, %d host(s), at most %d unavailable" %
+                        (number, len(pending), max_unavailable))
+            await asyncio.gather(*[restart(r) for r in pending])
+            if not all(r.ok for r in wave_results):
+                logger.error("Failures in wave %d, halting rollout" % number)
+                halted = True
+    return ordered
+
+
+def rolling_restart(sc, probe, action='restart', **kwargs):
+    """
+    Blocking wrapper around rolling_restart_async
+    :return list: HostResult per host
+    """
+    return asyncio.run(rolling_restart_async(sc, probe, action, **kwargs))
@@ -0,0 +1,218 @@
+import socket
+import logging
+import contextvars
+from JenkinsTools import lazy_import, ContextExecutor
+from SSHTools import get_pool
+from JenkinsTools.metrics import record
+
+asyncio = lazy_import('asyncio')
+paramiko = lazy_import('paramiko')
+
+"""
+asyncio service control over the pooled ssh transports.
+Connecting and opening channels block in paramiko, so those run in an executor; once a command is running its
+channel's event fd is watched by the event loop, so hundreds of hosts can be driven from one thread without polling.
+stdout and stderr are logged line by line, prefixed with the host, and each host's exit status is captured.
+
+"""
+
+logger = logging.getLogger('ServiceTools')
+
+__all__ = ['CommandResult', 'service_command', 'run_command_async', 'control_service_async',
+           'control_services_async', 'control_services']
+
+
+class CommandResult(object):
+    """
+    Outcome of running a command on one host
+    """
+    def __init__(self, host, command):
+        self.host = host
+        self.command = command
+        self.exit_status = None
+        self.stdout = []
+        self.stderr = []
+        self.error = None
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None and self.exit_status == 0
+
+    def __repr__(self):
+        return '<CommandResult %s exit=%s>' % (self.host, self.exit_status)
+
+
+def service_command(service, type, action):
+    """
+    Builds the command controlling a service
+    :param str service: service name
+    :param str type: sysv or systemd
+    :param str action: start / stop / restart
+    :return str: the command, or None if the service or action are not valid
+    """
+    if (service is None) or (action is None):
+        logger.error("Service/action cannot be empty, please specify the service name and action to be performed")
+        return None
+    if action not in ['start', 'stop', 'restart']:
+        logger.error("Action unknown, please specify one of start / stop / restart")
+        return None
+    if type == 'sysv':
+        return "sudo /etc/init.d/%s %s" % (service, action)
+    return "sudo service %s %s" % (service, action)
+
+
+class _LineLog(object):
+    """
+    Splits channel output into lines, logging and keeping each one
+    """
+    def __init__(self, host, log, lines):
+        self.host = host
+        self.log = log
+        self.lines = lines
+        self.pending = b''
+
+    def feed(self, data):
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self._emit(line)
+
+    def flush(self):
+        if self.pending:
+            self._emit(self.pending)
+            self.pending = b''
+
+    def _emit(self, line):
+        line = line.rstrip(b'\r').decode('utf-8', 'replace')
+        self.lines.append(line)
+        self.log("[%s] %s" % (self.host, line))
+
+
+def _blocking(loop, executor, fn, *args):
+    # run in the caller's context, as asyncio.to_thread does, since the loop's default executor does not copy it
+    return loop.run_in_executor(executor, contextvars.copy_context().run, fn, *args)
+
+
+def _open_channel(transport, command, get_pty, timeout):
+    chan = transport.open_session(timeout=timeout)
+    if get_pty:
+        chan.get_pty()
+    chan.exec_command(command)
+    chan.setblocking(0)
+    return chan
+
+
+async def _collect(chan, result, loop, executor=None, quiet=False):
+    """
+    Reads the channel whenever its event fd signals data, until the remote end sends EOF,
+    then waits for the exit status
+    """
+    out = _LineLog(result.host, logger.debug if quiet else logger.info, result.stdout)
+    err = _LineLog(result.host, logger.debug if quiet else logger.warning, result.stderr)
+    eof = loop.create_future()
+
+    def readable():
+        while chan.recv_ready():
+            out.feed(chan.recv(65536))
+        while chan.recv_stderr_ready():
+            err.feed(chan.recv_stderr(65536))
+        if (chan.eof_received or chan.closed) and not eof.done():
+            eof.set_result(None)
+
+    fd = chan.fileno()
+    loop.add_reader(fd, readable)
+    try:
+        readable()
+        await eof
+    finally:
+        loop.remove_reader(fd)
+    out.flush()
+    err.flush()
+    # the event fd stays set after EOF, so block on paramiko's status event in the executor instead
+    result.exit_status = await _blocking(loop, executor, chan.recv_exit_status)
+
+
+async def run_command_async(command, host, port=22, user='root', identity_file='~/.ssh/id_rsa', timeout=120,
+                            get_pty=False, executor=None, quiet=False):
+    """
+    Runs a command on a host over a pooled transport
+    :param str command:
+    :param str host:
+    :param int port: ssh port on the host
+    :param str user: user to connect as
+    :param str identity_file:
+    :param int timeout: seconds allowed for the command to finish
+    :param bool get_pty: request a pty, which merges stderr into stdout
+    :param Executor executor: used for the blocking connect and channel setup
+    :param bool quiet: log output at debug and leave failures to the caller, e.g. for polling
+    :return CommandResult:
+    """
+    loop = asyncio.get_running_loop()
+    result = CommandResult(host, command)
+    start = loop.time()
+    chan = None
+    try:
+        transport = await _blocking(loop, executor, get_pool().transport, host, port, user, identity_file)
+        chan = await _blocking(loop, executor, _open_channel, transport, command, get_pty, timeout)
+        await asyncio.wait_for(_collect(chan, result, loop, executor, quiet), timeout)
+    except asyncio.TimeoutError:
+        result.error = 'timed out after %ss' % timeout
+    except paramiko.AuthenticationException:
+        result.error = 'authentication failed for %s with %s' % (user, identity_file)
+    except (paramiko.SSHException, socket.error) as e:
+        result.error = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        if chan is not None:
+            chan.close()
+    result.elapsed = loop.time() - start
+    record('service.command', result.elapsed, result.ok, {'host': host}, command=command,
+           exit_status=result.exit_status, error=result.error)
+    if result.error and not quiet:
+        logger.error("[%s] %s failed: %s" % (host, command, result.error))
+    elif result.exit_status != 0 and not quiet:
+        logger.error("[%s] %s exited with status %s" % (host, command, result.exit_status))
+    return result
+
+
+async def control_service_async(user='root', host='localhost', service=None, type='sysv', action=None,
+                                identity_file='~/.ssh/id_rsa', port=22, timeout=120, get_pty=True, executor=None):
+    """
+    Starts, stops or restarts a service on one host
+    :param bool get_pty: request a pty, as sudo needs on hosts with requiretty set
+    :return CommandResult:
+    """
+    command = service_command(service, type, action)
+    if command is None:
+        result = CommandResult(host, None)
+        result.error = 'invalid service or action'
+        return result
+    logger.info("trying to perform a %s on %s, running on %s" % (action, service, host))
+    return await run_command_async(command, host, port, user, identity_file, timeout, get_pty, executor)
+
+
+async def control_services_async(hosts, service, type='sysv', action='restart', user='root',
+                                 identity_file='~/.ssh/id_rsa', port=22, max_in_flight=100, timeout=120,
+                                 get_pty=True):
+    """
+    Controls a service on many hosts at once, with at most max_in_flight commands running
+    :param list hosts:
+    :return list: CommandResult per host, in host order
+    """
+    semaphore = asyncio.Semaphore(max(1, max_in_flight))
+    with ContextExecutor(max_workers=max(1, min(max_in_flight, 32))) as executor:
+        async def run(host):
+            async with semaphore:
+                return await control_service_async(user, host, service, type, action, identity_file, port,
+                                                   timeout, get_pty, executor)
+        return list(await asyncio.gather(*[run(host) for host in hosts]))
+
+
+def control_services(hosts, service, type='sysv', action='restart', user='root', identity_file='~/.ssh/id_rsa',
+                     port=22, max_in_flight=100, timeout=120, get_pty=True):
+    """
+    Blocking wrapper around control_services_async
+    :return list: CommandResult per host, in host order
+    """
+    return asyncio.run(control_services_async(hosts, service, type, action, user, identity_file, port,
+                                              max_in_flight, timeout, get_pty))
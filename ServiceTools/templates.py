@@ -0,0 +1,149 @@
+import os
+import threading
+from string import Template
+
+"""
+Registry of service templates, each read, validated and compiled once.
+A compiled template is its text split into literal pieces and placeholders, so rendering is a single join rather than
+a regex pass per service. Templates are reloaded when their mtime or size changes.
+
+"""
+
+__all__ = ['TEMPLATE_VARIABLES', 'UNIT_PATHS', 'TemplateError', 'CompiledTemplate', 'TemplateRegistry',
+           'get_registry', 'unit_path']
+
+# Variables ServiceConfig supplies to templates
+TEMPLATE_VARIABLES = ('servicename', 'conf_path', 'app_path', 'env', 'service_description')
+
+# Where each system's unit file is installed on the host
+UNIT_PATHS = {'sysv': '/etc/init.d/%s', 'systemd': '/etc/systemd/system/%s.service'}
+
+DEFAULT_TEMPLATES = {'sysv': 'templates/sysv.template', 'systemd': 'templates/sysd.template'}
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def unit_path(service_name, system):
+    """
+    :return str: path of the unit file for a service on the host
+    """
+    return UNIT_PATHS.get(system, UNIT_PATHS['sysv']) % service_name
+
+
+class CompiledTemplate(object):
+    """
+    A template split into literal text and placeholders.
+    $$ is an escaped dollar; anything else after a $ that is not a variable name (e.g. the shell's $1) is kept as is.
+
+    :param str text: template source
+    :param str name: used in error messages
+    :param known: variable names the template may use
+    """
+    def __init__(self, text, name='template', known=TEMPLATE_VARIABLES):
+        self.name = name
+        self.template = Template(text)
+        self.parts = []
+        self.variables = set()
+        literal, position = [], 0
+        for match in Template.pattern.finditer(text):
+            literal.append(text[position:match.start()])
+            position = match.end()
+            variable = match.group('named') or match.group('braced')
+            if match.group('escaped') is not None:
+                literal.append('$')
+            elif variable is None:
+                literal.append(match.group(0))
+            else:
+                self.parts.append(''.join(literal))
+                self.parts.append((variable,))
+                self.variables.add(variable)
+                literal = []
+        literal.append(text[position:])
+        self.parts.append(''.join(literal))
+        unknown = self.variables.difference(known)
+        if unknown:
+            raise TemplateError("%s uses unknown variable(s) %s, expected some of %s" %
+                                (name, ', '.join(sorted(unknown)), ', '.join(known)))
+
+    def render(self, values):
+        """
+        :param dict values: variable -> value
+        :return str:
+        :raises TemplateError: if a variable the template uses has no value
+        """
+        missing = [v for v in self.variables if values.get(v) is None]
+        if missing:
+            raise TemplateError("%s needs a value for %s" % (self.name, ', '.join(sorted(missing))))
+        return ''.join(p if isinstance(p, str) else str(values[p[0]]) for p in self.parts)
+
+
+class TemplateRegistry(object):
+    """
+    Loads templates on first use and keeps them until the file changes
+    :param dict templates: system -> template path used by render_matrix
+    :param known: variable names templates may use
+    """
+    def __init__(self, templates=None, known=TEMPLATE_VARIABLES):
+        self.templates = dict(DEFAULT_TEMPLATES)
+        self.templates.update(templates or {})
+        self.known = tuple(known)
+        self.loads = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        :param str path: template file
+        :return CompiledTemplate:
+        :raises TemplateError: if the template uses variables that are not known
+        """
+        path = os.path.abspath(os.path.expanduser(path))
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+        with open(path) as f:
+            compiled = CompiledTemplate(f.read(), os.path.basename(path), self.known)
+        with self._lock:
+            self._cache[path] = (stamp, compiled)
+            self.loads += 1
+        return compiled
+
+    def for_system(self, system):
+        """
+        :return CompiledTemplate: the template registered for sysv or systemd
+        """
+        if system not in self.templates:
+            raise TemplateError("No template registered for system %s" % system)
+        return self.get(self.templates[system])
+
+    def render_matrix(self, configs):
+        """
+        Renders the unit for every host of every service config
+        :param configs: iterable of ServiceConfig, e.g. one per service and environment
+        :return: generator of (host, path, content)
+        """
+        for sc in configs:
+            content = self.for_system(sc.system).render(sc.variables())
+            path = unit_path(sc.service_name, sc.system)
+            for host in sc.hosts:
+                yield host, path, content
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    :return TemplateRegistry: registry shared by the module
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = TemplateRegistry()
+        return _registry
@@ -1,11 +1,7 @@
 #!/usr/bin/env python
-from DockerTools import BuildConf
-
-
-def main():
-    bc = BuildConf()
-    bc.build_command_list()
-    bc.run_commands()
+import sys
+from JenkinsTools.cli import main
 
+# kept for existing jobs, the same as jenkins-tools docker-runner
 if __name__ == '__main__':
-    main()
+    sys.exit(main(['docker-runner'] + sys.argv[1:]))
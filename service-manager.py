@@ -1,18 +1,6 @@
-from ServiceTools import *
-
-ssh_key = '~/.ssh/jenkins_rsa'
-service_command = 'restart'
-
-
-def main():
-    sc = ServiceConfig()
-    if sc.conf['system'] == 'sysv':
-        template = BasicSysVTemplate()
-    elif sc.conf['system'] == 'systemd':
-        template = BasicSysDTemplate()
-
-    sc.push_to_server(template.template)
-    control_service(sc.deploy_user, sc.host, sc.service_name, sc.system, service_command, ssh_key)
+import sys
+from JenkinsTools.cli import main
 
+# kept for existing jobs, the same as jenkins-tools service-manager
 if __name__ == '__main__':
-    main()
+    sys.exit(main(['service-manager'] + sys.argv[1:]))
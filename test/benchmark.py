@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from httpstub import HTTPStubServer, write_artifact
+from sshstub import SSHStubServer, write_client_key
+from ArtifactTools import ArtifactUploader
+from ArtifactTools.segmented import SegmentedDownload
+from DockerTools import BuildConf
+from ServiceTools.remote import run_command_async
+import SSHTools
+
+"""
+Throughput and latency benchmarks against loopback stand-ins: the Range/PUT HTTP stub, the in-process paramiko
+SSH/SFTP stub and the fake docker CLI, so they run anywhere the test suite does.
+Results are written as JSON; given a previous run with --baseline, metrics that got worse by more than --tolerance
+are reported and the exit status is 1, so regressions can be tracked between versions.
+
+    python test/benchmark.py --size 64 --output bench.json
+    python test/benchmark.py --baseline bench.json
+
+Metrics ending in _per_s are better higher, all others (seconds) better lower.
+"""
+
+__all__ = ['BENCHMARKS', 'run_benchmarks', 'compare']
+
+FAKE_DOCKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_docker.py')
+MB = 1024 ** 2
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Bench(object):
+    """
+    Scratch directory, test artifact and lazily started stand-in servers shared by the benchmarks of one run
+    :param int size: artifact size in MiB
+    :param int hosts: ssh stand-ins for the control latency benchmark
+    :param int repeat: repetitions for the latency benchmarks
+    """
+    def __init__(self, size=64, hosts=8, repeat=20):
+        self.size = size
+        self.hosts = hosts
+        self.repeat = repeat
+        self.tmp = tempfile.mkdtemp(prefix='jenkins-tools-bench-')
+        self.remote = os.path.join(self.tmp, 'remote')
+        os.mkdir(self.remote)
+        self.artifact = os.path.join(self.tmp, 'test.tgz')
+        write_artifact(self.artifact, int(size * MB))
+        shutil.copyfile(self.artifact, os.path.join(self.remote, 'test.tgz'))
+        self.key = write_client_key(os.path.join(self.tmp, 'id_rsa'))
+        self.docker = os.path.join(self.tmp, 'docker')
+        with open(self.docker, 'w') as f:
+            f.write('#!/bin/sh\nexec %s %s "$@"\n' % (sys.executable, FAKE_DOCKER))
+        os.chmod(self.docker, 0o755)
+        self._http = None
+        self._ssh = []
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = HTTPStubServer(self.remote, checksum_deploy=False)
+        return self._http
+
+    def ssh(self, count=1):
+        while len(self._ssh) < count:
+            self._ssh.append(SSHStubServer(self.remote))
+        return self._ssh[:count]
+
+    def close(self):
+        if self._http is not None:
+            self._http.close()
+        for server in self._ssh:
+            server.close()
+        SSHTools.get_pool().close_all()
+        shutil.rmtree(self.tmp)
+
+
+def http_download(bench):
+    target = os.path.join(bench.tmp, 'download.tgz')
+    results = {}
+    for connections in (1, 4):
+        start = time.time()
+        SegmentedDownload(bench.http.url + 'test.tgz', target, connections=connections, segment_size='8M').run()
+        results['mb_per_s_%d_connections' % connections] = bench.size / (time.time() - start)
+        os.remove(target)
+    return results
+
+
+def http_upload(bench):
+    au = ArtifactUploader({'upload': {'artifact': bench.artifact, 'target_type': 'artifactory',
+                                      'target': bench.http.url + 'uploads/test.tgz', 'checksum_deploy': False}},
+                          'upload')
+    start = time.time()
+    au.upload_to_repo()
+    if au.failures:
+        raise IOError('upload failed')
+    return {'mb_per_s': bench.size / (time.time() - start)}
+
+
+def sftp_upload(bench):
+    server = bench.ssh()[0]
+    results = {}
+    for name, outstanding in (('serial', 1), ('pipelined', 256)):
+        au = ArtifactUploader({'upload': {'artifact': bench.artifact, 'target_type': 'server',
+                                          'target': '127.0.0.1', 'target_port': server.port,
+                                          'target_path': 'upload-%s.tgz' % name, 'username': 'jenkins',
+                                          'identity_file': bench.key, 'max_outstanding': outstanding,
+                                          'progress_interval': 0}}, 'upload')
+        start = time.time()
+        au.put_to_server()
+        results['mb_per_s_%s' % name] = bench.size / (time.time() - start)
+    return results
+
+
+def ssh_handshakes(bench):
+    server = bench.ssh()[0]
+    pool = SSHTools.SSHConnectionPool(keepalive=0)
+    start = time.time()
+    for i in range(bench.repeat):
+        pool.transport('127.0.0.1', server.port, 'jenkins', bench.key)
+        pool.close_all()
+    elapsed = time.time() - start
+    pool.transport('127.0.0.1', server.port, 'jenkins', bench.key)
+    start = time.time()
+    for i in range(bench.repeat):
+        pool.transport('127.0.0.1', server.port, 'jenkins', bench.key)
+    reused = time.time() - start
+    pool.close_all()
+    return {'handshakes_per_s': bench.repeat / elapsed, 'pooled_per_s': bench.repeat / max(reused, 1e-9)}
+
+
+def control_latency(bench):
+    servers = bench.ssh(bench.hosts)
+    pool = SSHTools.get_pool()
+
+    async def run_all():
+        return await asyncio.gather(*[run_command_async('true', '127.0.0.1', s.port, 'jenkins', bench.key)
+                                      for s in servers])
+
+    pool.close_all()
+    cold = asyncio.run(run_all())
+    warm = []
+    for i in range(max(1, bench.repeat // 4)):
+        warm.extend(asyncio.run(run_all()))
+    failed = [r for r in cold + warm if r.error or r.exit_status != 0]
+    if failed:
+        raise IOError('%d commands failed: %s' % (len(failed), failed[0].error))
+    cold_times = [r.elapsed for r in cold]
+    warm_times = [r.elapsed for r in warm]
+    return {'cold_p50_seconds': percentile(cold_times, 0.5), 'cold_max_seconds': max(cold_times),
+            'warm_p50_seconds': percentile(warm_times, 0.5), 'warm_p95_seconds': percentile(warm_times, 0.95)}
+
+
+def buildconf_overhead(bench):
+    steps = max(2, bench.repeat // 2)
+    conf = os.path.join(bench.tmp, 'docker-runner.yml')
+    with open(conf, 'w') as f:
+        for i in range(steps):
+            f.write('step%d:\n  image: bench\n  command: "true"\n  depends_on: []\n' % i)
+    start = time.time()
+    for i in range(steps):
+        subprocess.call(['true'])
+    direct = (time.time() - start) / steps
+    results = {}
+    for mode, warm in (('run', False), ('exec', True)):
+        bc = BuildConf(conf, workers=1, warm=warm, docker=bench.docker)
+        bc.build_command_list()
+        start = time.time()
+        if not bc.run_commands():
+            raise IOError('build steps failed')
+        results['step_%s_seconds' % mode] = (time.time() - start) / steps - direct
+    return results
+
+
+BENCHMARKS = {
+    'http_download': http_download,
+    'http_upload': http_upload,
+    'sftp_upload': sftp_upload,
+    'ssh_handshakes': ssh_handshakes,
+    'control_latency': control_latency,
+    'buildconf_overhead': buildconf_overhead,
+}
+
+
+def run_benchmarks(names=None, size=64, hosts=8, repeat=20):
+    """
+    :param list names: benchmarks to run, all of them if not given
+    :return dict: environment details and, under results, metric name -> value for each benchmark
+    """
+    bench = Bench(size, hosts, repeat)
+    results = {}
+    try:
+        for name in names or sorted(BENCHMARKS):
+            try:
+                results[name] = dict((k, round(v, 6)) for k, v in BENCHMARKS[name](bench).items())
+            except Exception as e:
+                results[name] = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    finally:
+        bench.close()
+    try:
+        revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'revision': revision, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'host': socket.gethostname(), 'python': platform.python_version(),
+            'parameters': {'size_mb': size, 'hosts': hosts, 'repeat': repeat}, 'results': results}
+
+
+def compare(baseline, current, tolerance=0.2):
+    """
+    :param dict baseline: an earlier run_benchmarks result
+    :param dict current:
+    :param float tolerance: fraction a metric may get worse by before it counts as a regression
+    :return list: (benchmark, metric, baseline value, current value) for each regression
+    """
+    regressions = []
+    for name, metrics in sorted(current['results'].items()):
+        before = baseline.get('results', {}).get(name, {})
+        for metric, value in sorted(metrics.items()):
+            old = before.get(metric)
+            if metric == 'error' or not isinstance(old, (int, float)) or old <= 0:
+                continue
+            if metric.endswith('_per_s'):
+                worse = value < old * (1 - tolerance)
+            else:
+                worse = value > old * (1 + tolerance)
+            if worse:
+                regressions.append((name, metric, old, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ArtifactTools, ServiceTools and DockerTools against '
+                                                 'local stand-in servers')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark', help='benchmarks to run (default all): %s' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--size', type=float, default=64, help='artifact size in MiB for transfers')
+    parser.add_argument('--hosts', type=int, default=8, help='ssh stand-ins for control latency')
+    parser.add_argument('--repeat', type=int, default=20, help='repetitions for latency benchmarks')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fraction a metric may get worse')
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmark %s' % ', '.join(unknown))
+    report = run_benchmarks(args.benchmarks, args.size, args.hosts, args.repeat)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    status = 1 if any('error' in r for r in report['results'].values()) else 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for name, metric, old, new in regressions:
+            sys.stderr.write('regression: %s %s %.4g -> %.4g\n' % (name, metric, old, new))
+        if regressions:
+            status = 1
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Stand-in for the Docker Engine API on a Unix socket for tests. Containers run their Cmd on the host, with the host
+side of their first bind as the working directory; their output is served to attach as a multiplexed stream.
+Images are names in a set; pulls add to it, or report an error for the names in fail_pulls. The X-Registry-Auth
+header of each pull, None if it had none, is kept in pull_auth. A (method, path) added to hang_up has its next
+request read and logged, then the connection closed without an answer.
+"""
+import os
+import json
+import uuid
+import struct
+import selectors
+import threading
+import subprocess
+import socketserver
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler
+
+
+class _Container(object):
+    def __init__(self, config):
+        self.config = config
+        self.frames = []
+        self.exit_code = None
+        self.cond = threading.Condition()
+
+    def run(self):
+        binds = self.config.get('HostConfig', {}).get('Binds') or []
+        cwd = binds[0].split(':')[0] if binds else None
+        try:
+            p = subprocess.Popen(self.config['Cmd'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+        except OSError as e:
+            self.finish([(2, ('exec failed: %s\n' % e).encode())], 127)
+            return
+        sel = selectors.DefaultSelector()
+        sel.register(p.stdout, selectors.EVENT_READ, 1)
+        sel.register(p.stderr, selectors.EVENT_READ, 2)
+        while sel.get_map():
+            for key, mask in sel.select():
+                data = os.read(key.fd, 65536)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    continue
+                with self.cond:
+                    self.frames.append((key.data, data))
+                    self.cond.notify_all()
+        sel.close()
+        self.finish([], p.wait())
+
+    def finish(self, frames, exit_code):
+        with self.cond:
+            self.frames.extend(frames)
+            self.exit_code = exit_code
+            self.cond.notify_all()
+
+
+class EngineStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        if body is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self, method):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        parts = unquote(url.path).split('/')[2:]
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode()) if length else None
+        self.server.log.append((method, '/' + '/'.join(parts)))
+        if (method, '/' + '/'.join(parts)) in self.server.hang_up:
+            self.server.hang_up.discard((method, '/' + '/'.join(parts)))
+            self.close_connection = True
+            return
+        if parts[:2] == ['containers', 'create']:
+            if body['Image'] not in self.server.images:
+                return self._reply(404, {'message': 'No such image: %s' % body['Image']})
+            cid = uuid.uuid4().hex
+            self.server.containers[cid] = _Container(body)
+            return self._reply(201, {'Id': cid, 'Warnings': []})
+        if parts[0] == 'containers':
+            container = self.server.containers.get(parts[1])
+            if container is None:
+                return self._reply(404, {'message': 'No such container: %s' % parts[1]})
+            action = parts[2] if len(parts) > 2 else None
+            if method == 'DELETE' and action is None:
+                del self.server.containers[parts[1]]
+                return self._reply(204)
+            if action == 'start':
+                threading.Thread(target=container.run, daemon=True).start()
+                return self._reply(204)
+            if action == 'wait':
+                with container.cond:
+                    container.cond.wait_for(lambda: container.exit_code is not None)
+                return self._reply(200, {'StatusCode': container.exit_code, 'Error': None})
+            if action == 'attach':
+                return self._attach(container)
+        if parts[0] == 'images' and parts[-1] == 'json' and method == 'GET':
+            name = '/'.join(parts[1:-1])
+            if name not in self.server.images:
+                return self._reply(404, {'message': 'No such image: %s' % name})
+            return self._reply(200, {'Id': 'sha256:' + uuid.uuid5(uuid.NAMESPACE_URL, name).hex * 2})
+        if parts[:2] == ['images', 'create']:
+            self.server.pull_auth.append(self.headers.get('X-Registry-Auth'))
+            image = '%s:%s' % (query['fromImage'], query.get('tag', 'latest'))
+            if image in self.server.fail_pulls:
+                lines = [{'status': 'Pulling from %s' % query['fromImage']},
+                         {'errorDetail': {'message': 'manifest unknown'}, 'error': 'manifest unknown'}]
+            else:
+                self.server.images.add(image)
+                lines = [{'status': 'Pulling from %s' % query['fromImage']}, {'status': 'Downloaded newer image'}]
+            data = ''.join(json.dumps(line) + '\n' for line in lines).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            return self.wfile.write(data)
+        return self._reply(404, {'message': 'page not found'})
+
+    def _attach(self, container):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.end_headers()
+        sent = 0
+        while True:
+            with container.cond:
+                container.cond.wait_for(lambda: len(container.frames) > sent or container.exit_code is not None)
+                frames = container.frames[sent:]
+                done = container.exit_code is not None
+            for stream, data in frames:
+                self.wfile.write(struct.pack('>BxxxL', stream, len(data)) + data)
+            self.wfile.flush()
+            sent += len(frames)
+            if done and sent == len(container.frames):
+                break
+        self.close_connection = True
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_POST(self):
+        self._route('POST')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+
+class EngineStubServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, images=()):
+        socketserver.UnixStreamServer.__init__(self, path, EngineStubHandler)
+        self.path = path
+        self.images = set(images)
+        self.fail_pulls = set()
+        self.pull_auth = []
+        self.hang_up = set()
+        self.containers = {}
+        self.connections = 0
+        self.log = []
+        self.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Stand-in for the docker CLI in tests. Commands given to run/exec are executed on the host.
+Every invocation is appended to $FAKE_DOCKER_LOG, and $FAKE_DOCKER_START_DELAY seconds are spent
+"creating" each container to mimic the cost of docker run. image inspect reports $FAKE_DOCKER_IMAGE_ID as the image id.
+With $FAKE_DOCKER_IMAGES set, only images with a file in that directory are present; pull takes
+$FAKE_DOCKER_PULL_DELAY seconds to add one, and fails for the images listed in $FAKE_DOCKER_PULL_FAIL.
+"""
+import os
+import sys
+import time
+import uuid
+
+OPTIONS_WITH_VALUES = ('-v', '--volume', '--entrypoint', '--name', '-w', '--workdir', '-e', '--env')
+
+
+def split(args):
+    options, rest = [], list(args)
+    while rest and rest[0].startswith('-'):
+        option = rest.pop(0)
+        options.append(option)
+        if option in OPTIONS_WITH_VALUES:
+            options.append(rest.pop(0))
+    return options, rest
+
+
+def image_file(image):
+    return os.path.join(os.environ['FAKE_DOCKER_IMAGES'], image.replace('/', '_').replace(':', '_'))
+
+
+def main(args):
+    log = os.environ.get('FAKE_DOCKER_LOG')
+    if log:
+        with open(log, 'a') as f:
+            f.write(' '.join(args) + '\n')
+    command = args[0]
+    if command == 'run':
+        options, rest = split(args[1:])
+        time.sleep(float(os.environ.get('FAKE_DOCKER_START_DELAY', '0')))
+        if '-d' in options:
+            sys.stdout.write(uuid.uuid4().hex + '\n')
+            return 0
+        image, cmd = rest[0], rest[1:]
+    elif command == 'exec':
+        options, rest = split(args[1:])
+        container, cmd = rest[0], rest[1:]
+    elif command == 'image' and args[1] == 'inspect':
+        if os.environ.get('FAKE_DOCKER_IMAGES') and not os.path.exists(image_file(args[-1])):
+            sys.stderr.write('Error: No such image: %s\n' % args[-1])
+            return 1
+        sys.stdout.write(os.environ.get('FAKE_DOCKER_IMAGE_ID', 'sha256:' + '0' * 64) + '\n')
+        return 0
+    elif command == 'pull' and os.environ.get('FAKE_DOCKER_IMAGES'):
+        time.sleep(float(os.environ.get('FAKE_DOCKER_PULL_DELAY', '0')))
+        if args[-1] in os.environ.get('FAKE_DOCKER_PULL_FAIL', '').split(','):
+            sys.stderr.write('Error response from daemon: manifest for %s not found\n' % args[-1])
+            return 1
+        open(image_file(args[-1]), 'w').close()
+        return 0
+    elif command in ('rm', 'pull', 'stop'):
+        return 0
+    else:
+        sys.stderr.write('fake docker: unsupported command %s\n' % command)
+        return 1
+    if not cmd:
+        return 0
+    sys.stdout.flush()
+    os.execvp(cmd[0], cmd)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
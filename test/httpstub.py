@@ -0,0 +1,218 @@
+"""
+Loopback HTTP server for tests, serving files from a directory with HEAD, ranged GET (honouring If-Range), PUT,
+DELETE and MOVE support.
+"""
+import os
+import shutil
+import hashlib
+import threading
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _path(self):
+        return os.path.join(self.server.root, self.path.split('?')[0].lstrip('/'))
+
+    def _etag(self, path):
+        st = os.stat(path)
+        return '"%x-%x"' % (int(st.st_mtime), st.st_size)
+
+    def _headers(self, path):
+        size = os.path.getsize(path)
+        headers = {'Content-Length': str(size), 'ETag': self._etag(path),
+                   'Last-Modified': self.date_time_string(os.path.getmtime(path))}
+        if self.server.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+        return size, headers
+
+    def do_HEAD(self):
+        self.server.log.append(('HEAD', self.path, None))
+        if not self.server.head:
+            return self._reply(405)
+        path = self._path()
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size, headers = self._headers(path)
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            self.send_response(304)
+            self.send_header('ETag', headers['ETag'])
+            self.end_headers()
+            return
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_GET(self):
+        path = self._path()
+        requested = self.headers.get('Range')
+        self.server.log.append(('GET', self.path, requested))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size, headers = self._headers(path)
+        start, end, status = 0, size - 1, 200
+        if self.headers.get('If-Range') not in (None, headers['ETag'], headers['Last-Modified']):
+            requested = None
+        if requested and self.server.ranges:
+            first, last = requested.split('=', 1)[1].split('-')
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        headers['Content-Length'] = str(end - start + 1)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            sent = 0
+            while remaining > 0:
+                chunk = f.read(min(65536, remaining))
+                with self.server.lock:
+                    if self.server.fail_after is not None and self.server.failures > 0 and \
+                            sent + len(chunk) > self.server.fail_after:
+                        self.server.failures -= 1
+                        self.wfile.write(chunk[:self.server.fail_after - sent])
+                        self.wfile.flush()
+                        self.close_connection = True
+                        return
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                remaining -= len(chunk)
+
+    def do_DELETE(self):
+        self.server.log.append(('DELETE', self.path, None))
+        path = self._path()
+        if not os.path.isfile(path):
+            return self._reply(404)
+        os.remove(path)
+        self._reply(204)
+
+    def do_MOVE(self):
+        destination = self.headers.get('Destination', '')
+        self.server.log.append(('MOVE', self.path, destination))
+        path = self._path()
+        if not self.server.move or not os.path.isfile(path):
+            return self._reply(405 if not self.server.move else 404)
+        target = os.path.join(self.server.root, urlparse(destination).path.lstrip('/'))
+        existed = os.path.exists(target)
+        os.replace(path, target)
+        self._reply(204 if existed else 201)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        path = self._path()
+        self.server.log.append(('PUT', self.path, dict(self.headers)))
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        if self.server.api_key is not None and self.headers.get('X-JFrog-Art-Api') != self.server.api_key:
+            return self._reply(401)
+        directory = os.path.dirname(path)
+        if self.headers.get('X-Checksum-Deploy', '').lower() == 'true' and self.server.checksum_deploy:
+            # Artifactory style: publish stored content with this sha1 without a body
+            source = self.server.find_sha1(self.headers.get('X-Checksum-Sha1'))
+            if source is None:
+                return self._reply(404)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            if source != path:
+                shutil.copyfile(source, path)
+            return self._reply(201)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        content_range = self.headers.get('Content-Range')
+        if content_range and self.server.put_ranges:
+            start = int(content_range.split()[1].split('-')[0])
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                f.seek(start)
+                f.write(data)
+        else:
+            with open(path, 'wb') as f:
+                f.write(data)
+        self._reply(201)
+
+
+class HTTPStubServer(ThreadingHTTPServer):
+    """
+    :param str root: directory to serve and store uploads in
+    :param bool ranges: advertise and honour Range requests
+    :param bool put_ranges: write ranged PUTs at their offset rather than replacing the file
+    :param bool checksum_deploy: answer X-Checksum-Deploy PUTs from stored content
+    :param str api_key: require this X-JFrog-Art-Api header on PUTs
+    :param bool move: accept WebDAV MOVE
+    :param bool head: answer HEAD requests, 405 when False (as presigned GET urls and some CDNs do)
+    """
+    daemon_threads = True
+
+    def __init__(self, root, ranges=True, put_ranges=True, checksum_deploy=True, api_key=None, move=True,
+                 head=True):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.root = root
+        self.ranges = ranges
+        self.put_ranges = put_ranges
+        self.checksum_deploy = checksum_deploy
+        self.api_key = api_key
+        self.move = move
+        self.head = head
+        self.log = []
+        self.lock = threading.Lock()
+        self.fail_after = None
+        self.failures = 0
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def find_sha1(self, sha1):
+        """
+        :return str: path of a stored file with this sha1, or None
+        """
+        for directory, dirs, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as f:
+                    if hashlib.sha1(f.read()).hexdigest() == sha1:
+                        return path
+        return None
+
+    def fail_responses(self, count, after):
+        """
+        Drops the next count responses after sending after bytes of the body
+        """
+        self.failures = count
+        self.fail_after = after
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def write_artifact(path, size):
+    """
+    Writes a file of pseudo random content and returns its sha256
+    """
+    data = b''.join(hashlib.sha256(str(i).encode()).digest() for i in range(size // 32 + 1))[:size]
+    with open(path, 'wb') as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
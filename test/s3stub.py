@@ -0,0 +1,119 @@
+"""
+Loopback S3-compatible server for tests: path style buckets stored under a directory, single and multipart PUT,
+GET, and Signature Version 4 checked against the request as received.
+"""
+import os
+import uuid
+import hashlib
+import datetime
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.etree import ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ArtifactTools.s3 import sign_v4
+
+
+class S3StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('AWS4-HMAC-SHA256 Credential=%s/' % self.server.access_key):
+            return False
+        names = authorization.split('SignedHeaders=')[1].split(',')[0].split(';')
+        extra = dict((n, self.headers.get(n)) for n in names
+                     if n not in ('host', 'x-amz-date', 'x-amz-content-sha256'))
+        now = datetime.datetime.strptime(self.headers.get('x-amz-date'), '%Y%m%dT%H%M%SZ')
+        url = 'http://%s%s' % (self.headers.get('Host'), self.path)
+        expected = sign_v4(self.command, url, extra, self.server.access_key, self.server.secret_key,
+                           payload_hash=self.headers.get('x-amz-content-sha256'), now=now)
+        return expected['authorization'] == authorization
+
+    def _handle(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query, keep_blank_values=True)
+        self.server.log.append((self.command, self.path))
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length) if length else b''
+        if not self._authorized():
+            return self._reply(403, b'<Error><Code>SignatureDoesNotMatch</Code></Error>')
+        path = os.path.join(self.server.root, unquote(parsed.path).lstrip('/'))
+        if self.command == 'GET':
+            if not os.path.isfile(path):
+                return self._reply(404, b'<Error><Code>NoSuchKey</Code></Error>')
+            with open(path, 'rb') as f:
+                return self._reply(200, f.read())
+        if self.command == 'POST' and 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            self.server.uploads[upload_id] = {}
+            return self._reply(200, ('<InitiateMultipartUploadResult><UploadId>%s</UploadId>'
+                                     '</InitiateMultipartUploadResult>' % upload_id).encode())
+        if self.command == 'PUT' and 'partNumber' in query:
+            self.server.uploads[query['uploadId'][0]][int(query['partNumber'][0])] = data
+            return self._reply(200, headers={'ETag': '"%s"' % hashlib.md5(data).hexdigest()})
+        if self.command == 'POST' and 'uploadId' in query:
+            parts = self.server.uploads.pop(query['uploadId'][0])
+            numbers = [int(e.text) for e in ElementTree.fromstring(data).iter('PartNumber')]
+            self._store(path, b''.join(parts[n] for n in numbers))
+            return self._reply(200, b'<CompleteMultipartUploadResult/>')
+        if self.command == 'DELETE' and 'uploadId' in query:
+            self.server.uploads.pop(query['uploadId'][0], None)
+            return self._reply(204)
+        if self.command == 'DELETE':
+            if os.path.isfile(path):
+                os.remove(path)
+            return self._reply(204)
+        if self.command == 'PUT':
+            self._store(path, data)
+            return self._reply(200, headers={'ETag': '"%s"' % hashlib.md5(data).hexdigest()})
+        self._reply(400)
+
+    def _store(self, path, data):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+
+class S3StubServer(ThreadingHTTPServer):
+    """
+    :param str root: directory holding one subdirectory per bucket
+    """
+    daemon_threads = True
+
+    def __init__(self, root, access_key='AKIDTEST', secret_key='secret'):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), S3StubHandler)
+        self.root = root
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.uploads = {}
+        self.log = []
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def options(self, **extra):
+        options = {'endpoint': self.endpoint, 'access_key': self.access_key, 'secret_key': self.secret_key}
+        options.update(extra)
+        return options
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
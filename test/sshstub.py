@@ -0,0 +1,241 @@
+"""
+In-process SSH/SFTP server for tests, serving a local directory over SFTP and running exec requests
+with the local shell (or a supplied handler).
+"""
+import os
+import socket
+import subprocess
+import threading
+
+import paramiko
+from paramiko import (AUTH_SUCCESSFUL, OPEN_SUCCEEDED, SFTP_OK, SFTPAttributes, SFTPHandle,
+                      SFTPServer, SFTPServerInterface)
+
+_host_key = None
+
+
+def host_key():
+    global _host_key
+    if _host_key is None:
+        _host_key = paramiko.RSAKey.generate(2048)
+    return _host_key
+
+
+def write_client_key(path):
+    """
+    Writes a fresh private key for clients to authenticate with (any key is accepted)
+    """
+    paramiko.RSAKey.generate(2048).write_private_key_file(path)
+    return path
+
+
+class StubServer(paramiko.ServerInterface):
+    def __init__(self, stub):
+        self.stub = stub
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        self.stub.ptys += 1
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        command = command.decode() if isinstance(command, bytes) else command
+        self.stub.commands.append(command)
+        # paramiko replies to the exec request after this returns, so give it time to do that before the
+        # handler can close the channel, as a real sshd would
+        t = threading.Timer(0.02, self.stub.exec_handler, args=(command, channel))
+        t.daemon = True
+        t.start()
+        return True
+
+
+def shell_handler(root):
+    """
+    Runs exec requests with the local shell in root, passing the channel's input to it and its output back
+    """
+    def run(command, channel):
+        p = subprocess.Popen(command, shell=True, cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        err = []
+
+        def feed():
+            try:
+                for data in iter(lambda: channel.recv(65536), b''):
+                    p.stdin.write(data)
+            except (OSError, ValueError):
+                pass
+            finally:
+                try:
+                    p.stdin.close()
+                except OSError:
+                    pass
+
+        threads = [threading.Thread(target=feed), threading.Thread(target=lambda: err.append(p.stderr.read()))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        out = p.stdout.read()
+        p.wait()
+        threads[1].join()
+        if out:
+            channel.sendall(out)
+        if err[0]:
+            channel.sendall_stderr(err[0])
+        channel.send_exit_status(p.returncode)
+        channel.close()
+    return run
+
+
+class StubHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+
+class StubSFTPServer(SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        self.root = server.stub.root
+        super(StubSFTPServer, self).__init__(server, *args, **kwargs)
+
+    def _realpath(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def list_folder(self, path):
+        path = self._realpath(path)
+        try:
+            out = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        path = self._realpath(path)
+        try:
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        f = os.fdopen(fd, mode)
+        handle = StubHandle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._realpath(oldpath), self._realpath(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._realpath(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            if attr.st_mode is not None:
+                os.chmod(self._realpath(path), attr.st_mode & 0o7777)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class SSHStubServer(object):
+    """
+    Listens on a loopback port, accepting any public key. Paths are served relative to root.
+    :param str root: directory served over sftp and used as the cwd for exec requests
+    :param exec_handler: callable(command, channel) used for exec requests, defaults to the local shell
+    """
+    def __init__(self, root, exec_handler=None):
+        self.root = root
+        self.exec_handler = exec_handler or shell_handler(root)
+        self.connections = 0
+        self.commands = []
+        self.ptys = 0
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            t = paramiko.Transport(conn)
+            t.add_server_key(host_key())
+            t.set_subsystem_handler('sftp', SFTPServer, StubSFTPServer)
+            self.transports.append(t)
+            handshake = threading.Thread(target=t.start_server, kwargs={'server': StubServer(self)})
+            handshake.daemon = True
+            handshake.start()
+
+    def close(self):
+        # wakes the blocked accept before the fd is released, so the thread cannot go on to accept on whatever
+        # socket is given the same fd next
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._thread.join()
+        self.sock.close()
+        for t in self.transports:
+            t.close()
@@ -1,8 +1,434 @@
+import os
+import sys
+import json
+import base64
+import stat
+import socket
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
+from DockerTools import BuildConf, DockerBuilder
+from DockerTools.scheduler import BuildScheduler, StepResult, resolve_dependencies
+from DockerTools.warm import ContainerPool
+from DockerTools.stepcache import StepCache
+from DockerTools.engine import EngineClient, EngineError, AuthUnavailable, registry_auth
+from enginestub import EngineStubServer
+
+FAKE_DOCKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_docker.py')
+
+
+def step(name, order=0, depends_on=None):
+    command = {'name': name, 'order': order, 'image': 'img', 'command': name}
+    if depends_on is not None:
+        command['depends_on'] = depends_on
+    return command
+
 
 class TestDockerRunner(unittest.TestCase):
-    pass
+    def test_sample_config(self):
+        bc = BuildConf('sample_configs/docker-runner.yml')
+        bc.build_command_list()
+        self.assertEqual([c['name'] for c in bc.command_list], ['npmtest', 'rmdist', 'ngbuild'])
+        self.assertEqual(resolve_dependencies(bc.command_list),
+                         {'npmtest': [], 'rmdist': [], 'ngbuild': ['rmdist']})
+
+
+class TestStreamingOutput(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def builder(self, script):
+        path = os.path.join(self.tmp, 'step.sh')
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(path, stat.S_IRWXU)
+        run = DockerBuilder()
+        run.set_command({'name': 'npmtest', 'image': 'img'})
+        run.exec_me = path
+        return run
+
+    def test_lines_are_prefixed_and_exit_status_returned(self):
+        run = self.builder('echo one; echo two >&2; printf three; exit 3\n')
+        with self.assertLogs('DockerTools', 'INFO') as logs:
+            self.assertEqual(run.run_command(), 3)
+        self.assertIn('INFO:DockerTools:[npmtest] one', logs.output)
+        self.assertIn('WARNING:DockerTools:[npmtest] two', logs.output)
+        self.assertIn('INFO:DockerTools:[npmtest] three', logs.output)
+
+    def test_long_lines_are_split(self):
+        run = self.builder('head -c 200000 /dev/zero | tr "\\0" x\n')
+        run.max_line = 65536
+        with self.assertLogs('DockerTools', 'INFO') as logs:
+            self.assertEqual(run.run_command(), 0)
+        chunks = [line for line in logs.output if line.startswith('INFO:DockerTools:[npmtest] x')]
+        self.assertEqual(sum(len(c) - len('INFO:DockerTools:[npmtest] ') for c in chunks), 200000)
+        self.assertTrue(all(len(c) <= 65536 + 30 for c in chunks))
+
+
+class TestBuildScheduler(unittest.TestCase):
+    def test_order_is_the_fallback(self):
+        graph = resolve_dependencies([step('a', 1), step('b', 2), step('c', 2), step('d', 3, 'a')])
+        self.assertEqual(graph, {'a': [], 'b': ['a'], 'c': ['a'], 'd': ['a']})
+
+    def test_invalid_graphs(self):
+        self.assertRaises(ValueError, resolve_dependencies, [step('a', depends_on='missing')])
+        self.assertRaises(ValueError, resolve_dependencies, [step('a', depends_on='b'), step('b', depends_on=['a'])])
+
+    def test_independent_steps_run_concurrently(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def run(command):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+            return 0
+
+        scheduler = BuildScheduler([step('lint', 1), step('test', 1), step('build', 1), step('package', 2)], run, 4)
+        results = scheduler.run()
+        self.assertEqual(state['peak'], 3)
+        self.assertTrue(all(r.status == StepResult.OK for r in results))
+        self.assertTrue(results[3].start >= max(r.end for r in results[:3]))
+        path, seconds = scheduler.critical_path()
+        self.assertEqual(path[-1], 'package')
+        self.assertEqual(len(path), 2)
+
+    def test_failure_skips_dependents_only(self):
+        ran = []
+
+        def run(command):
+            ran.append(command['name'])
+            if command['name'] == 'test':
+                return 1
+            if command['name'] == 'lint':
+                raise OSError('docker not found')
+            return 0
+
+        scheduler = BuildScheduler([step('test', depends_on=[]), step('build', depends_on='test'),
+                                    step('publish', depends_on='build'), step('lint', depends_on=[]),
+                                    step('docs', depends_on=[])], run)
+        results = dict((r.name, r) for r in scheduler.run())
+        self.assertEqual(sorted(ran), ['docs', 'lint', 'test'])
+        self.assertEqual(results['test'].returncode, 1)
+        self.assertEqual(results['build'].status, StepResult.SKIPPED)
+        self.assertEqual(results['publish'].status, StepResult.SKIPPED)
+        self.assertIn('docker not found', results['lint'].error)
+        self.assertEqual(results['docs'].status, StepResult.OK)
+
+
+class TestWarmContainers(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, 'docker.log')
+        os.environ['FAKE_DOCKER_LOG'] = self.log
+        self.docker = os.path.join(self.tmp, 'docker')
+        with open(self.docker, 'w') as f:
+            f.write('#!/bin/sh\nexec %s %s "$@"\n' % (sys.executable, FAKE_DOCKER))
+        os.chmod(self.docker, stat.S_IRWXU)
+        self.config = os.path.join(self.tmp, 'docker-runner.yml')
+        with open(self.config, 'w') as f:
+            f.write('one:\n  order: 1\n  command: echo one\n  image: node\n'
+                    'two:\n  order: 2\n  command: echo two\n  image: node\n'
+                    'other:\n  order: 2\n  command: echo other\n  image: python\n')
+
+    def tearDown(self):
+        del os.environ['FAKE_DOCKER_LOG']
+        shutil.rmtree(self.tmp)
+
+    def calls(self):
+        with open(self.log) as f:
+            return [line.split() for line in f]
+
+    def test_steps_share_a_container_per_image(self):
+        bc = BuildConf(self.config, warm=True, docker=self.docker)
+        bc.build_command_list()
+        with self.assertLogs('DockerTools', 'INFO') as logs:
+            self.assertTrue(bc.run_commands())
+        self.assertIn('INFO:DockerTools:[two] two', logs.output)
+        calls = self.calls()
+        runs = [c for c in calls if c[0] == 'run']
+        self.assertEqual(len(runs), 2)
+        self.assertTrue(all('-d' in c for c in runs))
+        execs = [c for c in calls if c[0] == 'exec']
+        self.assertEqual(len(execs), 3)
+        self.assertEqual(execs[0][1], execs[1][1])
+        self.assertEqual(len([c for c in calls if c[0] == 'rm']), 2)
+        self.assertIsNone(bc.pool)
+
+    def test_failed_exec_still_removes_containers(self):
+        with open(self.config, 'a') as f:
+            f.write('bad:\n  order: 3\n  command: "false"\n  image: node\n')
+        bc = BuildConf(self.config, warm=True, docker=self.docker)
+        bc.build_command_list()
+        with self.assertLogs('DockerTools', 'INFO'):
+            self.assertFalse(bc.run_commands())
+        self.assertEqual(bc.exit_code(), 1)
+        self.assertEqual(len([c for c in self.calls() if c[0] == 'rm']), 2)
+
+    def test_overhead_is_measured_for_both_modes(self):
+        bc = BuildConf(self.config, docker=self.docker)
+        bc.build_command_list()
+        with self.assertLogs('DockerTools', 'INFO'):
+            timings = bc.measure_overhead(runs=1)
+        self.assertEqual(sorted(k[0] for k in timings), ['node', 'python'])
+        for timing in timings.values():
+            self.assertEqual(sorted(timing), ['exec', 'run', 'start'])
+
+    def test_pool_starts_each_container_once(self):
+        run = DockerBuilder(self.docker)
+        run.set_command({'image': 'node', 'command': 'true'})
+        with ContainerPool(self.docker) as pool:
+            containers = set()
+            threads = [threading.Thread(target=lambda: containers.add(pool.container_for(run))) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(containers), 1)
+        self.assertEqual([c[0] for c in self.calls()], ['run', 'rm'])
+
+
+class TestStepCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.workspace = os.path.join(self.tmp, 'workspace')
+        os.makedirs(os.path.join(self.workspace, 'src'))
+        self.write('src/app.ts', 'one')
+        self.docker = os.path.join(self.tmp, 'docker')
+        with open(self.docker, 'w') as f:
+            f.write('#!/bin/sh\nexec %s %s "$@"\n' % (sys.executable, FAKE_DOCKER))
+        os.chmod(self.docker, stat.S_IRWXU)
+        script = os.path.join(self.tmp, 'build.sh')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\necho ran >> %s/runs\nmkdir -p %s/dist\ncat %s/src/app.ts > %s/dist/app.js\n' %
+                    (self.tmp, self.workspace, self.workspace, self.workspace))
+        os.chmod(script, stat.S_IRWXU)
+        self.config = os.path.join(self.tmp, 'docker-runner.yml')
+        with open(self.config, 'w') as f:
+            f.write('ngbuild:\n  command: %s\n  image: node\n  volume: %s\n  inputs: "src/**"\n'
+                    '  outputs: [dist]\n' % (script, self.workspace))
+
+    def tearDown(self):
+        os.environ.pop('FAKE_DOCKER_IMAGE_ID', None)
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        with open(os.path.join(self.workspace, name), 'w') as f:
+            f.write(content)
+
+    def build(self):
+        bc = BuildConf(self.config, docker=self.docker, cache_dir=os.path.join(self.tmp, 'cache'))
+        bc.build_command_list()
+        with self.assertLogs('DockerTools', 'INFO'):
+            self.assertTrue(bc.run_commands())
+        with open(os.path.join(self.tmp, 'runs')) as f:
+            runs = len(f.readlines())
+        with open(os.path.join(self.workspace, 'dist', 'app.js')) as f:
+            return runs, f.read(), bc.cached
+
+    def test_unchanged_inputs_restore_outputs(self):
+        self.assertEqual(self.build(), (1, 'one', set()))
+        shutil.rmtree(os.path.join(self.workspace, 'dist'))
+        self.assertEqual(self.build(), (1, 'one', {'ngbuild'}))
+
+    def test_changed_inputs_or_image_rerun(self):
+        self.build()
+        self.write('src/app.ts', 'two')
+        self.assertEqual(self.build(), (2, 'two', set()))
+        os.environ['FAKE_DOCKER_IMAGE_ID'] = 'sha256:' + '1' * 64
+        self.assertEqual(self.build()[:2], (3, 'two'))
+        self.write('src/app.ts', 'one')
+        self.assertEqual(self.build()[0], 4)
+
+    def test_outputs_are_not_inputs(self):
+        cache = StepCache(os.path.join(self.tmp, 'cache'), self.docker)
+        cmd = {'name': 'build', 'image': 'node', 'command': 'build', 'volume': self.workspace,
+               'inputs': ['**'], 'outputs': ['dist']}
+        key = cache.key(cmd)
+        os.makedirs(os.path.join(self.workspace, 'dist'))
+        self.write('dist/app.js', 'built')
+        self.assertEqual(cache.key(cmd), key)
+        cmd['command'] = 'build --prod'
+        self.assertNotEqual(cache.key(cmd), key)
+
+
+class TestImagePrePull(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.images = os.path.join(self.tmp, 'images')
+        os.makedirs(self.images)
+        open(os.path.join(self.images, 'python_3'), 'w').close()
+        os.environ.update({'FAKE_DOCKER_IMAGES': self.images, 'FAKE_DOCKER_PULL_DELAY': '0.5',
+                           'FAKE_DOCKER_LOG': os.path.join(self.tmp, 'docker.log')})
+        self.docker = os.path.join(self.tmp, 'docker')
+        with open(self.docker, 'w') as f:
+            f.write('#!/bin/sh\nexec %s %s "$@"\n' % (sys.executable, FAKE_DOCKER))
+        os.chmod(self.docker, stat.S_IRWXU)
+        self.config = os.path.join(self.tmp, 'docker-runner.yml')
+        node = os.path.join(self.images, 'node_14')
+        with open(self.config, 'w') as f:
+            # lint can only pass before the node image arrives, test only after it has
+            f.write('lint:\n  command: test ! -e %s\n  image: python\n  label: "3"\n  depends_on: []\n'
+                    'test:\n  command: test -e %s\n  image: node\n  label: "14"\n  depends_on: []\n'
+                    'package:\n  command: "true"\n  image: node\n  label: "14"\n  depends_on: [test]\n'
+                    % (node, node))
+
+    def tearDown(self):
+        for name in ('FAKE_DOCKER_IMAGES', 'FAKE_DOCKER_PULL_DELAY', 'FAKE_DOCKER_PULL_FAIL', 'FAKE_DOCKER_LOG'):
+            os.environ.pop(name, None)
+        shutil.rmtree(self.tmp)
+
+    def calls(self):
+        with open(os.environ['FAKE_DOCKER_LOG']) as f:
+            return [line.split() for line in f]
+
+    def test_missing_images_are_pulled_while_local_ones_run(self):
+        bc = BuildConf(self.config, workers=1, docker=self.docker)
+        bc.build_command_list()
+        with self.assertLogs('DockerTools', 'INFO') as logs:
+            self.assertTrue(bc.run_commands())
+        self.assertEqual([c for c in self.calls() if c[0] == 'pull'], [['pull', '--quiet', 'node:14']])
+        self.assertEqual(sorted(bc.puller.digests), ['node:14', 'python:3'])
+        self.assertGreaterEqual(bc.puller.pull_times['node:14'], 0.5)
+        self.assertTrue(any('Pulled 1 image(s) in' in line for line in logs.output))
+        results = dict((r.name, r) for r in bc.results)
+        self.assertLess(results['test'].elapsed, 0.5)
+
+    def test_failed_pull_fails_its_steps_only(self):
+        os.environ['FAKE_DOCKER_PULL_FAIL'] = 'node:14'
+        bc = BuildConf(self.config, docker=self.docker)
+        bc.build_command_list()
+        with self.assertLogs('DockerTools', 'INFO'):
+            self.assertFalse(bc.run_commands())
+        results = dict((r.name, r.status) for r in bc.results)
+        self.assertEqual(results, {'lint': StepResult.OK, 'test': StepResult.FAILED, 'package': StepResult.SKIPPED})
+        self.assertIn('manifest for node:14 not found', bc.results[1].error)
+        self.assertEqual(bc.exit_code(), 1)
+
+    def test_pulls_can_be_left_to_docker_run(self):
+        open(os.path.join(self.images, 'node_14'), 'w').close()
+        bc = BuildConf(self.config, docker=self.docker, pulls=0)
+        bc.build_command_list()
+        with self.assertLogs('DockerTools', 'INFO'):
+            bc.run_commands()
+        self.assertEqual([c[0] for c in self.calls()], ['run', 'run', 'run'])
+
+
+class TestEngineBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = EngineStubServer(os.path.join(self.tmp, 'docker.sock'), images=['python:3'])
+        self.config = os.path.join(self.tmp, 'docker-runner.yml')
+        with open(self.config, 'w') as f:
+            f.write('quoted:\n  command: printf "%%s|%%s\\n" "two words" \'it is\'\n  image: python\n  label: "3"\n'
+                    '  volume: %s\n'
+                    'where:\n  command: pwd\n  image: python\n  label: "3"\n  volume: %s\n'
+                    'failing:\n  command: sh -c "echo broken >&2; exit 3"\n  image: python\n  label: "3"\n'
+                    % (self.tmp, self.tmp))
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp)
+
+    def build(self, workers=2, pulls=3):
+        bc = BuildConf(self.config, workers=workers, pulls=pulls, backend='engine', docker_host='unix://' +
+                       self.server.path)
+        bc.build_command_list()
+        with self.assertLogs('DockerTools', 'INFO') as logs:
+            ok = bc.run_commands()
+        return bc, ok, logs.output
+
+    def test_steps_run_through_the_socket(self):
+        bc, ok, logs = self.build()
+        self.assertFalse(ok)
+        self.assertIn('INFO:DockerTools:[quoted] two words|it is', logs)
+        self.assertIn('INFO:DockerTools:[where] %s' % os.path.realpath(self.tmp), logs)
+        self.assertIn('WARNING:DockerTools:[failing] broken', logs)
+        self.assertEqual(dict((r.name, r.returncode) for r in bc.results), {'quoted': 0, 'where': 0, 'failing': 3})
+        self.assertEqual(bc.exit_code(), 3)
+        self.assertEqual(self.server.containers, {})
+        # one connection per worker for create, start, wait and remove, plus one per attach and the image lookup
+        self.assertLessEqual(self.server.connections, 3 + 2 + 1)
+
+    def test_missing_images_are_pulled_through_the_socket(self):
+        with open(self.config, 'a') as f:
+            f.write('node:\n  command: "true"\n  image: node\n  label: "14"\n'
+                    'gone:\n  command: "true"\n  image: gone\n')
+        self.server.fail_pulls.add('gone:latest')
+        bc, ok, logs = self.build()
+        results = dict((r.name, r) for r in bc.results)
+        self.assertEqual(results['node'].returncode, 0)
+        self.assertIn('manifest unknown', results['gone'].error)
+        self.assertIn(('POST', '/images/create'), self.server.log)
+        self.assertTrue(any('Pulled 1 image(s) in' in line for line in logs))
+
+    def test_daemon_errors_fail_the_step(self):
+        with open(self.config, 'w') as f:
+            f.write('node:\n  command: "true"\n  image: node\n')
+        bc, ok, logs = self.build(pulls=0)
+        self.assertEqual(bc.results[0].returncode, 125)
+        self.assertTrue(any('No such image: node:latest' in line for line in logs))
+
+    def docker_config(self, settings):
+        path = os.path.join(self.tmp, 'config.json')
+        with open(path, 'w') as f:
+            json.dump(settings, f)
+        return path
+
+    def test_pulls_send_registry_credentials(self):
+        config = self.docker_config({'auths': {
+            'registry.example.com:5000': {'auth': base64.b64encode(b'deploy:hunter2').decode()},
+            'https://index.docker.io/v1/': {'identitytoken': 'hub-token'}}})
+        engine = EngineClient(self.server.path, docker_config=config)
+        engine.pull('registry.example.com:5000/team/app:1.0')
+        engine.pull('library/node:14')
+        engine.pull('localhost:5000/app')
+        engine.close()
+        auth = [json.loads(base64.urlsafe_b64decode(a)) if a else None for a in self.server.pull_auth]
+        self.assertEqual(auth, [{'username': 'deploy', 'password': 'hunter2',
+                                 'serveraddress': 'registry.example.com:5000'},
+                                {'identitytoken': 'hub-token', 'serveraddress': 'https://index.docker.io/v1/'},
+                                None])
+        self.assertIn('registry.example.com:5000/team/app:1.0', self.server.images)
+
+    def test_credential_helpers_are_left_to_the_cli(self):
+        config = self.docker_config({'auths': {'ghcr.io': {}}, 'credsStore': 'desktop',
+                                     'credHelpers': {'123.dkr.ecr.us-east-1.amazonaws.com': 'ecr-login'}})
+        with self.assertRaises(AuthUnavailable):
+            registry_auth('ghcr.io/team/app:1', config)
+        with self.assertRaises(AuthUnavailable) as raised:
+            registry_auth('123.dkr.ecr.us-east-1.amazonaws.com/app:1', config)
+        self.assertIn('docker-credential-ecr-login', str(raised.exception))
+        self.assertIsNone(registry_auth('python:3', config))
+        self.assertIsNone(registry_auth('python:3', os.path.join(self.tmp, 'missing.json')))
+
+    def test_idle_connection_is_reopened(self):
+        engine = EngineClient(self.server.path)
+        self.assertEqual(engine.inspect_image('python:3')[:7], 'sha256:')
+        engine._local.conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertIsNone(engine.inspect_image('node:14'))
+        engine.close()
+
+    def test_only_idempotent_requests_are_resent(self):
+        engine = EngineClient(self.server.path)
+        self.assertIsNone(engine.inspect_image('node:14'))
+        self.server.hang_up.add(('GET', '/images/python:3/json'))
+        self.assertEqual(engine.inspect_image('python:3')[:7], 'sha256:')
+        self.assertEqual(self.server.log.count(('GET', '/images/python:3/json')), 2)
+        self.server.hang_up.add(('POST', '/containers/create'))
+        with self.assertRaises(EngineError):
+            engine.create('python:3', ['true'])
+        self.assertEqual(self.server.log.count(('POST', '/containers/create')), 1)
+        engine.close()
 
 
 class TestDeployArtifact(unittest.TestCase):
@@ -0,0 +1,81 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from SSHTools import SSHConnectionPool, load_key
+from sshstub import SSHStubServer, write_client_key
+
+
+class TestSSHConnectionPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.key = write_client_key(os.path.join(cls.tmp, 'id_rsa'))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.server = SSHStubServer(self.root)
+        self.pool = SSHConnectionPool(known_hosts=os.path.join(self.tmp, 'known_hosts'))
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.close()
+        shutil.rmtree(self.root)
+
+    def test_sftp_and_exec_share_one_handshake(self):
+        sftp = self.pool.sftp('127.0.0.1', self.server.port, 'jenkins', self.key)
+        with sftp.open('unit.txt', 'w') as f:
+            f.write('hello')
+        sftp.close()
+        stdin, stdout, stderr = self.pool.exec_command('cat unit.txt', '127.0.0.1', self.server.port,
+                                                       'jenkins', self.key)
+        self.assertEqual(stdout.read(), b'hello')
+        self.assertEqual(stdout.channel.recv_exit_status(), 0)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.pool.stats(), {'handshakes': 1, 'handshakes_saved': 1, 'open': 1})
+
+    def test_separate_users_get_separate_transports(self):
+        self.pool.transport('127.0.0.1', self.server.port, 'jenkins', self.key)
+        self.pool.transport('127.0.0.1', self.server.port, 'root', self.key)
+        self.assertEqual(self.pool.handshakes, 2)
+
+    def test_compressed_sessions_are_pooled_separately(self):
+        plain = self.pool.transport('127.0.0.1', self.server.port, 'jenkins', self.key)
+        sftp = self.pool.sftp('127.0.0.1', self.server.port, 'jenkins', self.key, compress=True,
+                              window_size=16 * 1024 ** 2)
+        self.assertIsNot(sftp.get_channel().get_transport(), plain)
+        self.assertEqual(sftp.get_channel().in_window_size, 16 * 1024 ** 2)
+        sftp.close()
+        self.assertEqual(self.pool.handshakes, 2)
+
+    def test_idle_transports_are_evicted(self):
+        t = self.pool.transport('127.0.0.1', self.server.port, 'jenkins', self.key)
+        self.pool.idle_timeout = -1
+        self.assertEqual(self.pool.evict_idle(), 1)
+        self.assertFalse(t.is_active())
+        self.pool.idle_timeout = 300
+        self.pool.transport('127.0.0.1', self.server.port, 'jenkins', self.key)
+        self.assertEqual(self.pool.stats(), {'handshakes': 2, 'handshakes_saved': 0, 'open': 1})
+
+    def test_transports_with_running_commands_are_not_evicted(self):
+        self.pool.idle_timeout = 0.2
+        stdin, stdout, stderr = self.pool.exec_command('sleep 1; echo done', '127.0.0.1', self.server.port,
+                                                       'jenkins', self.key)
+        time.sleep(0.5)
+        self.pool.transport('127.0.0.1', self.server.port, 'root', self.key)
+        self.assertEqual(stdout.read(), b'done\n')
+        self.assertEqual(stdout.channel.recv_exit_status(), 0)
+        self.assertEqual(self.pool.stats()['open'], 2)
+
+    def test_key_is_parsed_once(self):
+        self.assertIs(load_key(self.key), load_key(self.key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,416 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import ServiceTools
+import ServiceTools.remote
+import SSHTools
+from ServiceTools import ServiceConfig, BasicSysVTemplate, control_service, plan_waves, deploy_service, format_results
+from ServiceTools import control_services, make_probe, rolling_restart
+from ServiceTools.remote import CommandResult
+from ServiceTools.templates import TemplateRegistry, TemplateError
+from ServiceTools.health import HttpProbe, PidfileProbe, SystemdProbe, template_http_port
+from sshstub import SSHStubServer, write_client_key
+
+
+def write_file(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+class TestServiceConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_hosts_and_inventory(self):
+        inventory = write_file(self.tmp, 'inventory.txt', 'web3\n# retired\nweb4\n')
+        conf = write_file(self.tmp, 'service.yml',
+                          'service_name: svc\nhost: web1\nhosts: [web2]\ninventory: %s\n'
+                          'identity_file: /tmp/id\nmax_in_flight: 4\ncanary: 1\nbatch_size: 2\n' % inventory)
+        sc = ServiceConfig(conf)
+        self.assertEqual(sc.hosts, ['web1', 'web2', 'web3', 'web4'])
+        self.assertEqual(sc.host, 'web1')
+        self.assertEqual((sc.max_in_flight, sc.canary, sc.batch_size), (4, 1, 2))
+
+    def test_sample_config(self):
+        sc = ServiceConfig('sample_configs/service-config.yml')
+        self.assertEqual(sc.hosts, ['192.168.56.101'])
+
+
+class TestPlanWaves(unittest.TestCase):
+    def test_canary_and_batches(self):
+        hosts = ['h%d' % i for i in range(7)]
+        self.assertEqual(plan_waves(hosts, canary=1, batch_size=3),
+                         [['h0'], ['h1', 'h2', 'h3'], ['h4', 'h5', 'h6']])
+
+    def test_single_wave(self):
+        self.assertEqual(plan_waves(['a', 'b']), [['a', 'b']])
+        self.assertEqual(plan_waves([]), [])
+
+
+class TestDeployService(unittest.TestCase):
+    def setUp(self):
+        self.sc = mock.Mock(spec=ServiceConfig)
+        self.sc.hosts = ['h%d' % i for i in range(6)]
+        self.sc.max_in_flight = 3
+        self.sc.canary = 0
+        self.sc.batch_size = None
+        self.sc.identity_file = '/tmp/id'
+        self.sc.deploy_user = 'jenkins'
+        self.sc.service_name = 'svc'
+        self.sc.system = 'sysv'
+        self.sc.host_port = 22
+
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'peak': 0}
+
+        def push(template, host):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+
+        self.sc.push_to_host.side_effect = push
+        with mock.patch.object(ServiceTools, 'control_service', return_value=True) as control:
+            results = deploy_service(self.sc, 'template')
+        self.assertEqual([r.host for r in results], self.sc.hosts)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(control.call_count, 6)
+        self.assertEqual(state['peak'], 3)
+
+    def test_canary_failure_halts(self):
+        self.sc.push_to_host.side_effect = IOError('connection refused')
+        with mock.patch.object(ServiceTools, 'control_service', return_value=True):
+            results = deploy_service(self.sc, 'template', canary=1)
+        self.assertEqual(self.sc.push_to_host.call_count, 1)
+        self.assertIn('connection refused', results[0].error)
+        self.assertTrue(all('halted' in r.error for r in results[1:]))
+        self.assertIn('h5', format_results(results))
+
+
+def exit_ok(command, channel):
+    channel.sendall(b'Starting svc service: OK\n')
+    channel.send_exit_status(0)
+    channel.close()
+
+
+class TestPooledConnections(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp, 'tmp'))
+        os.makedirs(os.path.join(self.tmp, 'etc', 'init.d'))
+        os.makedirs(os.path.join(self.tmp, 'etc', 'systemd', 'system'))
+        self.key = write_client_key(os.path.join(self.tmp, 'id_rsa'))
+        self.server = SSHStubServer(self.tmp, exit_ok)
+        self.pool = SSHTools.SSHConnectionPool()
+        self.patches = [mock.patch.object(ServiceTools, 'get_pool', return_value=self.pool),
+                        mock.patch.object(ServiceTools.remote, 'get_pool', return_value=self.pool)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        self.pool.close_all()
+        self.server.close()
+        shutil.rmtree(self.tmp)
+
+    def test_push_and_restart_reuse_one_connection(self):
+        conf = write_file(self.tmp, 'service.yml', 'service_name: svc\nhost: 127.0.0.1\nidentity_file: %s\n'
+                          'deploy_user: jenkins\n' % self.key)
+        sc = ServiceConfig(conf)
+        sc.host_port = self.server.port
+        sc.push_to_host(BasicSysVTemplate().template, '127.0.0.1')
+        self.assertTrue(control_service('jenkins', '127.0.0.1', 'svc', 'sysv', 'restart', self.key,
+                                        self.server.port))
+        self.assertEqual(self.server.commands, ['sudo /etc/init.d/svc restart'])
+        self.assertEqual(self.server.ptys, 1)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.pool.handshakes_saved, 1)
+        with open(os.path.join(self.tmp, 'etc', 'init.d', 'svc')) as f:
+            self.assertIn('Starting svc service', f.read())
+
+
+def unit_handler(root):
+    """
+    Answers sha256sum from the stub's sftp root and succeeds at everything else
+    """
+    def run(command, channel):
+        if command.startswith('sha256sum '):
+            path = command.split()[1]
+            with open(os.path.join(root, path.lstrip('/')), 'rb') as f:
+                channel.sendall(('%s  %s\n' % (hashlib.sha256(f.read()).hexdigest(), path)).encode())
+        channel.send_exit_status(0)
+        channel.close()
+    return run
+
+
+class TestUnitPush(TestPooledConnections):
+    def setUp(self):
+        TestPooledConnections.setUp(self)
+        self.server.exec_handler = unit_handler(self.tmp)
+
+    def deploy(self, system='sysv', env='dev'):
+        conf = write_file(self.tmp, 'service.yml', 'service_name: svc\nhosts: [127.0.0.1]\nidentity_file: %s\n'
+                          'deploy_user: jenkins\nsystem: %s\nenv: %s\n' % (self.key, system, env))
+        sc = ServiceConfig(conf)
+        sc.host_port = self.server.port
+        template = BasicSysVTemplate() if system == 'sysv' else ServiceTools.BasicSysDTemplate()
+        del self.server.commands[:]
+        with self.assertLogs('ServiceTools', 'INFO'):
+            result, = deploy_service(sc, template.template)
+        self.assertTrue(result.ok)
+        return result
+
+    def test_unchanged_unit_is_not_restarted(self):
+        path = os.path.join(self.tmp, 'etc', 'init.d', 'svc')
+        self.assertTrue(self.deploy().changed)
+        self.assertEqual(self.server.commands, ['sudo /etc/init.d/svc restart'])
+        self.assertTrue(os.access(path, os.X_OK))
+        result = self.deploy()
+        self.assertIs(result.changed, False)
+        self.assertFalse(result.controlled)
+        self.assertEqual(self.server.commands, ['sha256sum /etc/init.d/svc'])
+        with open(path, 'a') as f:
+            f.write('#')
+        self.assertTrue(self.deploy().changed)
+        self.assertEqual(self.server.commands, ['sudo /etc/init.d/svc restart'])
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['svc'])
+
+    def test_systemd_reload_only_when_changed(self):
+        self.deploy('systemd')
+        self.assertEqual(self.server.commands, ['sudo systemctl daemon-reload', 'sudo service svc restart'])
+        self.deploy('systemd')
+        self.assertEqual(self.server.commands, ['sha256sum /etc/systemd/system/svc.service'])
+        self.deploy('systemd', 'prd')
+        self.assertEqual(self.server.commands, ['sha256sum /etc/systemd/system/svc.service',
+                                                'sudo systemctl daemon-reload', 'sudo service svc restart'])
+
+
+def slow_restart(command, channel):
+    action = command.split()[-1]
+    try:
+        channel.sendall(b'stopping\n')
+        channel.sendall_stderr(b'warning: ' + action.encode() + b' is slow\n')
+        time.sleep(0.5)
+        channel.sendall(b'started')
+        channel.send_exit_status(3 if action == 'restart-fail' else 0)
+    except OSError:
+        pass
+    channel.close()
+
+
+class TestControlServices(TestPooledConnections):
+    def setUp(self):
+        TestPooledConnections.setUp(self)
+        self.server.exec_handler = slow_restart
+
+    def test_many_hosts_at_once_without_spinning(self):
+        hosts = ['127.0.0.1'] * 40
+        start, cpu = time.time(), time.process_time()
+        with self.assertLogs('ServiceTools', 'INFO') as logs:
+            results = control_services(hosts, 'svc', 'systemd', 'restart', 'jenkins', self.key, self.server.port)
+        self.assertLess(time.time() - start, 5)
+        self.assertLess(time.process_time() - cpu, 2)
+        self.assertEqual(len(results), 40)
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(results[0].stdout, ['stopping', 'started'])
+        self.assertEqual(results[0].stderr, ['warning: restart is slow'])
+        self.assertIn('WARNING:ServiceTools:[127.0.0.1] warning: restart is slow', logs.output)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_exit_status_and_timeout(self):
+        with self.assertLogs('ServiceTools', 'INFO'):
+            result, = control_services(['127.0.0.1'], 'svc', 'sysv', 'restart', 'jenkins', self.key,
+                                       self.server.port, timeout=0.2)
+        self.assertIn('timed out', result.error)
+        with mock.patch.object(ServiceTools.remote, 'service_command', return_value='restart-fail'):
+            with self.assertLogs('ServiceTools', 'INFO'):
+                self.assertFalse(control_service('jenkins', '127.0.0.1', 'svc', 'sysv', 'restart', self.key,
+                                                 self.server.port))
+
+
+class FakeProbe(object):
+    """
+    Ready on the given poll for each host, never if None
+    """
+    def __init__(self, ready_on=2):
+        self.ready_on = ready_on
+        self.polls = {}
+
+    async def check(self, host, sc, executor):
+        self.polls[host] = self.polls.get(host, 0) + 1
+        return self.ready_on is not None and self.polls[host] >= self.ready_on
+
+
+class TestRollingRestart(unittest.TestCase):
+    def setUp(self):
+        self.sc = mock.Mock(spec=ServiceConfig)
+        self.sc.hosts = ['h%d' % i for i in range(6)]
+        self.sc.canary = 1
+        self.sc.batch_size = 3
+        self.sc.max_unavailable = 2
+        self.sc.readiness = {'interval': 0.01, 'timeout': 0.2}
+        self.sc.identity_file = '/tmp/id'
+        self.sc.deploy_user = 'jenkins'
+        self.sc.service_name = 'svc'
+        self.sc.system = 'sysv'
+        self.sc.host_port = 22
+        self.state = {'down': 0, 'peak': 0, 'order': [], 'keys': set()}
+
+    def control(self, probe, failing=()):
+        async def control(user, host, service, type, action, identity_file, port, executor=None):
+            self.state['order'].append(host)
+            self.state['keys'].add(identity_file)
+            self.state['down'] += 1
+            self.state['peak'] = max(self.state['peak'], self.state['down'])
+            result = CommandResult(host, action)
+            result.exit_status = 1 if host in failing else 0
+            return result
+
+        async def check(host, sc, executor):
+            ready = await FakeProbe.check(probe, host, sc, executor)
+            if ready:
+                self.state['down'] -= 1
+            return ready
+        probe.check = check
+        return mock.patch('ServiceTools.health.control_service_async', control)
+
+    def test_waves_wait_for_readiness(self):
+        probe = FakeProbe(ready_on=3)
+        with self.control(probe), self.assertLogs('ServiceTools', 'INFO'):
+            results = rolling_restart(self.sc, probe)
+        self.assertTrue(all(r.ok and r.healthy for r in results))
+        self.assertEqual([r.wave for r in results], [0, 1, 1, 1, 2, 2])
+        self.assertEqual(self.state['peak'], 2)
+        self.assertEqual(probe.polls, dict((h, 3) for h in self.sc.hosts))
+
+    def test_unready_host_halts_rollout(self):
+        probe = FakeProbe(ready_on=None)
+        with self.control(probe), self.assertLogs('ServiceTools', 'INFO'):
+            results = rolling_restart(self.sc, probe)
+        self.assertEqual(self.state['order'], ['h0'])
+        self.assertIn('not ready within', results[0].error)
+        self.assertIs(results[0].healthy, False)
+        self.assertTrue(all('halted' in r.error for r in results[1:]))
+        self.assertIn('False', format_results(results))
+
+    def test_failed_restart_is_not_probed(self):
+        probe = FakeProbe()
+        with self.control(probe, failing=['h2']), self.assertLogs('ServiceTools', 'INFO'):
+            results = rolling_restart(self.sc, probe)
+        self.assertNotIn('h2', probe.polls)
+        self.assertEqual(results[2].error, 'exited with status 1')
+        self.assertEqual(sorted(self.state['order']), ['h0', 'h1', 'h2', 'h3'])
+
+    def test_identity_file_override(self):
+        probe = FakeProbe(ready_on=1)
+        with self.control(probe), self.assertLogs('ServiceTools', 'INFO'):
+            rolling_restart(self.sc, probe, identity_file='/tmp/other_id')
+        self.assertEqual(self.state['keys'], {'/tmp/other_id'})
+
+    def test_probe_from_templates(self):
+        self.sc.readiness = {}
+        sysv = open('templates/sysv.template').read()
+        self.assertEqual(template_http_port(sysv), 9005)
+        probe = make_probe(self.sc, sysv)
+        self.assertIsInstance(probe, HttpProbe)
+        self.assertEqual(probe.port, 9005)
+        self.sc.readiness = {'type': 'pidfile'}
+        probe = make_probe(self.sc, sysv.replace('$servicename', 'svc'))
+        self.assertIsInstance(probe, PidfileProbe)
+        self.assertIn('/var/run/svc/svc.pid', str(probe))
+        self.sc.readiness = {'type': 'systemd'}
+        self.assertIsInstance(make_probe(self.sc, ''), SystemdProbe)
+
+    def test_http_probe(self):
+        import http.server
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200 if self.path == '/health' else 503)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            self.assertTrue(HttpProbe(server.server_port, '/health')._get('127.0.0.1'))
+            self.assertFalse(HttpProbe(server.server_port, '/')._get('127.0.0.1'))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertFalse(HttpProbe(server.server_port)._get('127.0.0.1'))
+
+
+class TestTemplateRegistry(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def config(self, name, system='sysv', hosts='[web1, web2]'):
+        return ServiceConfig(write_file(self.tmp, name + '.yml',
+                                        'service_name: %s\nsystem: %s\nhosts: %s\nenv: dev\n'
+                                        'identity_file: /tmp/id\n' % (name, system, hosts)))
+
+    def test_compiled_render_matches_substitute(self):
+        sc = self.config('svc')
+        for cls in (BasicSysVTemplate, ServiceTools.BasicSysDTemplate):
+            template = cls()
+            self.assertEqual(sc.render(template.compiled), sc.render(template.template))
+        self.assertIn('case "$1" in', sc.render(BasicSysVTemplate().compiled))
+
+    def test_loaded_once_until_changed(self):
+        path = write_file(self.tmp, 'unit.template', 'run $servicename $$HOME\n')
+        registry = TemplateRegistry()
+        self.assertIs(registry.get(path), registry.get(path))
+        self.assertEqual(registry.loads, 1)
+        self.assertEqual(registry.get(path).render({'servicename': 'svc'}), 'run svc $HOME\n')
+        write_file(self.tmp, 'unit.template', 'run ${servicename} in $env\n')
+        os.utime(path, ns=(0, 10 ** 9))
+        self.assertEqual(registry.get(path).render({'servicename': 'svc', 'env': 'dev'}), 'run svc in dev\n')
+        self.assertEqual(registry.loads, 2)
+
+    def test_validation(self):
+        path = write_file(self.tmp, 'bad.template', '$servicename $port $host\n')
+        with self.assertRaises(TemplateError) as e:
+            TemplateRegistry().get(path)
+        self.assertIn('host, port', str(e.exception))
+        path = write_file(self.tmp, 'env.template', '$servicename $env\n')
+        with self.assertRaises(TemplateError) as e:
+            TemplateRegistry().get(path).render({'servicename': 'svc', 'env': None})
+        self.assertIn('env', str(e.exception))
+
+    def test_render_matrix(self):
+        registry = TemplateRegistry()
+        configs = [self.config('api'), self.config('web', 'systemd', '[web3]')]
+        rendered = registry.render_matrix(configs)
+        host, path, content = next(rendered)
+        self.assertEqual((host, path), ('web1', '/etc/init.d/api'))
+        self.assertIn('Starting api service', content)
+        rest = list(rendered)
+        self.assertEqual([(h, p) for h, p, c in rest],
+                         [('web2', '/etc/init.d/api'), ('web3', '/etc/systemd/system/web.service')])
+        self.assertIn('/var/run/dev/web/web.pid', rest[1][2])
+        self.assertEqual(registry.loads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import json
+import unittest
+
+from benchmark import BENCHMARKS, run_benchmarks, compare
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_all_benchmarks_report_metrics(self):
+        report = run_benchmarks(size=1, hosts=2, repeat=4)
+        json.dumps(report)
+        self.assertEqual(sorted(report['results']), sorted(BENCHMARKS))
+        for name, metrics in report['results'].items():
+            self.assertNotIn('error', metrics, name)
+            self.assertTrue(all(value >= 0 or name == 'buildconf_overhead' for value in metrics.values()), name)
+        self.assertGreater(report['results']['http_download']['mb_per_s_4_connections'], 0)
+
+    def test_compare_flags_regressions_by_direction(self):
+        baseline = {'results': {'http_upload': {'mb_per_s': 100.0},
+                                'control_latency': {'warm_p50_seconds': 0.05, 'cold_p50_seconds': 0.2}}}
+        current = {'results': {'http_upload': {'mb_per_s': 70.0},
+                               'control_latency': {'warm_p50_seconds': 0.1, 'cold_p50_seconds': 0.1},
+                               'ssh_handshakes': {'handshakes_per_s': 10.0}}}
+        self.assertEqual(compare(baseline, current),
+                         [('control_latency', 'warm_p50_seconds', 0.05, 0.1), ('http_upload', 'mb_per_s', 100.0, 70.0)])
+        self.assertEqual(compare(baseline, current, tolerance=1.5), [])
+
+
+if __name__ == '__main__':
+    unittest.main()